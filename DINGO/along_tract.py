@@ -542,7 +542,16 @@ data_descr='FA', tract_dir=None):
     )
 
 
-def gen_along_tract_means(data_filename, mask_filename, tract, data_descr='FA'):
+def gen_along_tract_means(data_filename, mask_filename, tract, data_descr='FA',
+                          index_file=None):
+    if index_file is not None:
+        # FileOut cohort index, check inputs were completely sunk
+        from DINGO.interfaces.io import verify_index
+        problems = verify_index(index_file,
+                                files=(data_filename, mask_filename))
+        if len(problems) > 0:
+            raise IOError('Incomplete inputs in {}:\n{}'
+                          .format(index_file, '\n'.join(problems)))
     masked = mask_data(data_filename, mask_filename)
     slice_means = mean_3d(masked)
     masked = None
@@ -1,5 +1,6 @@
 import os
 import sys
+import copy
 import smtplib
 from importlib import import_module
 from email.mime.text import MIMEText
@@ -12,6 +13,7 @@ from nipype import IdentityInterface
 from DINGO.utils import (read_setup,
                          reverse_lookup,
                          tobool)
+from DINGO.preflight import Preflight
 
 
 def keep_and_move_files():
@@ -154,13 +156,18 @@ class DINGO(pe.Workflow):
         'TBSSPreReg':       'DINGO.workflows.fsl',
         'TBSSRegNXN':       'DINGO.workflows.fsl',
         'TBSSPostReg':      'DINGO.workflows.fsl',
+        'TemplateBuild':    'DINGO.workflows.fsl',
+        'WarpRegions':      'DINGO.workflows.fsl',
         'DSI_SRC':          'DINGO.workflows.dsistudio',
         'REC_prep':         'DINGO.workflows.dsistudio',
         'DSI_REC':          'DINGO.workflows.dsistudio',
+        'DSI_HOLD':         'DINGO.workflows.dsistudio',
         'DSI_TRK':          'DINGO.workflows.dsistudio',
         'DSI_ANA':          'DINGO.workflows.dsistudio',
         'DSI_Merge':        'DINGO.workflows.dsistudio',
-        'DSI_EXP':          'DINGO.workflows.dsistudio'
+        'DSI_EXP':          'DINGO.workflows.dsistudio',
+        'DSI_TDI':          'DINGO.workflows.dsistudio',
+        'DSI_DROP':         'DINGO.workflows.dsistudio'
     }
 
     def __init__(self, setuppath=None, workflow_to_module=None, name=None,
@@ -170,6 +177,7 @@ class DINGO(pe.Workflow):
         self.name2step = dict()
         self.input_connections = dict()
         self.input_params = dict()
+        self.method = dict()
         self.subflows = OrderedDict()
         if name is None:
             name = 'DINGO'
@@ -257,6 +265,13 @@ class DINGO(pe.Workflow):
                 setup_val = getattr(setup.inputs, paramval)
                 self.input_params[name].update({paramkey: setup_val})
         _, obj = self.import_mod_obj(step)
+        for paramkey in getattr(obj, 'step_inputs', ()):
+            # e.g. WarpRegions tracts from the DSI_TRK step's inputs
+            paramval = self.input_params[name].get(paramkey)
+            if (isinstance(paramval, (str, unicode)) and
+                    paramval in self.method and paramval != name):
+                self.input_params[name][paramkey] = copy.deepcopy(
+                    self.method[paramval].get('inputs', {}))
         try:
             if issubclass(obj, Interface):
                 new_class = dingo_node_factory(name=name,
@@ -440,6 +455,17 @@ class DINGO(pe.Workflow):
             self.email = setup['email']
 
         method = input_fields['method']
+        self.method = method
+
+        # Collect setup and input problems, report them before connecting
+        if 'preflight' not in setup or tobool(setup['preflight']):
+            if 'preflight_n_procs' in setup:
+                n_procs = setup['preflight_n_procs']
+            else:
+                n_procs = None
+            preflight = Preflight(self, setup_bn, n_procs=n_procs)
+        else:
+            preflight = None
 
         for nameandstep in input_fields['steps']:
             if isinstance(nameandstep, list):
@@ -505,7 +531,12 @@ class DINGO(pe.Workflow):
                 print('### No input connections found for {}, using defaults ###'
                       .format(name))
             print('Create Workflow/Node Name:{0}, Obj:{1}'.format(name, step))
-            self.create_subwf(step, name)
+            if preflight is None:
+                self.create_subwf(step, name)
+            else:
+                preflight.create_subwf(step, name)
+        if preflight is not None:
+            preflight.check()
         self._connect_subwfs()
         if self.email is not None:
             print('Email notification will be sent to {}'
@@ -0,0 +1,561 @@
+import os
+import re
+import gzip
+import json
+import time
+import errno
+import fcntl
+import shutil
+import socket
+import struct
+import hashlib
+import tempfile
+from contextlib import contextmanager
+from warnings import warn
+
+
+def default_cache_dir(name):
+    """Return directory for a DINGO scratch cache, $DINGO_CACHE_DIR/name or
+    tmpdir/dingo_<name>"""
+    base = os.environ.get('DINGO_CACHE_DIR')
+    if base is None:
+        return os.path.join(tempfile.gettempdir(), '_'.join(('dingo', name)))
+    return os.path.join(base, name)
+
+
+@contextmanager
+def locked(path):
+    """Hold an exclusive flock on path for the duration of the block"""
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class FibCache(object):
+    """Scratch cache of decompressed DSI Studio fiber files.
+
+    Each .fib.gz is decompressed once per host into cache_dir/key/, keeping
+    its basename without '.gz', and later commands point at that copy. The
+    key is derived from the size, the first MB and the gzip trailer (crc32
+    and uncompressed size) of the compressed file, so renamed or copied
+    fibs are shared and a changed fib gets a new entry.
+
+    Every acquire() leaves a reference file in the entry, removed by
+    release(). When the cache would grow past max_gb, unreferenced entries
+    are evicted, least recently used first. References of processes that
+    died on this host are ignored. With evict_on_release, the release()
+    that leaves an entry without references also removes it, trading
+    reuse by later steps for scratch space.
+
+    hold() keeps an entry for a whole subject branch, across the processes
+    of its commands, until drop() removes it, e.g. from a node after the
+    last command using the fib.
+
+    Parameters
+    ----------
+    cache_dir   :   Directory (default $DINGO_CACHE_DIR/fib or
+                    tmpdir/dingo_fib)
+    max_gb      :   Float, size budget of the cache (default 20)
+    evict_on_release :  Bool, remove an entry once no process references
+                    it (default False)
+
+    e.g.
+    cache = FibCache('/scratch/fib', max_gb=50)
+    ref = cache.acquire('/data/sub/sub.fib.gz')
+    ... dsi_studio --source=ref ...
+    cache.release(ref)
+    """
+    head_bytes = 1024 * 1024
+    bufsize = 16 * 1024 * 1024
+    refs_name = 'refs'
+    held_prefix = 'held.'
+
+    def __init__(self, cache_dir=None, max_gb=20, evict_on_release=False):
+        if cache_dir is None:
+            cache_dir = default_cache_dir('fib')
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = int(max_gb * 1024 ** 3)
+        self.evict_on_release = evict_on_release
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.lock_file = os.path.join(self.cache_dir, '.lock')
+
+    @classmethod
+    def key(cls, source):
+        """Return cache key of a gzipped file"""
+        size = os.path.getsize(source)
+        sha = hashlib.sha1(str(size))
+        with open(source, 'rb') as f:
+            sha.update(f.read(cls.head_bytes))
+            if size > cls.head_bytes:
+                f.seek(-8, os.SEEK_END)
+                sha.update(f.read(8))
+        return sha.hexdigest()
+
+    @staticmethod
+    def uncompressed_size(source):
+        """Return size of gzip content from trailer, modulo 2**32"""
+        with open(source, 'rb') as f:
+            f.seek(-4, os.SEEK_END)
+            return struct.unpack('<I', f.read(4))[0]
+
+    def entry(self, source):
+        """Return path of the decompressed copy of source in the cache"""
+        name = os.path.basename(source)
+        if name.endswith('.gz'):
+            name = name[:-3]
+        return os.path.join(self.cache_dir, self.key(source), name)
+
+    def acquire(self, source):
+        """Return decompressed copy of source, creating it if necessary.
+        The copy stays until release(path) is called for it."""
+        source = os.path.abspath(source)
+        path = self.entry(source)
+        entry_dir = os.path.dirname(path)
+        with locked(self.lock_file):
+            if not os.path.isfile(path):
+                self._evict(self.uncompressed_size(source))
+            self._add_ref(entry_dir, 1)
+            # access time for LRU, atime is unreliable on noatime mounts
+            os.utime(entry_dir, None)
+        try:
+            # referenced, so not evicted, decompress outside the cache lock
+            with locked(''.join((entry_dir, '.lock'))):
+                if not os.path.isfile(path):
+                    self._decompress(source, path)
+        except Exception:
+            self.release(path)
+            raise
+        return path
+
+    def release(self, path):
+        """Drop one reference of this process to the cached path, removing
+        the entry if it was the last one and evict_on_release is set"""
+        entry_dir = os.path.dirname(path)
+        with locked(self.lock_file):
+            self._add_ref(entry_dir, -1)
+            if self.evict_on_release and self._n_refs(entry_dir) == 0:
+                self._remove(entry_dir)
+
+    def hold(self, source):
+        """Return decompressed copy of source, creating it if necessary.
+        The copy stays, whichever process uses it, until drop(source)."""
+        path = self.acquire(source)
+        entry_dir = os.path.dirname(path)
+        with locked(self.lock_file):
+            with open(os.path.join(entry_dir, self.refs_name,
+                                   self._held_name(source)), 'w') as f:
+                f.write(os.path.abspath(source))
+            self._add_ref(entry_dir, -1)
+        return path
+
+    def drop(self, source, evict=True):
+        """Remove the hold() on source, and the entry if evict and no
+        process references it"""
+        entry_dir = os.path.dirname(self.entry(os.path.abspath(source)))
+        with locked(self.lock_file):
+            held = os.path.join(entry_dir, self.refs_name,
+                                self._held_name(source))
+            if os.path.isfile(held):
+                os.remove(held)
+            if (evict and os.path.isdir(entry_dir) and
+                    self._n_refs(entry_dir) == 0):
+                self._remove(entry_dir)
+
+    def _held_name(self, source):
+        return ''.join((self.held_prefix, hashlib.sha1(
+            os.path.abspath(source)).hexdigest()))
+
+    def _ref_name(self):
+        return '{}.{:d}'.format(socket.gethostname(), os.getpid())
+
+    def _add_ref(self, entry_dir, n):
+        """Change the reference count of this process to an entry by n"""
+        refs = os.path.join(entry_dir, self.refs_name)
+        if not os.path.isdir(refs):
+            if n < 0:
+                return
+            os.makedirs(refs)
+        ref = os.path.join(refs, self._ref_name())
+        count = n
+        if os.path.isfile(ref):
+            with open(ref, 'r') as f:
+                count += int(f.read() or 0)
+        if count > 0:
+            with open(ref, 'w') as f:
+                f.write(str(count))
+        elif os.path.isfile(ref):
+            os.remove(ref)
+
+    def _n_refs(self, entry_dir):
+        """Return number of processes with live references to an entry"""
+        refs = os.path.join(entry_dir, self.refs_name)
+        try:
+            names = os.listdir(refs)
+        except OSError:
+            return 0
+        host = socket.gethostname()
+        n = 0
+        for name in names:
+            if name.startswith(self.held_prefix):
+                n += 1
+                continue
+            ref_host, _, pid = name.rpartition('.')
+            if ref_host == host and not pid_alive(int(pid)):
+                os.remove(os.path.join(refs, name))
+            else:
+                n += 1
+        return n
+
+    def _decompress(self, source, path):
+        tmp = '{}.{:d}.part'.format(path, os.getpid())
+        try:
+            with open(tmp, 'wb') as fout:
+                gz = gzip.open(source, 'rb')
+                try:
+                    shutil.copyfileobj(gz, fout, self.bufsize)
+                finally:
+                    gz.close()
+            os.rename(tmp, path)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def entries(self):
+        """Return [(last_used, size, entry_dir)] of cached entries"""
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, key)
+            if not os.path.isdir(entry_dir):
+                continue
+            size = 0
+            for name in os.listdir(entry_dir):
+                if name != self.refs_name:
+                    size += os.path.getsize(os.path.join(entry_dir, name))
+            entries.append((os.stat(entry_dir).st_mtime, size, entry_dir))
+        return entries
+
+    @staticmethod
+    def _remove(entry_dir):
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        try:
+            os.remove(''.join((entry_dir, '.lock')))
+        except OSError:
+            pass
+
+    def _evict(self, needed):
+        """Remove unreferenced entries, oldest first, until needed bytes
+        fit in the budget"""
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in entries:
+            if total + needed <= self.max_bytes:
+                break
+            if self._n_refs(entry_dir) == 0:
+                self._remove(entry_dir)
+                total -= size
+        if total + needed > self.max_bytes:
+            warn('Fib cache {} over budget, {:.1f} GB in use'
+                 .format(self.cache_dir, (total + needed) / 1024. ** 3))
+
+    def purge(self, max_age=None):
+        """Remove unreferenced entries, only those unused for max_age
+        seconds if given"""
+        now = time.time()
+        with locked(self.lock_file):
+            for last_used, _, entry_dir in self.entries():
+                if max_age is not None and now - last_used < max_age:
+                    continue
+                if self._n_refs(entry_dir) == 0:
+                    self._remove(entry_dir)
+
+
+_hash_memo = dict()
+
+
+def content_hash(path, memo_file=None):
+    """Return sha1 of a file's content, memoized by real path, size and
+    mtime in this process, and in memo_file (json) if given"""
+    from DINGO.interfaces.io import file_checksum, update_json
+    path = os.path.realpath(path)
+    st = os.stat(path)
+    stamp = [st.st_size, st.st_mtime]
+    memo = _hash_memo.get(path)
+    if memo is not None and memo[:2] == stamp:
+        return memo[2]
+    if memo_file is not None and os.path.isfile(memo_file):
+        with open(memo_file, 'r') as f:
+            for p, entry in json.load(f).items():
+                _hash_memo.setdefault(p, entry)
+        memo = _hash_memo.get(path)
+        if memo is not None and memo[:2] == stamp:
+            return memo[2]
+    digest = file_checksum(path, 'sha1')
+    _hash_memo[path] = stamp + [digest]
+    if memo_file is not None:
+        def add(data):
+            data[path] = stamp + [digest]
+            return data
+        update_json(memo_file, add)
+    return digest
+
+
+class ResultCache(object):
+    """Cache of command results shared by workflows, keyed by content.
+
+    The key is the command's arguments with input files replaced by their
+    basename and content hash, input directories (e.g. of DICOMs) by their
+    name and the names and content hashes of their files, and the working
+    directory removed, so the same command on the same data in any nipype
+    working directory has the same key. Entries are the output files, hardlinked (copied across
+    filesystems) in and out, and the command output text.
+
+    Parameters
+    ----------
+    cache_dir   :   Directory
+
+    e.g.
+    cache = ResultCache('/scratch/dingo_results')
+    key = cache.key(['--action=rec', '--source=/data/a.src.gz'], os.getcwd())
+    if cache.fetch(key, os.getcwd()) is None:
+        ... run, then
+        cache.store(key, os.getcwd(), output_files, stdout)
+    """
+    cwd_mark = '<cwd>'
+    record_name = 'result.json'
+    _split_re = re.compile(r'([=,;:])')
+
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.abspath(cache_dir)
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.memo_file = os.path.join(self.cache_dir, 'hashes.json')
+
+    def normalize(self, arg, cwd):
+        """Replace input files and directories in an argument by
+        basename@hash and strip the working directory from outputs"""
+        cwd = os.path.join(os.path.abspath(cwd), '')
+        tokens = self._split_re.split(arg)
+        for i, token in enumerate(tokens):
+            if token.startswith(cwd):
+                tokens[i] = token[len(cwd):]
+            elif os.path.isfile(token):
+                tokens[i] = '@'.join((os.path.basename(token),
+                                      content_hash(token, self.memo_file)))
+            elif token and os.path.isdir(token):
+                tokens[i] = '@'.join((
+                    os.path.basename(os.path.normpath(token)),
+                    self.dir_hash(token)))
+        return ''.join(tokens)
+
+    def dir_hash(self, path):
+        """Return sha1 of the sorted relative names and content hashes of
+        the files in a directory tree"""
+        sha = hashlib.sha1()
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            for name in sorted(names):
+                afile = os.path.join(root, name)
+                if not os.path.isfile(afile):
+                    continue
+                sha.update('{}\0{}\n'.format(
+                    os.path.relpath(afile, path),
+                    content_hash(afile, self.memo_file)))
+        return sha.hexdigest()
+
+    def key(self, args, cwd, extra=()):
+        """Return key of a command's argument list, with extra values
+        that change its results but are not arguments"""
+        normalized = [self.normalize(arg, cwd) for arg in args]
+        normalized.extend(repr(e) for e in extra)
+        return hashlib.sha1('\n'.join(normalized)).hexdigest()
+
+    def fetch(self, key, cwd):
+        """Link the files of entry key into cwd. Return its record, or
+        None if it is not cached"""
+        from DINGO.interfaces.io import link_file, copy_file
+        entry_dir = os.path.join(self.cache_dir, key)
+        record_file = os.path.join(entry_dir, self.record_name)
+        if not os.path.isfile(record_file):
+            return None
+        with open(record_file, 'r') as f:
+            record = json.load(f)
+        cwd = os.path.abspath(cwd)
+        for name in record['files']:
+            src = os.path.join(entry_dir, name)
+            dst = os.path.join(cwd, name)
+            if link_file(src, dst, 'hardlink') is None:
+                copy_file(src, dst)
+        record['stdout'] = record['stdout'].replace(self.cwd_mark, cwd)
+        os.utime(entry_dir, None)
+        return record
+
+    def store(self, key, cwd, files, stdout):
+        """Add output files (in cwd) and stdout as entry key, atomically"""
+        from DINGO.interfaces.io import link_file, copy_file
+        cwd = os.path.abspath(cwd)
+        entry_dir = os.path.join(self.cache_dir, key)
+        if os.path.isdir(entry_dir):
+            return entry_dir
+        tmp = '{}.{:d}.tmp'.format(entry_dir, os.getpid())
+        shutil.rmtree(tmp, ignore_errors=True)
+        names = []
+        for afile in files:
+            name = os.path.relpath(os.path.abspath(afile), cwd)
+            if link_file(afile, os.path.join(tmp, name), 'hardlink') is None:
+                copy_file(afile, os.path.join(tmp, name))
+            names.append(name)
+        if not os.path.isdir(tmp):
+            os.makedirs(tmp)
+        with open(os.path.join(tmp, self.record_name), 'w') as f:
+            json.dump({'files': names,
+                       'stdout': stdout.replace(cwd, self.cwd_mark),
+                       'created': time.time()}, f)
+        try:
+            os.rename(tmp, entry_dir)
+        except OSError:
+            # stored meanwhile by another process
+            shutil.rmtree(tmp, ignore_errors=True)
+        return entry_dir
+
+
+class PairStore(ResultCache):
+    """Store of pairwise registrations, e.g. TBSS NxN, keyed by content.
+
+    The key is the content hash of the moving image, target image and
+    moving weight (mask), and the registration options, so a pair is
+    computed once whatever cohort list it was part of. Entries are the
+    output files, by basename, and numbers such as deformation statistics.
+
+    Parameters
+    ----------
+    cache_dir   :   Directory
+
+    e.g.
+    store = PairStore('/scratch/dingo_tbss_pairs')
+    key = store.key(moving_fa, target_fa, moving_mask, {'dof': 12})
+    record = store.fetch(key, os.getcwd())
+    if record is None:
+        ... register, then
+        store.store(key, [mat_file, warp_file], mean_median=[mean, median])
+    """
+    record_name = 'pair.json'
+
+    def key(self, moving, target, mask=None, options=None):
+        """Return key of registering moving (weighted by mask) to target"""
+        parts = [content_hash(moving, self.memo_file),
+                 content_hash(target, self.memo_file),
+                 '' if mask is None else content_hash(mask, self.memo_file),
+                 json.dumps(options, sort_keys=True)]
+        return hashlib.sha1('\n'.join(parts)).hexdigest()
+
+    def fetch(self, key, out_dir):
+        """Link the files of entry key into out_dir. Return its record with
+        'files' as absolute paths, or None if it is not stored"""
+        record = super(PairStore, self).fetch(key, out_dir)
+        if record is not None:
+            out_dir = os.path.abspath(out_dir)
+            record['files'] = [os.path.join(out_dir, name)
+                               for name in record['files']]
+        return record
+
+    def store(self, key, files, **values):
+        """Add files, by basename, and values as entry key, atomically"""
+        from DINGO.interfaces.io import link_file, copy_file
+        entry_dir = os.path.join(self.cache_dir, key)
+        if os.path.isdir(entry_dir):
+            return entry_dir
+        tmp = '{}.{:d}.tmp'.format(entry_dir, os.getpid())
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        names = []
+        for afile in files:
+            name = os.path.basename(afile)
+            if link_file(afile, os.path.join(tmp, name), 'hardlink') is None:
+                copy_file(afile, os.path.join(tmp, name))
+            names.append(name)
+        record = dict(values)
+        record.update(files=names, stdout='', created=time.time())
+        with open(os.path.join(tmp, self.record_name), 'w') as f:
+            json.dump(record, f)
+        try:
+            os.rename(tmp, entry_dir)
+        except OSError:
+            # stored meanwhile by another process
+            shutil.rmtree(tmp, ignore_errors=True)
+        return entry_dir
+
+
+class TransformCache(object):
+    """Cache of transform chains composed into one displacement field.
+
+    The key is the content hash of each transform, in order, which affines
+    are inverted, and the reference grid (shape and affine), so a subject's
+    chain is composed once and shared by every image warped into that grid.
+
+    Parameters
+    ----------
+    cache_dir   :   Directory
+
+    e.g.
+    cache = TransformCache('/scratch/dingo_transforms')
+    key = cache.key(['s_Affine.txt', 's_InverseWarp.nii.gz'], 'fa.nii.gz', [1])
+    field = cache.get(key, compose)  # compose(out_file) writes the field
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.abspath(cache_dir)
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.memo_file = os.path.join(self.cache_dir, 'hashes.json')
+
+    def key(self, transforms, reference_image, invert_affine=None,
+            dimension=3):
+        """Return key of composing transforms on reference_image's grid"""
+        import nibabel as nib
+        ref = nib.load(reference_image)
+        grid = [list(ref.shape[:dimension]), ref.affine.round(4).tolist()]
+        parts = [content_hash(t, self.memo_file) for t in transforms]
+        parts.append(json.dumps(sorted(invert_affine or [])))
+        parts.append(json.dumps(grid))
+        parts.append(str(dimension))
+        return hashlib.sha1('\n'.join(parts)).hexdigest()
+
+    def get(self, key, compose):
+        """Return the composed field of key, calling compose(out_file) to
+        write it first if it is not cached"""
+        path = os.path.join(self.cache_dir, ''.join((key, '.nii.gz')))
+        if not os.path.isfile(path):
+            with locked(''.join((path, '.lock'))):
+                if not os.path.isfile(path):
+                    tmp = os.path.join(self.cache_dir, '{}.{:d}.nii.gz'
+                                       .format(key, os.getpid()))
+                    try:
+                        compose(tmp)
+                        os.rename(tmp, path)
+                    finally:
+                        if os.path.isfile(tmp):
+                            os.remove(tmp)
+        os.utime(path, None)
+        return path
@@ -9,7 +9,9 @@
 from nipype.interfaces.base import (TraitedSpec, File, traits,isdefined)
 from nipype.interfaces.ants.base import ANTSCommand, ANTSCommandInputSpec
 import os
-from nipype.interfaces.base import InputMultiPath
+from nipype.interfaces.base import (InputMultiPath, OutputMultiPath,
+                                    Directory, BaseInterface,
+                                    BaseInterfaceInputSpec)
 from nipype.utils.filemanip import split_filename
 import numpy as np
 
@@ -189,6 +191,118 @@ class ANTS(ANTSCommand):
         return outputs
 
 
+def transformation_series_args(transforms, invert_affine=None):
+    """Return transforms as ANTs arguments, with -i before the affines
+    (counted from 1, by "affine" in the file name) in invert_affine"""
+    series = []
+    affine_counter = 0
+    for transformation in transforms:
+        if "affine" in transformation.lower() and \
+                isdefined(invert_affine) and invert_affine is not None:
+            affine_counter += 1
+            if affine_counter in invert_affine:
+                series += '-i',
+        series += [transformation]
+    return ' '.join(series)
+
+
+def compose_transforms(transforms, reference_image, invert_affine=None,
+                       dimension=3, cache_dir=None):
+    """Compose a WarpImageMultiTransform series into one displacement field
+    on the reference_image grid, with ComposeMultiTransform.
+
+    With cache_dir the field is kept in a DINGO.cache.TransformCache there,
+    and composed only if the same transforms and grid were not composed
+    before. Otherwise it is written to the working directory.
+
+    Returns
+    -------
+    field   :   File, absolute path
+    """
+    if not isdefined(invert_affine):
+        invert_affine = None
+
+    def compose(out_file):
+        cmt = ComposeMultiTransform(
+            dimension=dimension,
+            output_transform=out_file,
+            reference_image=reference_image,
+            transforms=list(transforms))
+        if invert_affine:
+            cmt.inputs.invert_affine = list(invert_affine)
+        cmt.terminal_output = 'allatonce'
+        return cmt.run().outputs.output_transform
+
+    if cache_dir is None:
+        _, name, _ = split_filename(os.path.abspath(transforms[0]))
+        return compose(os.path.abspath(''.join((name, '_composed.nii.gz'))))
+    from DINGO.cache import TransformCache
+    cache = TransformCache(cache_dir)
+    key = cache.key(transforms, reference_image, invert_affine, dimension)
+    return cache.get(key, compose)
+
+
+class ComposeMultiTransformInputSpec(ANTSCommandInputSpec):
+    dimension = traits.Enum(3, 2, argstr='%d', usedefault=True,
+                            desc='image dimension (2 or 3)', position=0)
+    output_transform = File(genfile=True, hash_files=False, argstr='%s',
+                            desc='name of the composed displacement field',
+                            position=1)
+    reference_image = File(exists=True, argstr='-R %s', mandatory=True,
+                           desc='the composed field is on this image\'s grid',
+                           position=2)
+    transforms = InputMultiPath(File(exists=True), argstr='%s',
+                                mandatory=True, position=-1,
+                                desc=('transformation file(s) to compose, in '
+                                      'WarpImageMultiTransform order'))
+    invert_affine = traits.List(traits.Int,
+                                desc=('List of Affine transformations to invert, '
+                                      'as WarpImageMultiTransform invert_affine'))
+
+
+class ComposeMultiTransformOutputSpec(TraitedSpec):
+    output_transform = File(exists=True, desc='Composed displacement field')
+
+
+class ComposeMultiTransform(ANTSCommand):
+    """Composes a series of transforms into one displacement field
+    Examples
+    --------
+    >>> cmt = ComposeMultiTransform()
+    >>> cmt.inputs.reference_image = 'functional.nii'
+    >>> cmt.inputs.transforms = ['func2anat_coreg_Affine.txt','dwi2anat_Warp.nii.gz']
+    >>> cmt.inputs.invert_affine = [1]
+    >>> cmt.cmdline
+    'ComposeMultiTransform 3 func2anat_coreg_Affine_composed.nii.gz -R functional.nii -i func2anat_coreg_Affine.txt dwi2anat_Warp.nii.gz'
+    """
+
+    _cmd = 'ComposeMultiTransform'
+    input_spec = ComposeMultiTransformInputSpec
+    output_spec = ComposeMultiTransformOutputSpec
+
+    def _gen_filename(self, name):
+        if name == 'output_transform':
+            _, name, _ = split_filename(
+                os.path.abspath(self.inputs.transforms[0]))
+            return ''.join((name, '_composed.nii.gz'))
+        return None
+
+    def _format_arg(self, opt, spec, val):
+        if opt == 'transforms':
+            return transformation_series_args(val, self.inputs.invert_affine)
+        return super(ComposeMultiTransform, self)._format_arg(opt, spec, val)
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        if isdefined(self.inputs.output_transform):
+            outputs['output_transform'] = os.path.abspath(
+                self.inputs.output_transform)
+        else:
+            outputs['output_transform'] = os.path.abspath(
+                self._gen_filename('output_transform'))
+        return outputs
+
+
 class WarpImageMultiTransformInputSpec(ANTSCommandInputSpec):
     dimension = traits.Enum(3, 2, argstr='%d', usedefault=True,
                             desc='image dimension (2 or 3)', position=1)
@@ -224,6 +338,11 @@ class WarpImageMultiTransformInputSpec(ANTSCommandInputSpec):
                                       'starts with 1 and does not include warp fields. Affine '
                                       'transformations are distinguished '
                                       'from warp fields by the word "affine" included in their filenames.'))
+    transform_cache = Directory(nohash=True,
+                                desc=('Compose transformation_series into one field '
+                                      'on the reference_image grid, kept here by the '
+                                      'content of the transforms and grid, and warp '
+                                      'with it. Requires reference_image.'))
 
 
 class WarpImageMultiTransformOutputSpec(TraitedSpec):
@@ -261,18 +380,24 @@ class WarpImageMultiTransform(ANTSCommand):
             return ''.join((name, self.inputs.out_postfix, ext))
         return None
 
+    def _run_interface(self, runtime):
+        self._composed = None
+        if (isdefined(self.inputs.transform_cache) and
+                isdefined(self.inputs.reference_image) and
+                len(self.inputs.transformation_series) > 1):
+            self._composed = compose_transforms(
+                self.inputs.transformation_series,
+                self.inputs.reference_image,
+                invert_affine=self.inputs.invert_affine,
+                dimension=self.inputs.dimension,
+                cache_dir=self.inputs.transform_cache)
+        return super(WarpImageMultiTransform, self)._run_interface(runtime)
+
     def _format_arg(self, opt, spec, val):
         if opt == 'transformation_series':
-            series = []
-            affine_counter = 0
-            for transformation in val:
-                if "affine" in transformation.lower() and \
-                        isdefined(self.inputs.invert_affine):
-                    affine_counter += 1
-                    if affine_counter in self.inputs.invert_affine:
-                        series += '-i',
-                series += [transformation]
-            return ' '.join(series)
+            if getattr(self, '_composed', None) is not None:
+                return self._composed
+            return transformation_series_args(val, self.inputs.invert_affine)
         return super(WarpImageMultiTransform, self)._format_arg(opt, spec, val)
 
     def _list_outputs(self):
@@ -282,4 +407,103 @@ class WarpImageMultiTransform(ANTSCommand):
         else:
             outputs['output_image'] = os.path.abspath(
                 self._gen_filename('output_image'))
-        return outputs
\ No newline at end of file
+        return outputs
+
+
+class BatchWarpImageMultiTransformInputSpec(BaseInterfaceInputSpec):
+    dimension = traits.Enum(3, 2, usedefault=True,
+                            desc='image dimension (2 or 3)')
+    input_images = InputMultiPath(File(exists=True), mandatory=True,
+                                  desc='images to apply transformation to')
+    out_postfix = traits.Str('_wimt', usedefault=True,
+                             desc='Postfix appended to each output image name')
+    reference_image = File(exists=True, mandatory=True,
+                           desc='reference image space that you wish to warp INTO')
+    use_nearest = traits.Bool(desc='Use nearest neighbor interpolation')
+    use_bspline = traits.Bool(desc='Use 3rd order B-Spline interpolation')
+    transformation_series = InputMultiPath(File(exists=True), mandatory=True,
+                                           desc='transformation file(s) to be applied')
+    invert_affine = traits.List(traits.Int,
+                                desc=('List of Affine transformations to invert, '
+                                      'as WarpImageMultiTransform invert_affine'))
+    transform_cache = Directory(nohash=True,
+                                desc=('Keep the composed field here, by content, '
+                                      'instead of the working directory'))
+    n_procs = traits.Int(1, usedefault=True,
+                         desc='Number of images to warp at the same time')
+
+
+class BatchWarpImageMultiTransformOutputSpec(TraitedSpec):
+    output_images = OutputMultiPath(File(exists=True),
+                                    desc='Warped images, in input_images order')
+    composed_transform = File(exists=True,
+                              desc='Composed displacement field used')
+
+
+class BatchWarpImageMultiTransform(BaseInterface):
+    """Warps a list of images with the same transformation series.
+
+    The series is composed once into a displacement field on the
+    reference_image grid (cached with transform_cache), and each image is
+    warped by it with WarpImageMultiTransform, n_procs at a time. Outputs
+    are named as WarpImageMultiTransform would name them.
+
+    Example
+    -------
+    bwimt = BatchWarpImageMultiTransform()
+    bwimt.inputs.input_images = ['region1.nii', 'region2.nii']
+    bwimt.inputs.reference_image = 'fa.nii.gz'
+    bwimt.inputs.transformation_series = ['s_Affine.txt', 's_InverseWarp.nii.gz']
+    bwimt.inputs.invert_affine = [1]
+    bwimt.inputs.use_nearest = True
+    bwimt.run()
+    bwimt.outputs.output_images = ['region1_wimt.nii', 'region2_wimt.nii']
+    """
+    input_spec = BatchWarpImageMultiTransformInputSpec
+    output_spec = BatchWarpImageMultiTransformOutputSpec
+
+    def _warp(self, input_image):
+        wimt = WarpImageMultiTransform(
+            dimension=self.inputs.dimension,
+            input_image=input_image,
+            out_postfix=self.inputs.out_postfix,
+            reference_image=self.inputs.reference_image,
+            transformation_series=[self._composed])
+        for opt in ('use_nearest', 'use_bspline'):
+            value = getattr(self.inputs, opt)
+            if isdefined(value):
+                setattr(wimt.inputs, opt, value)
+        # images share cwd, keep their stdout in memory
+        wimt.terminal_output = 'allatonce'
+        return wimt.run().outputs.output_image
+
+    def _run_interface(self, runtime):
+        from multiprocessing.pool import ThreadPool
+        cache_dir = self.inputs.transform_cache
+        if not isdefined(cache_dir):
+            cache_dir = None
+        self._composed = compose_transforms(
+            self.inputs.transformation_series,
+            self.inputs.reference_image,
+            invert_affine=self.inputs.invert_affine,
+            dimension=self.inputs.dimension,
+            cache_dir=cache_dir)
+        images = list(self.inputs.input_images)
+        n_procs = min(max(self.inputs.n_procs, 1), len(images))
+        if n_procs <= 1:
+            self._output_images = list(map(self._warp, images))
+        else:
+            pool = ThreadPool(n_procs)
+            try:
+                self._output_images = pool.map(self._warp, images)
+            finally:
+                pool.close()
+                pool.join()
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['output_images'] = getattr(self, '_output_images', [])
+        if getattr(self, '_composed', None) is not None:
+            outputs['composed_transform'] = self._composed
+        return outputs
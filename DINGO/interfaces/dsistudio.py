@@ -1,18 +1,28 @@
 import os
+import re
+import gzip
 import time
+import errno
 import shutil
+import logging
+import subprocess
 from itertools import compress
 from DINGO.utils import (list_to_str,
                          split_filename)
+from DINGO.cache import (FibCache,
+                         ResultCache)
 from nipype.interfaces.base import (traits, File, Directory, InputMultiPath, 
                                     OutputMultiPath, isdefined,
                                     CommandLine, CommandLineInputSpec, 
-                                    TraitedSpec)
+                                    TraitedSpec, BaseInterface,
+                                    BaseInterfaceInputSpec)
 from traits.trait_base import _Undefined
 
 # on_trait_change functions not firing when updating from indict
 # _check_mandatory_inputs  updates are currently necessary
 
+iflogger = logging.getLogger('nipype.interface')
+
 
 class DSIInfo(object):
     # atlas list
@@ -230,6 +240,30 @@ class DSIInfo(object):
             msg = 'Invalid DSIStudio Reconstruction method: %s' % method_id
             raise KeyError(msg)
             
+    @classmethod
+    def rec_param_tag(cls, method_id, params):
+        """Get a compact tag naming a reconstruction parameter set
+
+        Parameter
+        ---------
+        method_id   :   Str
+        params      :   Dict {input id: value}, all reconstruction inputs
+
+        Return
+        ------
+        Str, method id, values of the method rec_param_ids and a short
+        hash of all the method inputs, e.g. 'gqi1.25_3f9a2c'
+        """
+        import hashlib
+        values = [str(params[pid]) for pid in cls.rec_mid_to_pids(method_id)
+                  if pid in params]
+        method_inputs = sorted((k, repr(params[k]))
+                               for k in cls.rec_mid_to_req(method_id)
+                               if k in params)
+        digest = hashlib.sha1(
+            repr([method_id] + method_inputs)).hexdigest()[:6]
+        return '_'.join((''.join([method_id] + values), digest))
+
     @classmethod
     def rec_mid_to_req(cls, method_id):
         """Get required inputs per reconstruction method"""
@@ -263,6 +297,33 @@ class DSIStudioInputSpec(CommandLineInputSpec):
     indict = traits.Dict(
         desc='Dict of keys for inputspec, with their values. '
              'Will overwrite all conflicts')
+    fib_cache = traits.Bool(
+        False,
+        usedefault=True,
+        nohash=True,
+        desc='Run on a decompressed copy of a .fib.gz source kept in a '
+             'scratch cache shared by DSI Studio commands on this host')
+    fib_cache_dir = Directory(
+        nohash=True,
+        desc='Scratch cache directory (default $DINGO_CACHE_DIR/fib or '
+             'tmpdir/dingo_fib)')
+    fib_cache_gb = traits.Float(
+        20,
+        usedefault=True,
+        nohash=True,
+        desc='Size budget of the fib cache, unused fibs are evicted '
+             'least recently used first')
+    fib_cache_evict = traits.Bool(
+        False,
+        usedefault=True,
+        nohash=True,
+        desc='Remove the decompressed copy from the fib cache once no '
+             'command uses it')
+    result_cache = Directory(
+        nohash=True,
+        desc='Cache shared by workflows, an identical command on identical '
+             'input files links the outputs of its earlier run instead of '
+             'running again')
 
 
 class DSIStudioOutputSpec(TraitedSpec):
@@ -271,11 +332,23 @@ class DSIStudioOutputSpec(TraitedSpec):
 
 class DSIStudioCommand(CommandLine):
     """Base support for DSI Studio commands.
+
+    Output is read as DSI Studio writes it: paths of produced files and
+    progress percentages are collected line by line, progress is logged
+    every progress_step percent and passed to progress_callback(pct, line)
+    if set.
     """
     _cmd = 'dsi_studio'
     _output_type = None
     _action = None
     terminal_output = 'file'
+    # stdout markers of produced files, the path follows on the same line
+    _path_markers = ('write to file ',)
+    # or on the next line
+    _next_line_markers = ('output data',)
+    _progress_re = re.compile(r'(\d{1,3}(?:\.\d+)?)\s*%')
+    progress_step = 10
+    progress_callback = None
 
     input_spec = DSIStudioInputSpec
 
@@ -321,6 +394,242 @@ class DSIStudioCommand(CommandLine):
                     # print('Input: '%s' set to Value: %s' % (key, value))
                     # Type checking is handled by traits InputSpec
 
+    def _reset_output_parser(self):
+        self._produced = []
+        self._progress = None
+        self._next_line_path = False
+        self._last_line = None
+
+    def _parse_output_line(self, line):
+        """Collect produced path or progress from one line of output"""
+        line = line.strip()
+        if not line:
+            return
+        self._last_line = line
+        if self._next_line_path:
+            self._next_line_path = False
+            self._produced.append(line)
+            return
+        if line in self._next_line_markers:
+            self._next_line_path = True
+            return
+        for marker in self._path_markers:
+            if marker in line:
+                self._produced.append(line.split(marker, 1)[1].strip())
+                return
+        match = self._progress_re.search(line)
+        if match:
+            pct = float(match.group(1))
+            last = self._progress
+            self._progress = pct
+            if (last is None or
+                    int(pct // self.progress_step) !=
+                    int(last // self.progress_step)):
+                iflogger.info('dsi_studio %s %s: %.0f%%',
+                              self._action, os.path.basename(
+                                  str(getattr(self.inputs, 'source'))), pct)
+            if self.progress_callback is not None:
+                self.progress_callback(pct, line)
+
+    def _parse_output(self, text):
+        """Parse complete output, e.g. from a log or a cached result"""
+        self._reset_output_parser()
+        for line in re.split(r'[\r\n]', text):
+            self._parse_output_line(line)
+        return self._produced
+
+    def _produced_files(self, runtime):
+        """Return paths DSI Studio reported writing, in order"""
+        if getattr(self, '_produced', None) is None:
+            text = runtime.merged or runtime.stdout or ''
+            self._parse_output(text)
+        return self._produced
+
+    def _debuglog_path(self):
+        value = self.inputs.debuglog
+        if not isdefined(value):
+            return None
+        if os.path.exists(value):
+            return value
+        srcpath, _, _ = split_filename(getattr(self.inputs, 'source'))
+        return os.path.join(srcpath, value)
+
+    def _run_command(self, runtime, correct_return_codes=(0,)):
+        """Run cmdline like CommandLine._run_interface, but parse the
+        output as it arrives"""
+        from nipype.utils.filemanip import which
+        runtime.stdout = None
+        runtime.stderr = None
+        runtime.cmdline = self.cmdline
+        runtime.environ.update(self._get_environ())
+        executable_name = self.cmd.split()[0]
+        runtime.command_path = which(executable_name, env=runtime.environ)
+        if runtime.command_path is None:
+            raise IOError(
+                'No command "{}" found on host {}. Please check that the '
+                'corresponding package is installed.'
+                .format(executable_name, runtime.hostname))
+        runtime.dependencies = '<skipped>'
+
+        self._reset_output_parser()
+        proc = subprocess.Popen(runtime.cmdline,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                shell=True,
+                                cwd=runtime.cwd,
+                                env=runtime.environ)
+        chunks = []
+        partial = ''
+        fd = proc.stdout.fileno()
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            # DSI Studio rewrites progress with carriage returns
+            lines = re.split(r'[\r\n]', partial + chunk)
+            partial = lines.pop()
+            for line in lines:
+                self._parse_output_line(line)
+        self._parse_output_line(partial)
+        proc.stdout.close()
+        runtime.returncode = proc.wait()
+        runtime.stdout = ''.join(chunks)
+        runtime.stderr = ''
+        runtime.merged = runtime.stdout
+
+        debuglog = self._debuglog_path()
+        if debuglog is not None and os.path.isfile(debuglog):
+            # stdout was redirected to the log
+            with open(debuglog, 'r') as f:
+                self._parse_output(f.read())
+        if self.terminal_output == 'file':
+            with open(os.path.join(runtime.cwd, 'stdout.nipype'), 'w') as f:
+                f.write(runtime.stdout)
+            with open(os.path.join(runtime.cwd, 'stderr.nipype'), 'w') as f:
+                f.write(runtime.stderr)
+        if runtime.returncode not in correct_return_codes:
+            self.raise_exception(runtime)
+        return runtime
+
+    @staticmethod
+    def _relocate(afile, directory, basename=None):
+        """Move afile into directory, with a rename when on the same
+        filesystem. Return new path."""
+        if basename is None:
+            basename = os.path.basename(afile)
+        newfile = os.path.join(os.path.abspath(directory), basename)
+        if os.path.abspath(afile) == newfile:
+            return newfile
+        try:
+            os.rename(afile, newfile)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.move(afile, newfile)
+        return newfile
+
+    def _relocate_produced(self, runtime, index, newfile):
+        """Point produced file index and the runtime output at newfile"""
+        afile = self._produced[index]
+        self._produced[index] = newfile
+        for attr in ('merged', 'stdout'):
+            text = getattr(runtime, attr, None)
+            if text:
+                setattr(runtime, attr, text.replace(afile, newfile))
+
+    def _fib_cache(self):
+        """Return FibCache if the source should be run from it, else None"""
+        source = getattr(self.inputs, 'source')
+        if not (self.inputs.fib_cache and isdefined(source) and
+                source.endswith('.fib.gz')):
+            return None
+        cache_dir = self.inputs.fib_cache_dir
+        if not isdefined(cache_dir):
+            cache_dir = None
+        return FibCache(cache_dir, self.inputs.fib_cache_gb,
+                        self.inputs.fib_cache_evict)
+
+    def _result_cache_extra(self):
+        """Values besides the arguments that change the outputs, the
+        command and the path, size and mtime of the binary it runs, so
+        results of another DSI Studio build are not reused"""
+        from nipype.utils.filemanip import which
+        environ = dict(os.environ)
+        environ.update(self._get_environ())
+        command_path = which(self.cmd.split()[0], env=environ)
+        if command_path is None:
+            return [self.cmd]
+        command_path = os.path.realpath(command_path)
+        st = os.stat(command_path)
+        return [self.cmd, command_path, st.st_size, st.st_mtime]
+
+    def _result_files(self, outputs, cwd):
+        """Return existing output files in cwd"""
+        cwd = os.path.join(os.path.abspath(cwd), '')
+        files = []
+        for value in outputs.get().itervalues():
+            if not isinstance(value, (list, tuple)):
+                value = [value]
+            for afile in value:
+                if (isinstance(afile, basestring) and
+                        afile.startswith(cwd) and os.path.isfile(afile) and
+                        afile not in files):
+                    files.append(afile)
+        return files
+
+    def _run_interface(self, runtime):
+        if not isdefined(self.inputs.result_cache):
+            return self._run_fib_cached(runtime)
+        cache = ResultCache(self.inputs.result_cache)
+        args = [arg for arg in self._parse_inputs()
+                if not arg.startswith('> ')]  # debuglog
+        key = cache.key(args, runtime.cwd, self._result_cache_extra())
+        record = cache.fetch(key, runtime.cwd)
+        if record is not None:
+            runtime.cmdline = self.cmdline
+            runtime.returncode = 0
+            runtime.stdout = record['stdout']
+            runtime.merged = record['stdout']
+            runtime.stderr = ''
+            # aggregate_outputs parses the cached output
+            self._produced = None
+            return runtime
+        runtime = self._run_fib_cached(runtime)
+        # outputs are relocated to cwd by aggregate_outputs, which is
+        # safe to run again from run()
+        outputs = self.aggregate_outputs(runtime)
+        cache.store(key, runtime.cwd, self._result_files(outputs, runtime.cwd),
+                    runtime.merged or runtime.stdout or '')
+        return runtime
+
+    def _run_fib_cached(self, runtime):
+        cache = self._fib_cache()
+        if cache is None:
+            return self._run_command(runtime)
+        source = self.inputs.source
+        debuglog = self.inputs.debuglog
+        if isdefined(debuglog) and not os.path.exists(debuglog):
+            # keep the log beside the real source, not in the cache
+            self.inputs.debuglog = os.path.join(os.path.dirname(source),
+                                                debuglog)
+        cached = cache.acquire(source)
+        try:
+            self.inputs.source = cached
+            runtime = self._run_command(runtime)
+            self._from_fib_cache(runtime, source, cached)
+        finally:
+            self.inputs.source = source
+            self.inputs.debuglog = debuglog
+            cache.release(cached)
+        return runtime
+
+    def _from_fib_cache(self, runtime, source, cached):
+        """Fix outputs written beside the cached source, while it is held.
+        Output names from the source basename are the same for .fib and
+        .fib.gz, so nothing needs fixing by default."""
+        pass
+
     def _gen_fname(self,
                    basename,
                    cwd=None,
@@ -1291,6 +1600,251 @@ class DSIStudioTrack(DSIStudioFiberCommand):
         self.inputs.on_trait_change(self._gen_output_pfx_base, 'source')
 
 
+class DSIStudioBatchTrackInputSpec(BaseInterfaceInputSpec):
+    source = File(
+        exists=True,
+        mandatory=True,
+        desc='Fiber file shared by all tracts')
+    tract_names = traits.List(
+        traits.Str(),
+        mandatory=True,
+        desc='Names of the tracts, same order as tract_inputs')
+    tract_inputs = traits.List(
+        traits.Dict(),
+        mandatory=True,
+        desc='DSIStudioTrack indict for each tract')
+    n_procs = traits.Int(
+        1,
+        usedefault=True,
+        desc='Number of tracts to track at the same time')
+    decompress = traits.Bool(
+        True,
+        usedefault=True,
+        desc='Decompress a .fib.gz source once into the working directory, '
+             'so each tract does not have to')
+    fib_cache = traits.Bool(
+        False,
+        usedefault=True,
+        nohash=True,
+        desc='Decompress into the shared fib cache instead of the working '
+             'directory')
+    fib_cache_dir = Directory(
+        nohash=True,
+        desc='Scratch cache directory (default $DINGO_CACHE_DIR/fib or '
+             'tmpdir/dingo_fib)')
+    fib_cache_gb = traits.Float(
+        20,
+        usedefault=True,
+        nohash=True,
+        desc='Size budget of the fib cache')
+    fib_cache_evict = traits.Bool(
+        False,
+        usedefault=True,
+        nohash=True,
+        desc='Remove the decompressed copy from the fib cache once no '
+             'command uses it')
+
+
+class DSIStudioBatchTrackOutputSpec(TraitedSpec):
+    output = traits.List(
+        traits.Either(File(exists=True), None),
+        desc='path/name of fiber track file for each tract, None if not '
+             'generated')
+    tract_names = traits.List(
+        traits.Str(),
+        desc='tract names, same order as output, endpt and stat_file')
+    endpt = traits.List(
+        traits.Either(File(), None),
+        desc='path/name of fiber track end points file for each tract, '
+             'None if not generated')
+    stat_file = traits.List(
+        traits.Either(File(), None),
+        desc='path/name of fiber track stats file for each tract, None if '
+             'not generated')
+    tract_outputs = traits.List(
+        traits.Dict(),
+        desc='all DSIStudioTrack outputs for each tract')
+
+
+class DSIStudioBatchTrack(BaseInterface):
+    """Track several tracts from the same fiber file in one node.
+
+    The fiber file is decompressed once, into the working directory or the
+    shared fib cache, and every tract is run as a DSIStudioTrack against it,
+    n_procs at a time.
+    Outputs are named as DSIStudioTrack would name them from source, so
+    they are the same as tracking each tract separately.
+
+    Example
+    -------
+    trk = DSIStudioBatchTrack()
+    trk.inputs.source = 'my.fib.gz'
+    trk.inputs.tract_names = ['Genu', 'Splenium']
+    trk.inputs.tract_inputs = [{'rois': ['myR1.nii.gz']},
+                               {'rois': ['myR2.nii.gz']}]
+    trk.inputs.n_procs = 2
+    trk.run()
+    trk.outputs.output = ['Genu_my.trk.gz', 'Splenium_my.trk.gz']
+    """
+    input_spec = DSIStudioBatchTrackInputSpec
+    output_spec = DSIStudioBatchTrackOutputSpec
+
+    def _local_source(self):
+        """Return fiber file to track from, decompressed in cwd if needed"""
+        source = os.path.abspath(self.inputs.source)
+        if not (self.inputs.decompress and source.endswith('.gz')):
+            return source
+        local = os.path.abspath(os.path.basename(source)[:-3])
+        if (os.path.isfile(local) and
+                os.stat(local).st_mtime >= os.stat(source).st_mtime):
+            return local
+        tmp = '{}.{:d}.part'.format(local, os.getpid())
+        with open(tmp, 'wb') as fout:
+            gz = gzip.open(source, 'rb')
+            try:
+                shutil.copyfileobj(gz, fout, 16 * 1024 * 1024)
+            finally:
+                gz.close()
+        os.rename(tmp, local)
+        return local
+
+    def _track(self, source, tract_name, tract_input):
+        trk = DSIStudioTrack(indict=tract_input)
+        trk.inputs.source = source
+        trk.inputs.tract_name = tract_name
+        # tracts share cwd, keep their stdout in memory
+        trk.terminal_output = 'allatonce'
+        return trk.run().outputs.get()
+
+    def _run_interface(self, runtime):
+        if len(self.inputs.tract_names) != len(self.inputs.tract_inputs):
+            raise ValueError('{:d} tract_names, but {:d} tract_inputs'
+                             .format(len(self.inputs.tract_names),
+                                     len(self.inputs.tract_inputs)))
+        cache = None
+        if self.inputs.decompress and self.inputs.fib_cache:
+            cache_dir = self.inputs.fib_cache_dir
+            if not isdefined(cache_dir):
+                cache_dir = None
+            cache = FibCache(cache_dir, self.inputs.fib_cache_gb,
+                             self.inputs.fib_cache_evict)
+            source = cache.acquire(self.inputs.source)
+        else:
+            source = self._local_source()
+        try:
+            self._track_all(source)
+        finally:
+            if cache is not None:
+                cache.release(source)
+            elif source != os.path.abspath(self.inputs.source):
+                os.remove(source)
+        return runtime
+
+    def _track_all(self, source):
+        from multiprocessing.pool import ThreadPool
+        args = zip(self.inputs.tract_names, self.inputs.tract_inputs)
+
+        def track(arg):
+            return self._track(source, *arg)
+
+        n_procs = min(max(self.inputs.n_procs, 1), len(args))
+        if n_procs <= 1:
+            self._tract_outputs = map(track, args)
+        else:
+            pool = ThreadPool(n_procs)
+            try:
+                self._tract_outputs = pool.map(track, args)
+            finally:
+                pool.close()
+                pool.join()
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        tract_outputs = getattr(self, '_tract_outputs', [])
+        outputs['tract_names'] = list(self.inputs.tract_names)
+        outputs['tract_outputs'] = tract_outputs
+        # one entry per tract, so they stay aligned with tract_names
+        for key in ('output', 'endpt', 'stat_file'):
+            values = [out.get(key) for out in tract_outputs]
+            outputs[key] = [v if isdefined(v) else None for v in values]
+        return outputs
+
+
+class DSIStudioFibHoldInputSpec(BaseInterfaceInputSpec):
+    fib_file = File(
+        exists=True,
+        mandatory=True,
+        desc='Fiber file the DSI Studio commands of a subject run on')
+    fib_cache_dir = Directory(
+        nohash=True,
+        desc='Scratch cache directory (default $DINGO_CACHE_DIR/fib or '
+             'tmpdir/dingo_fib)')
+    fib_cache_gb = traits.Float(
+        20,
+        usedefault=True,
+        nohash=True,
+        desc='Size budget of the fib cache')
+
+
+class DSIStudioFibHoldOutputSpec(TraitedSpec):
+    fib_file = File(
+        exists=True,
+        desc='Fiber file, unchanged, for the commands and DSIStudioFibDrop')
+
+
+class DSIStudioFibHold(BaseInterface):
+    """Decompress a fiber file into the fib cache and keep it there, for
+    the commands of every process of the subject, until DSIStudioFibDrop.
+
+    Example
+    -------
+    hold = DSIStudioFibHold(fib_file='my.fib.gz')
+    hold.run()
+    ... DSI Studio commands with fib_cache=True ...
+    DSIStudioFibDrop(fib_file='my.fib.gz', after=last_output).run()
+    """
+    input_spec = DSIStudioFibHoldInputSpec
+    output_spec = DSIStudioFibHoldOutputSpec
+
+    def _cache(self):
+        cache_dir = self.inputs.fib_cache_dir
+        if not isdefined(cache_dir):
+            cache_dir = None
+        return FibCache(cache_dir, self.inputs.fib_cache_gb)
+
+    def _run_interface(self, runtime):
+        if self.inputs.fib_file.endswith('.gz'):
+            self._cache().hold(self.inputs.fib_file)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['fib_file'] = os.path.abspath(self.inputs.fib_file)
+        return outputs
+
+
+class DSIStudioFibDropInputSpec(DSIStudioFibHoldInputSpec):
+    after = traits.Any(
+        desc='Output of the last step using the fiber file, only connected '
+             'so the drop runs after it')
+    evict = traits.Bool(
+        True,
+        usedefault=True,
+        desc='Remove the decompressed copy if no command is using it')
+
+
+class DSIStudioFibDrop(DSIStudioFibHold):
+    """Remove the DSIStudioFibHold of a fiber file, and by default its
+    decompressed copy from the fib cache"""
+    input_spec = DSIStudioFibDropInputSpec
+    output_spec = DSIStudioFibHoldOutputSpec
+
+    def _run_interface(self, runtime):
+        if self.inputs.fib_file.endswith('.gz'):
+            self._cache().drop(self.inputs.fib_file, self.inputs.evict)
+        return runtime
+
+
 class DSIStudioAnalysisInputSpec(DSIStudioFiberInputSpec):
 
     output_type = traits.Enum(
@@ -1425,6 +1979,9 @@ class DSIStudioSource(DSIStudioCommand):
 
 class DSIStudioReconstructInputSpec(DSIStudioInputSpec):
     
+    output_tag = traits.Str(
+        desc='Tag added before .fib.gz of the fiber file, to tell apart '
+             'reconstructions of the same src, see DSIInfo.rec_param_tag')
     thread_count = traits.Int(
         1,
         argstr='--thread_count=%d',
@@ -1715,6 +2272,10 @@ class DSIStudioReconstruct(DSIStudioCommand):
         
         self._param_update()
             
+    def _result_cache_extra(self):
+        extra = super(DSIStudioReconstruct, self)._result_cache_extra()
+        return extra + [self.inputs.output_tag]
+
     def _check_mandatory_inputs(self):
         """using this to insert/update necessary values, then call super
         _check_mandatory_inputs called before any cmd is run
@@ -1820,25 +2381,30 @@ class DSIStudioReconstruct(DSIStudioCommand):
         
     def aggregate_outputs(self, runtime=None, needed_outputs=None):
         """DSIStudio reconstruct will write the output to the input directory
-        with a variable filename, but puts this information in stdout. Copy and 
-        fix to write to working directory.
+        with a variable filename, but puts this information in stdout. Move 
+        it to the working directory.
         """
         outputs = self._outputs()
-        # as long as terminal_output = 'file' ; stdout in runtime.merged
-        if len(runtime.merged) > 0:
-            split_output = runtime.merged.split('\n')
-        elif len(runtime.stdout) > 0:
-            split_output = runtime.stdout.split('\n')
-        if 'output data' in split_output and os.path.exists(split_output[-1]):
-            afile = split_output[-1]  # last line is created file
-            basename = os.path.basename(afile)
-            workflow_dir = os.getcwd()  # present cache working directory
-            newfile = os.path.join(workflow_dir, basename)
-            shutil.move(afile, newfile)
-            split_output[-1] = newfile
-            runtime.merged = '\n'.join(split_output)
-            setattr(outputs, 'fiber_file', newfile)
-            return outputs
+        produced = self._produced_files(runtime)
+        if self._last_line is not None and self._last_line not in produced:
+            # last line is the created file in older DSI Studio builds
+            produced.append(self._last_line)
+        for index in reversed(xrange(len(produced))):
+            afile = produced[index]
+            if os.path.exists(afile):
+                # last reported file is the fib
+                workflow_dir = os.getcwd()  # present cache working directory
+                basename = os.path.basename(afile)
+                tag = self.inputs.output_tag
+                tagged = ''.join(('.', str(tag), '.fib.gz'))
+                if (isdefined(tag) and tag and basename.endswith('.fib.gz') and
+                        not basename.endswith(tagged)):
+                    basename = ''.join((basename[:-len('.fib.gz')],
+                                        '.', tag, '.fib.gz'))
+                newfile = self._relocate(afile, workflow_dir, basename)
+                self._relocate_produced(runtime, index, newfile)
+                setattr(outputs, 'fiber_file', newfile)
+                return outputs
         raise(IOError('Fiber file not created/found properly for {}.'
                       .format(self.inputs.source)))
     
@@ -1945,34 +2511,35 @@ class DSIStudioExport(DSIStudioCommand):
     _output_type = 'NIFTI'
     input_spec = DSIStudioExportInputSpec
     output_spec = DSIStudioExportOutputSpec
-        
+
+    def _from_fib_cache(self, runtime, source, cached):
+        """Move exports out of the cache, named after the real source"""
+        cached_name = os.path.basename(cached)
+        source_name = os.path.basename(source)
+        produced = self._produced_files(runtime)
+        for index in xrange(len(produced)):
+            afile = produced[index]
+            basename = os.path.basename(afile)
+            if basename.startswith(cached_name):
+                basename = ''.join((source_name,
+                                    basename[len(cached_name):]))
+            if os.path.exists(afile):
+                newfile = self._relocate(afile, os.getcwd(), basename)
+                self._relocate_produced(runtime, index, newfile)
+
     def aggregate_outputs(self, runtime=None, needed_outputs=None):
         """DSIStudio export will write the output to the input directory
         with a variable filename, but puts this information in stdout.
         """
         outputs = self._outputs()
         outputkey = 'export'
-        # as long as terminal_output = 'file' ; stdout in runtime.merged
-        if len(runtime.merged) > 0:
-            log = runtime.merged
-        elif len(runtime.stdout) > 0:
-            log = runtime.stdout
-        split_stdout = log.split('\n')
-        str2find = 'write to file '
         workflow_dir = os.getcwd()
+        produced = self._produced_files(runtime)
         fixed_outputs = []
-        for i in xrange(len(split_stdout)):
-            if str2find in split_stdout[i]:
-                afile = split_stdout[i].replace(str2find, '')
-                basename = os.path.basename(afile)
-                newfile = os.path.join(workflow_dir, basename)
-                shutil.move(afile, newfile)
-                split_stdout[i] = ''.join((str2find, newfile))
-                fixed_outputs.append(newfile)
-        if len(runtime.merged) > 0:
-            runtime.merged = '\n'.join(split_stdout)
-        elif len(runtime.stdout) > 0:
-            runtime.stdout = '\n'.join(split_stdout)
+        for index in xrange(len(produced)):
+            newfile = self._relocate(produced[index], workflow_dir)
+            self._relocate_produced(runtime, index, newfile)
+            fixed_outputs.append(newfile)
         n_expected = len(getattr(self.inputs, outputkey))
         if len(fixed_outputs) == n_expected:
             setattr(outputs, outputkey, fixed_outputs)
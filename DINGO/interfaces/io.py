@@ -0,0 +1,584 @@
+import os
+import glob
+import json
+import time
+import errno
+import shutil
+import hashlib
+from warnings import warn
+from multiprocessing.pool import ThreadPool
+from nipype.interfaces.base import (File, traits, isdefined)
+from nipype.interfaces.io import (DataGrabber,
+                                  DataGrabberInputSpec,
+                                  DataSink,
+                                  DataSinkInputSpec,
+                                  DataSinkOutputSpec)
+from nipype.utils.filemanip import (get_related_files,
+                                    split_filename)
+from nipype.utils.misc import human_order_sorted
+
+
+# linux/fs.h, share the data blocks of src with dst on btrfs, xfs, ...
+FICLONE = 0x40049409
+# link not possible between these files, copy instead
+LINK_FALLBACK_ERRNOS = set(getattr(errno, e) for e in (
+    'EXDEV', 'EPERM', 'EMLINK', 'EOPNOTSUPP', 'ENOTSUP', 'EINVAL', 'ENOTTY',
+    'ENOSYS') if hasattr(errno, e))
+
+
+def makedirs(path):
+    """os.makedirs that tolerates concurrent creation"""
+    try:
+        os.makedirs(path)
+    except OSError as err:
+        if err.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+
+def reflink(src, dst):
+    """Copy-on-write clone src to dst, raise IOError if unsupported"""
+    import fcntl
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            except (IOError, OSError):
+                fdst.close()
+                os.remove(dst)
+                raise
+    shutil.copystat(src, dst)
+
+
+def copy_file(src, dst, checksum=None, bufsize=1024*1024):
+    """Copy src to a temporary file next to dst, then rename it, so dst is
+    never seen partially written.
+
+    Parameters
+    ----------
+    src         :   File
+    dst         :   File
+    checksum    :   Str, hashlib algorithm computed while copying, or None
+
+    Returns
+    -------
+    hexdigest   :   Str or None
+    """
+    digest = None if checksum is None else hashlib.new(checksum)
+    tmp = '{}.{:d}.part'.format(dst, os.getpid())
+    with open(src, 'rb') as fsrc:
+        with open(tmp, 'wb') as fdst:
+            while True:
+                buf = fsrc.read(bufsize)
+                if not buf:
+                    break
+                if digest is not None:
+                    digest.update(buf)
+                fdst.write(buf)
+    shutil.copystat(src, tmp)
+    os.rename(tmp, dst)
+    return None if digest is None else digest.hexdigest()
+
+
+def file_checksum(path, checksum='md5', bufsize=1024*1024):
+    digest = hashlib.new(checksum)
+    with open(path, 'rb') as f:
+        while True:
+            buf = f.read(bufsize)
+            if not buf:
+                break
+            digest.update(buf)
+    return digest.hexdigest()
+
+
+def link_file(src, dst, method='hardlink'):
+    """Sink src to dst with a hardlink, reflink or symlink.
+
+    Parameters
+    ----------
+    src     :   File
+    dst     :   File, replaced if it exists
+    method  :   Str, 'hardlink', 'reflink', 'symlink' or 'copy'
+
+    Returns
+    -------
+    method  :   Str, the method used, None if dst must be copied instead
+        (e.g. different filesystems, or links unsupported)
+    """
+    makedirs(os.path.dirname(dst))
+    if os.path.lexists(dst):
+        if (method == 'hardlink' and not os.path.islink(dst) and
+                os.path.samefile(src, dst)):
+            return method
+        os.remove(dst)
+    try:
+        if method == 'hardlink':
+            os.link(src, dst)
+        elif method == 'reflink':
+            reflink(src, dst)
+        elif method == 'symlink':
+            os.symlink(src, dst)
+        else:
+            return None
+    except ImportError:  # no fcntl, reflink impossible
+        return None
+    except (IOError, OSError) as err:
+        if err.errno in LINK_FALLBACK_ERRNOS:
+            return None
+        raise
+    return method
+
+
+def sink_files(pairs, method='hardlink', n_procs=1, checksum=None):
+    """Sink (src, dst) pairs with method, falling back to copies. Copies, and
+    checksums of linked files, are done by n_procs threads.
+
+    Returns
+    -------
+    sunk    :   List[(method, hexdigest or None)] for each pair
+    """
+    methods = [link_file(src, dst, method) for src, dst in pairs]
+
+    def sink(i):
+        src, dst = pairs[i]
+        if methods[i] is None:
+            return 'copy', copy_file(src, dst, checksum)
+        if checksum is None:
+            return methods[i], None
+        # linked, the data still has to be read once to be hashed
+        return methods[i], file_checksum(src, checksum)
+
+    todo = range(len(pairs))
+    if n_procs > 1 and len(pairs) > 1:
+        pool = ThreadPool(min(n_procs, len(pairs)))
+        try:
+            sunk = pool.map(sink, todo)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        sunk = map(sink, todo)
+    return sunk
+
+
+def update_json(path, update):
+    """Read-modify-write a json file, locked against concurrent sinks and
+    replaced atomically.
+
+    Parameters
+    ----------
+    path    :   File, created if missing
+    update  :   Function(dict) -> dict
+    """
+    import fcntl
+    makedirs(os.path.dirname(path))
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        try:
+            if os.path.isfile(path):
+                with open(path, 'r') as f:
+                    data = json.load(f)
+            else:
+                data = dict()
+            data = update(data)
+            tmp = '{}.{:d}.tmp'.format(path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(data, f, indent=1, sort_keys=True)
+            os.rename(tmp, path)
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+    return data
+
+
+def check_entry(path, entry, checksum=None, rehash=False):
+    """Return the problem with a file listed in a FileOut manifest, or None"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return 'missing {}'.format(path)
+    if st.st_size != entry['size']:
+        return '{} size {:d} != {:d}'.format(path, st.st_size, entry['size'])
+    if st.st_mtime != entry['mtime']:
+        return '{} modified since it was sunk'.format(path)
+    if (rehash and entry.get('checksum') is not None and
+            file_checksum(path, checksum) != entry['checksum']):
+        return '{} {} mismatch'.format(path, checksum)
+    return None
+
+
+def read_manifest(manifest_file):
+    """Return {path: entry}, checksum of a FileOut manifest"""
+    with open(manifest_file, 'r') as f:
+        manifest = json.load(f)
+    root = os.path.dirname(os.path.abspath(manifest_file))
+    files = dict((os.path.join(root, relpath), entry)
+                 for relpath, entry in manifest['files'].items())
+    return files, manifest['checksum']
+
+
+def verify_manifest(manifest_file, rehash=False):
+    """Check the files listed in a FileOut manifest against the disk.
+
+    Size and mtime are compared, the data is only re-read with rehash.
+
+    Returns
+    -------
+    problems    :   List[Str], empty if complete
+    """
+    files, checksum = read_manifest(manifest_file)
+    problems = [check_entry(path, entry, checksum, rehash)
+                for path, entry in sorted(files.items())]
+    return [p for p in problems if p is not None]
+
+
+def verify_index(index_file, files=None, rehash=False, by_content=False):
+    """Check the files of a cohort index written by FileOut, by reading the
+    index and manifests instead of the data.
+
+    Parameters
+    ----------
+    index_file  :   File, base_directory/<manifest_name>_index.json
+    files       :   List[File], only check these, they must be listed
+        (default all listed files)
+    rehash      :   Bool, also compare checksums
+    by_content  :   Bool, a file not listed by path is matched to the
+        listed file sunk from it, e.g. the working directory file of a
+        FileOut, if its size and mtime are as recorded, else to the listed
+        file with the same size and checksum. Only files changed since
+        they were sunk, or sunk before sources were recorded, are read
+
+    Returns
+    -------
+    problems    :   List[Str], empty if complete
+    """
+    with open(index_file, 'r') as f:
+        index = json.load(f)
+    root = os.path.dirname(os.path.abspath(index_file))
+    problems = []
+    listed = dict()
+    for container, entry in sorted(index['containers'].items()):
+        manifest_file = os.path.join(root, entry['manifest'])
+        try:
+            manifest_files, checksum = read_manifest(manifest_file)
+        except (IOError, OSError, ValueError) as err:
+            problems.append('{}: manifest {}: {}'
+                            .format(container, manifest_file, err))
+            continue
+        for path, fentry in manifest_files.items():
+            listed[path] = (fentry, checksum)
+    if files is None:
+        files = sorted(listed.keys())
+    by_size = None
+    for path in files:
+        path = os.path.abspath(path)
+        if path not in listed and by_content:
+            if by_size is None:
+                by_size = dict()
+                by_source = dict()
+                for lpath, (fentry, checksum) in listed.items():
+                    by_size.setdefault(fentry['size'], []).append(
+                        (lpath, fentry, checksum))
+                    if fentry.get('source') is not None:
+                        by_source[fentry['source']] = (lpath, fentry)
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            candidates = []
+            if st is not None:
+                candidates = sorted(by_size.get(st.st_size, []))
+            if path in by_source and st is not None:
+                lpath, fentry = by_source[path]
+                if ([fentry['size'], fentry['source_mtime']] ==
+                        [st.st_size, st.st_mtime]):
+                    # unchanged since it was sunk, no need to read it
+                    path = lpath
+                    candidates = []
+            digests = dict()
+            for lpath, fentry, checksum in candidates:
+                if fentry.get('checksum') is None:
+                    continue
+                if checksum not in digests:
+                    digests[checksum] = file_checksum(path, checksum)
+                if digests[checksum] == fentry['checksum']:
+                    path = lpath
+                    break
+        if path not in listed:
+            problems.append('{} not in {}'.format(path, index_file))
+            continue
+        problem = check_entry(path, listed[path][0], listed[path][1], rehash)
+        if problem is not None:
+            problems.append(problem)
+    return problems
+
+
+class DINGOGrabberInputSpec(DataGrabberInputSpec):
+    manifest = File(exists=True,
+                    desc='DINGO.manifest index of base_directory, templates '
+                         'are resolved from it instead of globbing')
+
+
+class DINGOGrabber(DataGrabber):
+    """DataGrabber that resolves templates through a FileManifest, so that
+    subjects do not each walk the filesystem.
+
+    Behaves as nipype.interfaces.io.DataGrabber if manifest is not set.
+    Paths outside the manifest data_dir are globbed as usual.
+    """
+    input_spec = DINGOGrabberInputSpec
+
+    @staticmethod
+    def subject_key(sub_id, scan_id, uid):
+        return '_'.join((sub_id, scan_id, uid))
+
+    def _glob(self, pattern):
+        if isdefined(self.inputs.manifest):
+            from DINGO.manifest import load_manifest
+            return load_manifest(self.inputs.manifest).glob(pattern)
+        return glob.glob(pattern)
+
+    def _field_template(self, key):
+        template = self.inputs.template
+        field_template = self.inputs.field_template
+        if isdefined(field_template) and key in field_template:
+            template = field_template[key]
+        return template
+
+    def _resolve(self, key, template):
+        filelist = self._glob(template)
+        if len(filelist) == 0:
+            msg = ('Output key: {} Template: {} returned no files'
+                   .format(key, template))
+            if self.inputs.raise_on_empty:
+                raise IOError(msg)
+            warn(msg)
+            return None
+        if self.inputs.sort_filelist:
+            filelist = human_order_sorted(filelist)
+        if len(filelist) == 1:
+            return filelist[0]
+        return filelist
+
+    def _list_outputs(self):
+        """Mostly the same as nipype.interfaces.io.DataGrabber._list_outputs,
+        with glob.glob replaced by self._glob"""
+        if self._infields:
+            for key in self._infields:
+                value = getattr(self.inputs, key)
+                if not isdefined(value):
+                    raise ValueError('{} requires a value for input "{}" '
+                                     'because it was listed in "infields"'
+                                     .format(self.__class__.__name__, key))
+
+        outputs = {}
+        for key, args in self.inputs.template_args.items():
+            outputs[key] = []
+            template = self._field_template(key)
+            if isdefined(self.inputs.base_directory):
+                template = os.path.join(
+                    os.path.abspath(self.inputs.base_directory), template)
+            else:
+                template = os.path.abspath(template)
+            if not args:
+                filelist = self._resolve(key, template)
+                if filelist is not None:
+                    outputs[key].append(filelist)
+            for arglist in args:
+                maxlen = 1
+                for arg in arglist:
+                    if isinstance(arg, str) and hasattr(self.inputs, arg):
+                        arg = getattr(self.inputs, arg)
+                    if isinstance(arg, list):
+                        if (maxlen > 1) and (len(arg) != maxlen):
+                            raise ValueError('incompatible number of '
+                                             'arguments for {}'.format(key))
+                        if len(arg) > maxlen:
+                            maxlen = len(arg)
+                for i in range(maxlen):
+                    argtuple = []
+                    for arg in arglist:
+                        if isinstance(arg, str) and hasattr(self.inputs, arg):
+                            arg = getattr(self.inputs, arg)
+                        if isinstance(arg, list):
+                            argtuple.append(arg[i])
+                        else:
+                            argtuple.append(arg)
+                    filledtemplate = template
+                    if argtuple:
+                        try:
+                            filledtemplate = template % tuple(argtuple)
+                        except TypeError as e:
+                            raise TypeError('{}: Template {} failed to '
+                                            'convert with args {}'
+                                            .format(e, template,
+                                                    tuple(argtuple)))
+                    outputs[key].append(self._resolve(key, filledtemplate))
+            if self.inputs.drop_blank_outputs:
+                outputs[key] = [x for x in outputs[key] if x is not None]
+            elif any([val is None for val in outputs[key]]):
+                outputs[key] = []
+            if len(outputs[key]) == 0:
+                outputs[key] = None
+            elif len(outputs[key]) == 1:
+                outputs[key] = outputs[key][0]
+        return outputs
+
+
+class DINGOSinkInputSpec(DataSinkInputSpec):
+    sink_method = traits.Enum(
+        'copy', 'hardlink', 'reflink', 'symlink', usedefault=True,
+        desc='how files are put in base_directory, links fall back to copy '
+             'when not possible, e.g. across filesystems')
+    sink_n_procs = traits.Int(
+        1, usedefault=True,
+        desc='threads used to copy files')
+    manifest_name = traits.Str(
+        desc='write base_directory/container/<manifest_name>.json with the '
+             'size, mtime and checksum of each sunk file and list it in '
+             'base_directory/<manifest_name>_index.json')
+    checksum = traits.Enum(
+        'md5', 'sha1', 'sha256', usedefault=True,
+        desc='hashlib algorithm of the manifest checksums, computed while '
+             'copying')
+
+
+class DINGOSinkOutputSpec(DataSinkOutputSpec):
+    manifest_file = File(exists=True, desc='manifest of the sunk files')
+
+
+class DINGOSink(DataSink):
+    """DataSink that can hardlink, reflink or symlink results instead of
+    copying them, and copies in parallel.
+
+    Behaves as nipype.interfaces.io.DataSink with sink_method='copy',
+    sink_n_procs=1 and no manifest_name, or when base_directory is on S3.
+
+    With manifest_name, the sunk files are listed with size, mtime and
+    checksum in a manifest per container, and containers are listed in a
+    cohort index, see verify_manifest and verify_index.
+    """
+    input_spec = DINGOSinkInputSpec
+    output_spec = DINGOSinkOutputSpec
+
+    def _sink_pairs(self):
+        """Return [(src, dst)] for all inputs and the out_file list, with
+        DataSink container, folder and substitution rules"""
+        outdir = self._outdir()
+        if isdefined(self.inputs.container):
+            outdir = os.path.join(outdir, self.inputs.container)
+
+        pairs = []
+        out_files = []
+        for key, files in self.inputs._outputs.items():
+            if not isdefined(files):
+                continue
+            if not isinstance(files, list):
+                files = [files]
+            tempoutdir = outdir
+            for d in key.split('.'):
+                if d[0] == '@':
+                    continue
+                tempoutdir = os.path.join(tempoutdir, d)
+            if len(files) > 0 and isinstance(files[0], list):
+                files = [item for sublist in files for item in sublist]
+
+            for src in files:
+                src = os.path.abspath(src)
+                if not os.path.isfile(src):
+                    src = os.path.join(src, '')
+                dst = self._get_dst(src)
+                dst = os.path.join(tempoutdir, dst)
+                dst = self._substitute(dst)
+                if os.path.isfile(src):
+                    pairs.append((src, dst))
+                    _, _, ext = split_filename(src)
+                    for related in get_related_files(
+                            src, include_this_file=False):
+                        _, _, relext = split_filename(related)
+                        if os.path.isfile(related) and dst.endswith(ext):
+                            pairs.append(
+                                (related, dst[:len(dst) - len(ext)] + relext))
+                    out_files.append(dst)
+                elif os.path.isdir(src):
+                    dst = dst.rstrip(os.sep)
+                    if (os.path.exists(dst) and
+                            self.inputs.remove_dest_dir):
+                        shutil.rmtree(dst)
+                    for root, _, names in os.walk(src):
+                        rel = os.path.relpath(root, src)
+                        for name in names:
+                            pairs.append((
+                                os.path.join(root, name),
+                                os.path.normpath(
+                                    os.path.join(dst, rel, name))))
+                    out_files.append(dst)
+        return pairs, out_files
+
+    def _outdir(self):
+        outdir = '.'
+        if isdefined(self.inputs.base_directory):
+            outdir = self.inputs.base_directory
+        return os.path.abspath(outdir)
+
+    def _write_manifest(self, pairs, sunk):
+        """Merge the sunk files in the container manifest, and the container
+        in the cohort index, return the manifest path"""
+        base = self._outdir()
+        root = base
+        container = '.'
+        if isdefined(self.inputs.container):
+            container = self.inputs.container
+            root = os.path.join(base, container)
+        name = self.inputs.manifest_name
+        manifest_file = os.path.join(root, '{}.json'.format(name))
+        files = dict()
+        for (src, dst), (method, hexdigest) in zip(pairs, sunk):
+            st = os.stat(dst)
+            files[os.path.relpath(dst, root)] = {
+                'size': st.st_size,
+                'mtime': st.st_mtime,
+                'checksum': hexdigest,
+                'method': method,
+                'source': os.path.abspath(src),
+                'source_mtime': os.stat(src).st_mtime}
+
+        def update_manifest(manifest):
+            if manifest.get('checksum') != self.inputs.checksum:
+                manifest = dict(files=dict())
+            manifest['checksum'] = self.inputs.checksum
+            manifest['updated'] = time.time()
+            manifest['files'].update(files)
+            return manifest
+
+        manifest = update_json(manifest_file, update_manifest)
+
+        def update_index(index):
+            index.setdefault('containers', dict())
+            index['containers'][container] = {
+                'manifest': os.path.relpath(manifest_file, base),
+                'files': len(manifest['files']),
+                'bytes': sum(e['size'] for e in manifest['files'].values()),
+                'updated': manifest['updated']}
+            return index
+
+        update_json(os.path.join(base, '{}_index.json'.format(name)),
+                    update_index)
+        return manifest_file
+
+    def _list_outputs(self):
+        if (isdefined(self.inputs.base_directory) and
+                self.inputs.base_directory.lower().startswith('s3://')):
+            return super(DINGOSink, self)._list_outputs()
+        manifest = isdefined(self.inputs.manifest_name)
+        if (self.inputs.sink_method == 'copy' and
+                self.inputs.sink_n_procs <= 1 and not manifest):
+            return super(DINGOSink, self)._list_outputs()
+
+        pairs, out_files = self._sink_pairs()
+        checksum = self.inputs.checksum if manifest else None
+        sunk = sink_files(pairs, self.inputs.sink_method,
+                          self.inputs.sink_n_procs, checksum)
+        outputs = self._outputs().get()
+        outputs['out_file'] = out_files
+        if manifest:
+            outputs['manifest_file'] = self._write_manifest(pairs, sunk)
+        return outputs
@@ -0,0 +1,75 @@
+import os
+import pytest
+from DINGO.interfaces.io import DINGOSink, verify_index
+from DINGO.workflows.fsl import TBSSPreReg
+
+
+def write(path, data):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+@pytest.fixture
+def sunk(tmpdir):
+    """Two subjects' FAs in nipype working directories, sunk by a FileOut
+    with a manifest. Returns the working files, sunk files and the index"""
+    work = [write(str(tmpdir.join('work', '_psid_{:d}'.format(i), 'dtifit',
+                                  'dtifit__FA.nii.gz')),
+                  'FA {:d}'.format(i).encode('ascii'))
+            for i in range(2)]
+    out = []
+    for i, fa in enumerate(work):
+        sink = DINGOSink(base_directory=str(tmpdir.join('out')),
+                         container='sub{:d}'.format(i),
+                         manifest_name='cohort',
+                         sink_method='copy')
+        setattr(sink.inputs, 'dti.@FA', fa)
+        out.extend(sink.run().outputs.out_file)
+    return work, out, str(tmpdir.join('out', 'cohort_index.json'))
+
+
+def test_verify_index_by_path(sunk):
+    work, out, index_file = sunk
+    assert verify_index(index_file) == []
+    assert verify_index(index_file, files=out) == []
+    assert len(verify_index(index_file, files=work)) == 2
+
+
+def test_verify_index_by_content(sunk):
+    work, out, index_file = sunk
+    assert verify_index(index_file, files=work, by_content=True) == []
+    write(work[1], b'FA 1, changed after sinking')
+    problems = verify_index(index_file, files=work, by_content=True)
+    assert problems == ['{} not in {}'.format(work[1], index_file)]
+
+
+def test_verify_index_by_content_stamp(sunk, monkeypatch):
+    from DINGO.interfaces import io
+    work, out, index_file = sunk
+    hashed = []
+
+    def file_checksum(path, checksum='md5'):
+        hashed.append(path)
+        return io.hashlib.new(checksum, open(path, 'rb').read()).hexdigest()
+
+    monkeypatch.setattr(io, 'file_checksum', file_checksum)
+    # same size and mtime as sunk, not read
+    assert verify_index(index_file, files=work, by_content=True) == []
+    assert hashed == []
+    # touched, read once to compare the content
+    os.utime(work[0], (0, 0))
+    assert verify_index(index_file, files=work, by_content=True) == []
+    assert hashed == [work[0]]
+
+
+def test_verify_fa_list_from_dtifit(sunk):
+    work, out, index_file = sunk
+    verify_fa_list = getattr(TBSSPreReg.verify_fa_list, '__func__',
+                             TBSSPreReg.verify_fa_list)
+    assert verify_fa_list(work, index_file) == work
+    os.remove(out[1])
+    with pytest.raises(IOError):
+        verify_fa_list(work, index_file)
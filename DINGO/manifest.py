@@ -0,0 +1,332 @@
+import os
+import re
+import json
+import time
+import glob
+import fnmatch
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from DINGO.utils import json_load_byteified
+
+
+_magic_check = re.compile('[*?[]')
+
+
+def has_magic(s):
+    return _magic_check.search(s) is not None
+
+
+def _walk(args):
+    """Walk a directory tree, return {reldir: entry} for every directory"""
+    data_dir, reldir = args
+    entries = dict()
+    top = os.path.join(data_dir, reldir)
+    for dirpath, dirnames, filenames in os.walk(top):
+        rel = os.path.relpath(dirpath, data_dir)
+        entry = FileManifest.list_dir(dirpath, dirnames, filenames)
+        if entry is not None:
+            entries[rel] = entry
+    return entries
+
+
+class FileManifest(object):
+    """Index of the files under a data directory, so that templates can be
+    resolved without walking the (often network) filesystem for every subject.
+
+    The index maps every directory relative to data_dir to its mtime, its
+    files with [size, mtime] and its subdirectories. It is persisted as json,
+    by default data_dir/.dingo_manifest.json, and refreshed by re-listing only
+    the directories whose mtime changed since the last scan.
+
+    Parameters
+    ----------
+    data_dir    :   Directory, root of the index
+    path        :   File, json index (default data_dir/.dingo_manifest.json)
+
+    e.g.
+    manifest = FileManifest('/data/CHD_tractography')
+    manifest.scan(n_procs=8)
+    manifest.save()
+    manifest.glob('/data/CHD_tractography/CHD_052/01a/Regions/to_auto/*.nii.gz')
+    """
+    version = 1
+    default_name = '.dingo_manifest.json'
+
+    def __init__(self, data_dir, path=None):
+        self.data_dir = os.path.abspath(data_dir)
+        if path is None:
+            path = os.path.join(self.data_dir, self.default_name)
+        self.path = os.path.abspath(path)
+        self.created = None
+        self.dirs = dict()
+
+    @staticmethod
+    def list_dir(dirpath, dirnames=None, filenames=None):
+        """Return the index entry of a single directory, None if it is gone"""
+        try:
+            mtime = os.stat(dirpath).st_mtime
+            if dirnames is None or filenames is None:
+                dirnames = []
+                filenames = []
+                for name in os.listdir(dirpath):
+                    if os.path.isdir(os.path.join(dirpath, name)):
+                        dirnames.append(name)
+                    else:
+                        filenames.append(name)
+        except OSError:
+            return None
+        files = dict()
+        for name in filenames:
+            if name.startswith(FileManifest.default_name):
+                continue
+            try:
+                st = os.stat(os.path.join(dirpath, name))
+            except OSError:
+                # broken link, removed since listing
+                continue
+            files[name] = [st.st_size, st.st_mtime]
+        return {'mtime': mtime,
+                'files': files,
+                'subdirs': sorted(dirnames)}
+
+    def _pool_map(self, func, args, n_procs=None):
+        if n_procs is None:
+            n_procs = cpu_count()
+        if n_procs <= 1 or len(args) <= 1:
+            return map(func, args)
+        pool = ThreadPool(min(n_procs, len(args)))
+        try:
+            return pool.map(func, args)
+        finally:
+            pool.close()
+            pool.join()
+
+    def scan(self, n_procs=None):
+        """Index data_dir from scratch, walking top level dirs in parallel"""
+        top = self.list_dir(self.data_dir)
+        if top is None:
+            raise IOError('Manifest data_dir does not exist: {}'
+                          .format(self.data_dir))
+        self.dirs = {'.': top}
+        args = [(self.data_dir, d) for d in top['subdirs']]
+        for entries in self._pool_map(_walk, args, n_procs):
+            self.dirs.update(entries)
+        self.created = time.time()
+        return self
+
+    def refresh(self, n_procs=None):
+        """Update the index, re-listing only directories whose mtime changed.
+
+        Creating, removing or renaming an entry changes the mtime of its
+        parent directory, so unchanged directories keep their listing.
+        Editing a file in place does not, so the files of unchanged
+        directories are stat'ed again and their [size, mtime] updated.
+        """
+        def relist(reldir):
+            return reldir, self.list_dir(os.path.join(self.data_dir, reldir))
+
+        def restat(reldir):
+            dirpath = os.path.join(self.data_dir, reldir)
+            stamps = dict()
+            for name, stamp in self.dirs[reldir]['files'].items():
+                try:
+                    st = os.stat(os.path.join(dirpath, name))
+                except OSError:
+                    continue
+                if [st.st_size, st.st_mtime] != list(stamp):
+                    stamps[name] = [st.st_size, st.st_mtime]
+            return reldir, stamps
+
+        changed = []
+        unchanged = []
+        for reldir, entry in self.dirs.items():
+            try:
+                mtime = os.stat(os.path.join(self.data_dir, reldir)).st_mtime
+            except OSError:
+                mtime = None
+            if mtime != entry['mtime']:
+                changed.append(reldir)
+            elif entry['files']:
+                unchanged.append(reldir)
+        for reldir, stamps in self._pool_map(restat, unchanged, n_procs):
+            self.dirs[reldir]['files'].update(stamps)
+        new_dirs = []
+        for reldir, entry in self._pool_map(relist, changed, n_procs):
+            if entry is None:
+                self._drop(reldir)
+                continue
+            old = self.dirs.get(reldir, {'subdirs': []})
+            for gone in set(old['subdirs']) - set(entry['subdirs']):
+                self._drop(os.path.normpath(os.path.join(reldir, gone)))
+            for new in set(entry['subdirs']) - set(old['subdirs']):
+                new_dirs.append(os.path.normpath(os.path.join(reldir, new)))
+            self.dirs[reldir] = entry
+        args = [(self.data_dir, d) for d in new_dirs]
+        for entries in self._pool_map(_walk, args, n_procs):
+            self.dirs.update(entries)
+        return self
+
+    def _drop(self, reldir):
+        prefix = reldir + os.sep
+        for d in list(self.dirs.keys()):
+            if d == reldir or d.startswith(prefix):
+                del self.dirs[d]
+
+    def load(self, manifest=None):
+        """Read the index from self.path, or use an already parsed dict"""
+        if manifest is None:
+            with open(self.path, 'r') as f:
+                manifest = json_load_byteified(f)
+        if manifest.get('version') != self.version:
+            raise ValueError('Manifest {} version {} != {}'
+                             .format(self.path, manifest.get('version'),
+                                     self.version))
+        if os.path.abspath(manifest['data_dir']) != self.data_dir:
+            raise ValueError('Manifest {} indexes {}, not {}'
+                             .format(self.path, manifest['data_dir'],
+                                     self.data_dir))
+        self.created = manifest['created']
+        self.dirs = manifest['dirs']
+        return self
+
+    def save(self):
+        """Write the index atomically, readers never see a partial file"""
+        manifest = {'version': self.version,
+                    'data_dir': self.data_dir,
+                    'created': self.created,
+                    'dirs': self.dirs}
+        tmp = '{}.{:d}.tmp'.format(self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f)
+        os.rename(tmp, self.path)
+        return self.path
+
+    def relpath(self, path):
+        """Return path relative to data_dir, None if it is not under it"""
+        path = os.path.abspath(path)
+        if path == self.data_dir:
+            return '.'
+        if not path.startswith(self.data_dir + os.sep):
+            return None
+        return os.path.relpath(path, self.data_dir)
+
+    def exists(self, path):
+        rel = self.relpath(path)
+        if rel is None:
+            return os.path.exists(path)
+        if rel in self.dirs:
+            return True
+        reldir, name = os.path.split(rel)
+        entry = self.dirs.get(reldir or '.')
+        return entry is not None and name in entry['files']
+
+    def stat(self, path):
+        """Return indexed [size, mtime] of a file, None if not indexed"""
+        rel = self.relpath(path)
+        if rel is None:
+            return None
+        reldir, name = os.path.split(rel)
+        entry = self.dirs.get(reldir or '.')
+        if entry is None:
+            return None
+        return entry['files'].get(name)
+
+    def glob(self, pattern):
+        """Return the paths matching a shell pattern, like glob.glob, from the
+        index. Patterns outside data_dir fall back to the filesystem.
+        """
+        rel = self.relpath(pattern)
+        if rel is None:
+            return glob.glob(pattern)
+        if rel == '.':
+            return [self.data_dir]
+        parts = rel.split(os.sep)
+        return [os.path.join(self.data_dir, p)
+                for p in self._match('.', parts)]
+
+    def _match(self, reldir, parts):
+        entry = self.dirs.get(reldir)
+        if entry is None:
+            return []
+        part = parts[0]
+        names = list(entry['subdirs'])
+        if len(parts) == 1:
+            names.extend(entry['files'].keys())
+        if has_magic(part):
+            if not part.startswith('.'):
+                names = [n for n in names if not n.startswith('.')]
+            names = [n for n in names if fnmatch.fnmatchcase(n, part)]
+        elif part in names:
+            names = [part]
+        else:
+            names = []
+        if reldir == '.':
+            joined = names
+        else:
+            joined = [os.path.join(reldir, n) for n in names]
+        if len(parts) == 1:
+            return joined
+        matches = []
+        for d in joined:
+            matches.extend(self._match(d, parts[1:]))
+        return matches
+
+    def subject_files(self, sub_id, scan_id=None, uid=None):
+        """Return all indexed files under data_dir/sub_id[/scan_id], optionally
+        only those containing uid in their name"""
+        reldir = sub_id if scan_id is None else os.path.join(sub_id, scan_id)
+        prefix = reldir + os.sep
+        files = []
+        for d, entry in self.dirs.items():
+            if d != reldir and not d.startswith(prefix):
+                continue
+            for name in entry['files']:
+                if uid is None or uid in name:
+                    files.append(os.path.join(self.data_dir, d, name))
+        return sorted(files)
+
+
+_prepared = dict()
+
+
+def prepare_manifest(data_dir, manifest=True, n_procs=None):
+    """Create or refresh the manifest of data_dir once per process.
+
+    Parameters
+    ----------
+    data_dir    :   Directory to index
+    manifest    :   True (data_dir/.dingo_manifest.json) or File path
+    n_procs     :   Int, threads used to walk data_dir (default cpu_count)
+
+    Returns
+    -------
+    path        :   File, the saved manifest
+    """
+    if manifest is True:
+        path = None
+    else:
+        path = manifest
+    fm = FileManifest(data_dir, path)
+    key = (fm.data_dir, fm.path)
+    if key not in _prepared:
+        if os.path.isfile(fm.path):
+            fm.load().refresh(n_procs)
+        else:
+            fm.scan(n_procs)
+        _prepared[key] = fm.save()
+    return _prepared[key]
+
+
+_loaded = dict()
+
+
+def load_manifest(path):
+    """Return the FileManifest saved at path, cached while its mtime holds"""
+    path = os.path.abspath(path)
+    mtime = os.stat(path).st_mtime
+    if path not in _loaded or _loaded[path][0] != mtime:
+        with open(path, 'r') as f:
+            manifest = json_load_byteified(f)
+        fm = FileManifest(manifest['data_dir'], path).load(manifest)
+        _loaded[path] = (mtime, fm)
+    return _loaded[path][1]
@@ -0,0 +1,421 @@
+import os
+import copy
+from difflib import get_close_matches
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import nipype.pipeline.engine as pe
+import nipype.interfaces.io as nio
+from nipype.interfaces.base import isdefined, Bunch
+from DINGO.utils import (split_chpid,
+                         flatten,
+                         reverse_lookup)
+
+
+class PreflightError(Exception):
+    """All problems found by Preflight, raised before anything is run"""
+
+    def __init__(self, setup_bn, problems):
+        self.problems = problems
+        lines = ['Analysis setup: {}, preflight found {:d} problem(s)'
+                 .format(setup_bn, len(problems))]
+        sections = []
+        for section, _ in problems:
+            if section not in sections:
+                sections.append(section)
+        for section in sections:
+            lines.append('[{}]'.format(section))
+            lines.extend('    {}'.format(msg)
+                         for sec, msg in problems if sec == section)
+        super(PreflightError, self).__init__('\n'.join(lines))
+
+
+class Preflight(object):
+    """Validate a DINGO workflow before it is connected and run.
+
+    Subflows that fail to be created are recorded instead of raising, then
+    check() verifies connection source names and fields, and resolves the
+    input files of every included id through the FileIn grabbers and subject
+    configs, in parallel. Resolved files must exist and not be empty, NIfTI
+    headers must be readable, the number of volumes of a 4D image must match
+    its bvals and bvecs, and masks must match its dimensions.
+
+    Parameters
+    ----------
+    dingo       :   DINGO workflow being created from a setup
+    setup_bn    :   Str, setup name for the report
+    n_procs     :   Int, threads resolving subjects (default cpu_count)
+
+    e.g. in setup json, to skip
+    "preflight":    false
+    """
+
+    def __init__(self, dingo, setup_bn, n_procs=None):
+        self.dingo = dingo
+        self.setup_bn = setup_bn
+        if n_procs is None:
+            n_procs = cpu_count()
+        self.n_procs = n_procs
+        self.problems = []
+        self.failed = []
+
+    def add(self, section, msg):
+        self.problems.append((section, msg))
+
+    def create_subwf(self, step, name):
+        try:
+            self.dingo.create_subwf(step, name)
+        except Exception as err:
+            self.failed.append(name)
+            self.add('Steps', '{} ({}): {}: {}'
+                     .format(name, step, type(err).__name__, err))
+
+    def check(self):
+        """Run all checks, raise PreflightError if any problem was found"""
+        self.check_connections()
+        self.check_warped_regions()
+        if len(self.failed) == 0:
+            self.check_inputs()
+        if len(self.problems) > 0:
+            raise PreflightError(self.setup_bn, self.problems)
+        print('Preflight: {} passed'.format(self.setup_bn))
+
+    # Connections
+    def _source(self, srckey):
+        """Resolve a source name as DINGO._connect_subwfs does, return
+        (srcobj or None, problem or None)"""
+        dingo = self.dingo
+        name2step = dingo.name2step
+        if srckey in name2step:
+            return dingo.subflows.get(srckey), None
+        if name2step.values().count(srckey) > 1:
+            return None, ('"{}" used more than once, set the connection by '
+                          'name'.format(srckey))
+        if (srckey == dingo._inputsname or
+                srckey.lower() == 'setup' or
+                srckey.lower() == 'config'):
+            return dingo.get_node(dingo._inputsname), None
+        try:
+            return dingo.subflows.get(reverse_lookup(name2step, srckey)), None
+        except ValueError:
+            choices = list(name2step.keys()) + ['Config']
+            close = get_close_matches(srckey, choices, n=1)
+            if close:
+                hint = ', did you mean "{}"?'.format(close[0])
+            else:
+                hint = ', names are {}'.format(sorted(name2step.keys()))
+            return None, 'unknown source "{}"{}'.format(srckey, hint)
+
+    @staticmethod
+    def _endpoint(obj, attr):
+        """Return the node at the inputnode/outputnode end of obj"""
+        if isinstance(obj, pe.Node):
+            return obj
+        if isinstance(obj, pe.Workflow):
+            nodename = getattr(obj, attr, None)
+            if nodename is None:
+                nodename = attr
+            return obj.get_node(nodename)
+        return None
+
+    @staticmethod
+    def _fields(node, spec):
+        """Return the field names of a node inputs/outputs, None if they
+        cannot be known before running"""
+        if node is None:
+            return None
+        if spec == 'inputs' and isinstance(node.interface, nio.DataSink):
+            return None
+        try:
+            traits = getattr(node, spec)
+        except Exception:
+            return None
+        if traits is None:
+            return None
+        if isinstance(traits, Bunch):
+            # MapNode outputs
+            return set(traits.dictcopy())
+        return set(traits.trait_names())
+
+    def check_connections(self):
+        dingo = self.dingo
+        for destkey, connections in dingo.input_connections.items():
+            if destkey in self.failed:
+                continue
+            destobj = dingo.subflows[destkey]
+            spec = dict(getattr(destobj, 'connection_spec', {}))
+            spec.update(connections)
+            destfields = self._fields(
+                self._endpoint(destobj, 'inputnode'), 'inputs')
+            for destfield, values in spec.items():
+                if len(values) == 0:
+                    continue
+                conn = '{}.{}'.format(destkey, destfield)
+                if len(values) != 2:
+                    self.add('Connections', '{}: malformed {}, should be '
+                             '[SourceObj, SourceKey]'.format(conn, values))
+                    continue
+                srckey, srcfield = values
+                srcobj, msg = self._source(srckey)
+                if msg is not None:
+                    self.add('Connections', '{} <- {}.{}: {}'
+                             .format(conn, srckey, srcfield, msg))
+                    continue
+                if srcobj is None:  # failed to create, already reported
+                    continue
+                srcfields = self._fields(
+                    self._endpoint(srcobj, 'outputnode'), 'outputs')
+                if srcfields is not None and srcfield not in srcfields:
+                    self.add('Connections', '{} <- {}.{}: {} has no output '
+                             '"{}"'.format(conn, srckey, srcfield, srckey,
+                                           srcfield))
+                if destfields is not None and destfield not in destfields:
+                    self.add('Connections', '{} <- {}.{}: {} has no input '
+                             '"{}"'.format(conn, srckey, srcfield, destkey,
+                                           destfield))
+
+    def check_warped_regions(self):
+        """Regions named by a DSI_TRK step must be warped by the WarpRegions
+        step its region_index comes from"""
+        from DINGO.utils import tract_region_names
+        from DINGO.workflows.fsl import WarpRegions
+        from DINGO.workflows.dsistudio import DSI_TRK
+        dingo = self.dingo
+        for name, subflow in dingo.subflows.items():
+            if not isinstance(subflow, DSI_TRK):
+                continue
+            spec = dict(getattr(subflow, 'connection_spec', {}))
+            spec.update(dingo.input_connections.get(name, {}))
+            values = spec.get('region_index')
+            if values is None or len(values) != 2:
+                continue
+            srcobj, _ = self._source(values[0])
+            if not isinstance(srcobj, WarpRegions):
+                continue
+            srcname = srcobj.name
+            tracts = dingo.input_params.get(srcname, {}).get('tracts')
+            if tracts is None or isinstance(tracts, (str, unicode)):
+                # all regions warped, or already reported
+                continue
+            warped = set(n.lower() for n in tract_region_names(tracts))
+            missing = [n for n in tract_region_names(
+                           dingo.input_params.get(name, {}))
+                       if n.lower() not in warped]
+            if missing:
+                self.add('Regions', '{}: {} not warped by {}, set its '
+                         'tracts to "{}"'.format(name, ', '.join(missing),
+                                                 srcname, name))
+
+    # Inputs
+    def _id_sep(self):
+        for name, step in self.dingo.name2step.items():
+            if step in ('SplitIDs', 'DINGO.workflows.utils.SplitIDs'):
+                sep = self.dingo.subflows[name].inputs.sep
+                if isdefined(sep):
+                    return sep
+        return '_'
+
+    def _base_directory(self, name, params):
+        """Return the base_directory a grabber step will get: its input, or
+        the setup data_dir when unset or connected from it. None when it is
+        connected from another step, so cannot be known before running"""
+        if params.get('base_directory') is not None:
+            return params['base_directory']
+        dingo = self.dingo
+        spec = dict(getattr(dingo.subflows[name], 'connection_spec', {}))
+        spec.update(dingo.input_connections.get(name, {}))
+        setup = dingo.get_node(dingo._inputsname)
+        values = spec.get('base_directory')
+        if values is not None and len(values) == 2:
+            srcobj, _ = self._source(values[0])
+            if srcobj is not setup or values[1] != 'data_dir':
+                return None
+        if ('data_dir' in setup.inputs.trait_names() and
+                isdefined(setup.inputs.data_dir)):
+            return setup.inputs.data_dir
+        return None
+
+    def _grabbers(self, ids, id_sep):
+        """Return [(name, grabber interface, subject templates or None,
+        base_directory)] for the grabbers whose inputs only depend on the
+        subject ids"""
+        grabbers = []
+        for name, subflow in self.dingo.subflows.items():
+            if isinstance(subflow, pe.Workflow):
+                nodes = subflow._graph.nodes()
+            else:
+                nodes = [subflow]
+            for node in nodes:
+                if (not isinstance(node, pe.Node) or
+                        isinstance(node, pe.MapNode) or
+                        not isinstance(node.interface, nio.DataGrabber)):
+                    continue
+                grabber = node.interface
+                infields = grabber._infields or []
+                if any(f not in ('sub_id', 'scan_id', 'uid') and
+                       not isdefined(getattr(grabber.inputs, f))
+                       for f in infields):
+                    continue
+                params = self.dingo.input_params.get(name, {})
+                base_directory = self._base_directory(name, params)
+                if base_directory is None:
+                    continue
+                templates = None
+                if not isdefined(grabber.inputs.field_template):
+                    # FileInSConfig batch mode, configs already read
+                    templates = getattr(subflow, 'batch_templates', None)
+                if (templates is None and
+                        not isdefined(grabber.inputs.field_template) and
+                        hasattr(subflow, 'subject_templates')):
+                    # FileInSConfig, templates come from subject configs
+                    try:
+                        templates = subflow.subject_templates(
+                            base_directory, ids, id_sep,
+                            params['outfields'], repl=params.get('repl'),
+                            n_procs=self.n_procs)
+                    except Exception as err:
+                        self.add('Inputs', '{}: {}'.format(name, err))
+                        continue
+                grabbers.append((name, grabber, templates, base_directory))
+        return grabbers
+
+    def _resolve(self, psid, id_sep, grabbers):
+        """Return ({field: [files]}, [problems]) for one id"""
+        sub_id, scan_id, uid = split_chpid(psid, id_sep)
+        ids = dict(sub_id=sub_id, scan_id=scan_id, uid=uid)
+        resolved = dict()
+        problems = []
+        for name, grabber, templates, base_directory in grabbers:
+            grabber = copy.deepcopy(grabber)
+            raise_on_empty = grabber.inputs.raise_on_empty
+            grabber.inputs.raise_on_empty = False
+            for f in grabber._infields or []:
+                if f in ids:
+                    setattr(grabber.inputs, f, ids[f])
+            if (not isdefined(grabber.inputs.base_directory) and
+                    base_directory is not None):
+                grabber.inputs.base_directory = base_directory
+            if templates is not None:
+                key = '_'.join((sub_id, scan_id, uid))
+                grabber.inputs.field_template = templates[key]
+            try:
+                outputs = grabber._list_outputs()
+            except Exception as err:
+                problems.append('{}: {}: {}: {}'.format(
+                    psid, name, type(err).__name__, err))
+                continue
+            for field, value in outputs.items():
+                if value is None:
+                    if raise_on_empty:
+                        problems.append('{}: {}.{}: no files found'
+                                        .format(psid, name, field))
+                    continue
+                if not isinstance(value, list):
+                    value = [value]
+                resolved['.'.join((name, field))] = flatten(value)
+        problems.extend(self.check_files(psid, resolved))
+        return resolved, problems
+
+    @staticmethod
+    def _read_table(path):
+        with open(path, 'r') as f:
+            return [line.split() for line in f if line.strip()]
+
+    @staticmethod
+    def check_files(psid, resolved):
+        """Check existence, size and header consistency of resolved files"""
+        import nibabel as nib
+        problems = []
+        shapes = dict()
+        bvals = []
+        bvecs = []
+        for field, files in resolved.items():
+            for f in files:
+                try:
+                    size = os.stat(f).st_size
+                except OSError:
+                    problems.append('{}: {}: missing {}'.format(psid, field, f))
+                    continue
+                if os.path.isdir(f):
+                    continue
+                if size == 0:
+                    problems.append('{}: {}: empty {}'.format(psid, field, f))
+                    continue
+                if f.endswith(('.nii', '.nii.gz', '.hdr', '.img')):
+                    try:
+                        shapes[(field, f)] = nib.load(f).shape
+                    except Exception as err:
+                        problems.append('{}: {}: unreadable NIfTI {}: {}'
+                                        .format(psid, field, f, err))
+                elif f.endswith('bval') or 'bval' in field.lower():
+                    bvals.append((field, f))
+                elif f.endswith('bvec') or 'bvec' in field.lower():
+                    bvecs.append((field, f))
+
+        dwis = [(k, s) for k, s in shapes.items() if len(s) == 4 and s[3] > 1]
+        if len(dwis) != 1:
+            # nothing to compare, or ambiguous which volumes the bvals are for
+            return problems
+        (dwifield, dwi), dwishape = dwis[0]
+        nvols = dwishape[3]
+        for field, f in bvals:
+            try:
+                nbvals = len(flatten(Preflight._read_table(f)))
+            except IOError as err:
+                problems.append('{}: {}: {}'.format(psid, field, err))
+                continue
+            if nbvals != nvols:
+                problems.append('{}: {} has {:d} bvals, {} {} has {:d} volumes'
+                                .format(psid, f, nbvals, dwifield, dwi, nvols))
+        for field, f in bvecs:
+            try:
+                rows = Preflight._read_table(f)
+            except IOError as err:
+                problems.append('{}: {}: {}'.format(psid, field, err))
+                continue
+            if not ((len(rows) == 3 and
+                     all(len(r) == nvols for r in rows)) or
+                    (len(rows) == nvols and all(len(r) == 3 for r in rows))):
+                problems.append('{}: {} is not 3x{:d} or {:d}x3 for {} {}'
+                                .format(psid, f, nvols, nvols, dwifield, dwi))
+        for (field, f), shape in shapes.items():
+            if 'mask' in field.lower() and tuple(shape[:3]) != dwishape[:3]:
+                problems.append('{}: {} {} dimensions {} != {} {} {}'
+                                .format(psid, field, f, shape[:3],
+                                        dwifield, dwi, dwishape[:3]))
+        return problems
+
+    def check_inputs(self):
+        setup = self.dingo.get_node(self.dingo._inputsname)
+        if ('included_ids' not in setup.inputs.trait_names() or
+                not isdefined(setup.inputs.included_ids)):
+            return
+        ids = setup.inputs.included_ids
+        if isinstance(ids, (str, unicode)):
+            ids = [ids]
+        id_sep = self._id_sep()
+        grabbers = self._grabbers(ids, id_sep)
+        if len(grabbers) == 0:
+            return
+
+        def resolve(psid):
+            try:
+                return self._resolve(psid, id_sep, grabbers)
+            except Exception as err:
+                return {}, ['{}: {}: {}'.format(psid, type(err).__name__, err)]
+
+        if self.n_procs > 1 and len(ids) > 1:
+            pool = ThreadPool(min(self.n_procs, len(ids)))
+            try:
+                results = pool.map(resolve, ids)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(resolve, ids)
+        nfiles = 0
+        for resolved, problems in results:
+            nfiles += sum(len(files) for files in resolved.values())
+            for msg in problems:
+                self.add('Inputs', msg)
+        print('Preflight: resolved {:d} files for {:d} ids'
+              .format(nfiles, len(ids)))
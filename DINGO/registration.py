@@ -0,0 +1,287 @@
+import os
+import sys
+import json
+import time
+import numpy as np
+
+
+# Schedule of FA_2_FMRIB58_1mm.cnf, FSLNonLinReg's default FNIRT config
+FA_2_FMRIB58_SCHEDULE = dict(subsampling_scheme=[8, 4, 2, 2],
+                             max_nonlin_iter=[5, 5, 5, 5],
+                             in_fwhm=[12, 6, 2, 2],
+                             ref_fwhm=[12, 6, 2, 2],
+                             regularization_lambda=[300, 75, 30, 30])
+
+# FNIRT schedules by the reference's smallest dimension in voxels, first
+# match wins: (min voxels, coarse affine factor, FNIRT inputs). Four levels,
+# as FA_2_FMRIB58_1mm.cnf, so per-level config options still line up. Each
+# is cheaper than the config, see schedule_cost: fewer iterations at full
+# resolution, and no level at 8 for references too small for it.
+FNIRT_PRESETS = [
+    (160, 4, dict(subsampling_scheme=[8, 4, 4, 2],
+                  max_nonlin_iter=[5, 5, 5, 5],
+                  in_fwhm=[12, 6, 4, 2],
+                  ref_fwhm=[12, 6, 4, 2],
+                  regularization_lambda=[300, 75, 30, 30])),
+    (96, 2, dict(subsampling_scheme=[4, 4, 2, 2],
+                 max_nonlin_iter=[5, 5, 5, 3],
+                 in_fwhm=[8, 6, 2, 2],
+                 ref_fwhm=[8, 6, 2, 2],
+                 regularization_lambda=[300, 75, 30, 30])),
+    (64, 2, dict(subsampling_scheme=[4, 4, 2, 2],
+                 max_nonlin_iter=[5, 5, 5, 2],
+                 in_fwhm=[6, 4, 2, 2],
+                 ref_fwhm=[6, 4, 2, 2],
+                 regularization_lambda=[300, 75, 30, 30])),
+    (0, 1, dict(subsampling_scheme=[4, 2, 2, 2],
+                max_nonlin_iter=[5, 5, 2, 2],
+                in_fwhm=[4, 3, 2, 2],
+                ref_fwhm=[4, 3, 2, 2],
+                regularization_lambda=[300, 75, 30, 30]))
+]
+
+
+def schedule_cost(opts):
+    """Relative FNIRT cost of a schedule, iterations times voxels at each
+    level, 1 being one iteration at full resolution"""
+    return sum(float(n) / s ** 3 for n, s in
+               zip(opts['max_nonlin_iter'], opts['subsampling_scheme']))
+
+
+def default_fnirtopts():
+    """Return FSLNonLinReg's default FNIRT inputs, FA=True"""
+    from warnings import warn
+    from nipype.interfaces import fsl
+    if fsl.no_fsl():
+        warn('NO FSL found')
+        return {}
+    return {'config_file': os.path.join(
+        os.environ['FSLDIR'], 'etc/flirtsch/FA_2_FMRIB58_1mm.cnf')}
+
+
+def fnirt_preset(ref_file):
+    """Return coarse affine factor and FNIRT inputs for ref_file's size.
+
+    Returns
+    -------
+    factor  :   Int, downsampling factor for the affine
+    opts    :   Dict, FNIRT inputs, see FNIRT_PRESETS
+    """
+    import nibabel as nib
+    min_dim = min(nib.load(ref_file).shape[:3])
+    for min_voxels, factor, opts in FNIRT_PRESETS:
+        if min_dim >= min_voxels:
+            return factor, dict(opts)
+    return FNIRT_PRESETS[-1][1], dict(FNIRT_PRESETS[-1][2])
+
+
+def downsample(in_file, factor, out_file):
+    """Block-average a 3D image by an integer factor.
+
+    Trailing voxels that do not fill a block are dropped. The affine is
+    scaled, with the origin at the first block's centre, so the coarse
+    image is in the same world space.
+
+    Returns
+    -------
+    out_file    :   File, absolute path
+    """
+    import nibabel as nib
+    img = nib.load(in_file)
+    data = np.asanyarray(img.dataobj)
+    data = np.nan_to_num(data.reshape(data.shape[:3]).astype(np.float32))
+    coarse = [n // factor for n in data.shape]
+    if min(coarse) < 1:
+        raise ValueError('{} is smaller than factor {:d}'
+                         .format(in_file, factor))
+    data = data[:coarse[0] * factor, :coarse[1] * factor, :coarse[2] * factor]
+    data = data.reshape(coarse[0], factor, coarse[1], factor,
+                        coarse[2], factor).mean(axis=(1, 3, 5))
+    scale = np.diag([factor, factor, factor, 1.]).astype(np.float64)
+    scale[:3, 3] = (factor - 1) / 2.
+    affine = np.dot(img.affine, scale)
+    header = img.header.copy()
+    header.set_data_dtype(np.float32)
+    header.set_slope_inter(None, None)
+    out_img = nib.Nifti1Image(data.astype(np.float32), affine, header)
+    out_img.set_qform(affine, int(img.header['qform_code']) or 1)
+    out_img.set_sform(affine, int(img.header['sform_code']) or 1)
+    out_file = os.path.abspath(out_file)
+    out_img.to_filename(out_file)
+    return out_file
+
+
+def pyramid_level(in_file, factor, cache_dir=None):
+    """Return in_file downsampled by factor, from the pyramid cache.
+
+    Levels are kept in cache_dir (default $DINGO_CACHE_DIR/pyramid or
+    tmpdir/dingo_pyramid) by content hash and factor, so an image used by
+    many registrations, e.g. a template, is downsampled once.
+    A factor of 1 returns in_file.
+    """
+    from DINGO.cache import default_cache_dir, content_hash
+    from DINGO.interfaces.io import makedirs
+    factor = int(factor)
+    if factor <= 1:
+        return os.path.abspath(in_file)
+    if cache_dir is None:
+        cache_dir = default_cache_dir('pyramid')
+    makedirs(cache_dir)
+    key = '_'.join((content_hash(in_file,
+                                 os.path.join(cache_dir, 'hashes.json')),
+                    'x{:d}'.format(factor)))
+    cached = os.path.join(cache_dir, ''.join((key, '.nii.gz')))
+    if not os.path.isfile(cached):
+        tmp = os.path.join(cache_dir, '{}.{:d}.nii.gz'
+                           .format(key, os.getpid()))
+        downsample(in_file, factor, tmp)
+        os.rename(tmp, cached)
+    return cached
+
+
+def fsl_coarse_shift(in_file, factor):
+    """Offset of downsample's coarse grid in FSL scaled-voxel coordinates.
+
+    FLIRT matrices are in scaled-voxel mm, x flipped when the qform has a
+    positive determinant. A point at coarse coordinate c is at c + shift on
+    the full resolution image.
+    """
+    import nibabel as nib
+    img = nib.load(in_file)
+    shape = img.shape[:3]
+    zooms = img.header.get_zooms()[:3]
+    shift = np.array([(factor - 1) / 2. * z for z in zooms])
+    if np.linalg.det(img.header.get_best_affine()[:3, :3]) > 0:
+        coarse = shape[0] // factor
+        shift[0] = (shape[0] - coarse * factor + (factor - 1) / 2.) * zooms[0]
+    return shift
+
+
+def coarse_to_fine_matrix(coarse_mat, in_file, ref_file, factor,
+                          out_file=None):
+    """Convert a FLIRT matrix between downsampled images to one between the
+    full resolution images, M = T(ref shift) . M coarse . T(-in shift)
+
+    Returns
+    -------
+    out_file    :   File, absolute path, default <coarse_mat>_fine.mat
+    """
+    mat = np.loadtxt(coarse_mat)
+    if int(factor) > 1:
+        t_in = np.eye(4)
+        t_in[:3, 3] = -fsl_coarse_shift(in_file, int(factor))
+        t_ref = np.eye(4)
+        t_ref[:3, 3] = fsl_coarse_shift(ref_file, int(factor))
+        mat = np.dot(t_ref, np.dot(mat, t_in))
+    if out_file is None:
+        base = os.path.basename(coarse_mat)
+        if base.endswith('.mat'):
+            base = base[:-len('.mat')]
+        out_file = ''.join((base, '_fine.mat'))
+    out_file = os.path.abspath(out_file)
+    np.savetxt(out_file, mat, fmt='%.10f')
+    return out_file
+
+
+def similarity(warped_file, ref_file):
+    """Correlation of warped_file and ref_file within ref_file != 0"""
+    import nibabel as nib
+    ref = np.asanyarray(nib.load(ref_file).dataobj).astype(np.float64)
+    warped = np.asanyarray(nib.load(warped_file).dataobj).astype(np.float64)
+    inside = ref.reshape(ref.shape[:3]) != 0
+    if inside.sum() == 0:
+        return 0.0
+    a = ref.reshape(ref.shape[:3])[inside]
+    b = warped.reshape(warped.shape[:3])[inside]
+    a -= a.mean()
+    b -= b.mean()
+    denom = np.sqrt(np.dot(a, a) * np.dot(b, b))
+    if denom == 0:
+        return 0.0
+    return float(np.dot(a, b) / denom)
+
+
+def benchmark(in_file, ref_file, work_dir=None, flirtopts=None,
+              fnirtopts=None):
+    """Register in_file to ref_file with FSLNonLinReg's default and
+    multires schedules, and compare runtime and similarity.
+
+    Each mode runs FLIRT and FNIRT directly in its own directory of
+    work_dir (default cwd). Pyramid levels are not cached, so multires
+    time includes downsampling. fnirtopts default to FSLNonLinReg's, see
+    default_fnirtopts, multires adds the preset for ref_file to them.
+
+    Returns
+    -------
+    results :   List(Dict), per mode 'mode', 'flirt_s', 'fnirt_s',
+        'total_s', 'similarity' (correlation of FNIRT warped and reference)
+        and 'cost' (schedule_cost of the FNIRT schedule, that of
+        FA_2_FMRIB58_1mm.cnf where not given)
+    """
+    from nipype.interfaces import fsl
+    from DINGO.interfaces.io import makedirs
+    if work_dir is None:
+        work_dir = os.getcwd()
+    if flirtopts is None:
+        flirtopts = {'dof': 12}
+    if fnirtopts is None:
+        fnirtopts = default_fnirtopts()
+    in_file = os.path.abspath(in_file)
+    ref_file = os.path.abspath(ref_file)
+    factor, preset = fnirt_preset(ref_file)
+    results = []
+    cwd = os.getcwd()
+    for mode in ('default', 'multires'):
+        mode_dir = os.path.abspath(os.path.join(work_dir, mode))
+        makedirs(mode_dir)
+        os.chdir(mode_dir)
+        try:
+            start = time.time()
+            if mode == 'multires' and factor > 1:
+                flirt_in = downsample(in_file, factor, 'in_coarse.nii.gz')
+                flirt_ref = downsample(ref_file, factor, 'ref_coarse.nii.gz')
+            else:
+                flirt_in, flirt_ref = in_file, ref_file
+            flirt = fsl.FLIRT(in_file=flirt_in, reference=flirt_ref,
+                              out_matrix_file='affine.mat', **flirtopts)
+            mat = flirt.run().outputs.out_matrix_file
+            if mode == 'multires':
+                mat = coarse_to_fine_matrix(mat, in_file, ref_file, factor)
+            flirt_s = time.time() - start
+            opts = dict(fnirtopts)
+            if mode == 'multires':
+                for k, v in preset.items():
+                    opts.setdefault(k, v)
+            schedule = dict(FA_2_FMRIB58_SCHEDULE)
+            schedule.update((k, v) for k, v in opts.items()
+                            if k in schedule)
+            start = time.time()
+            fnirt = fsl.FNIRT(in_file=in_file, ref_file=ref_file,
+                              affine_file=mat, warped_file='warped.nii.gz',
+                              fieldcoeff_file=True, **opts)
+            warped = fnirt.run().outputs.warped_file
+            fnirt_s = time.time() - start
+        finally:
+            os.chdir(cwd)
+        results.append({'mode': mode,
+                        'flirt_s': flirt_s,
+                        'fnirt_s': fnirt_s,
+                        'total_s': flirt_s + fnirt_s,
+                        'similarity': similarity(warped, ref_file),
+                        'cost': schedule_cost(schedule)})
+    return results
+
+
+if __name__ == '__main__':
+    # python registration.py in_file ref_file [work_dir]
+    if len(sys.argv) < 3:
+        print('Usage: python registration.py in_file ref_file [work_dir]')
+        sys.exit(1)
+    work_dir = sys.argv[3] if len(sys.argv) > 3 else None
+    results = benchmark(sys.argv[1], sys.argv[2], work_dir=work_dir)
+    print('{:<10}{:>10}{:>10}{:>10}{:>12}{:>8}'.format(
+        'mode', 'flirt_s', 'fnirt_s', 'total_s', 'similarity', 'cost'))
+    for r in results:
+        print('{mode:<10}{flirt_s:>10.1f}{fnirt_s:>10.1f}{total_s:>10.1f}'
+              '{similarity:>12.4f}{cost:>8.3f}'.format(**r))
+    print(json.dumps(results))
@@ -0,0 +1,492 @@
+import os
+import gzip
+import numpy as np
+
+
+# TrackVis header, as written by DSI Studio, 1000 bytes
+trk_header_dtype = np.dtype([
+    ('id_string', 'S6'),
+    ('dim', '<i2', 3),
+    ('voxel_size', '<f4', 3),
+    ('origin', '<f4', 3),
+    ('n_scalars', '<i2'),
+    ('scalar_name', 'S20', 10),
+    ('n_properties', '<i2'),
+    ('property_name', 'S20', 10),
+    ('vox_to_ras', '<f4', (4, 4)),
+    ('reserved', 'S444'),
+    ('voxel_order', 'S4'),
+    ('pad2', 'S4'),
+    ('image_orientation_patient', '<f4', 6),
+    ('pad1', 'S2'),
+    ('invert_x', 'u1'),
+    ('invert_y', 'u1'),
+    ('invert_z', 'u1'),
+    ('swap_xy', 'u1'),
+    ('swap_yz', 'u1'),
+    ('swap_zx', 'u1'),
+    ('n_count', '<i4'),
+    ('version', '<i4'),
+    ('hdr_size', '<i4')])
+
+
+def default_header(dim=(0, 0, 0), voxel_size=(1, 1, 1)):
+    """Return a TrackVis header for a volume of dim and voxel_size"""
+    header = np.zeros((), dtype=trk_header_dtype)
+    header['id_string'] = b'TRACK'
+    header['dim'] = dim
+    header['voxel_size'] = voxel_size
+    header['voxel_order'] = b'LPS'
+    header['version'] = 2
+    header['hdr_size'] = trk_header_dtype.itemsize
+    return header
+
+
+def _open(fname, mode):
+    if fname.endswith('.gz'):
+        return gzip.open(fname, mode)
+    return open(fname, mode)
+
+
+class Streamlines(object):
+    """Streamlines in one flat float32 points array, indexed by offsets.
+
+    Streamline i is points[offsets[i]:offsets[i+1]]. Per point scalars and
+    per streamline properties of trk files are kept alongside, with the trk
+    header so that a file can be written back unchanged.
+
+    Parameters
+    ----------
+    points      :   Array (N, 3) float32
+    offsets     :   Array (n + 1) int64, offsets[0] = 0, offsets[-1] = N
+    scalars     :   Array (N, n_scalars) float32 or None
+    properties  :   Array (n, n_properties) float32 or None
+    header      :   trk_header_dtype Array or None (default_header())
+
+    e.g.
+    s = read_trk('Genu_my.trk.gz')
+    len(s), s.lengths.max()
+    s[0]    # first streamline points
+    write_trk('Genu_sub.trk.gz', s.sample(1000))
+    """
+
+    def __init__(self, points=None, offsets=None, scalars=None,
+                 properties=None, header=None):
+        if points is None:
+            points = np.zeros((0, 3), dtype=np.float32)
+        if offsets is None:
+            offsets = np.zeros(1, dtype=np.int64)
+        self.points = np.asarray(points, dtype=np.float32).reshape(-1, 3)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        if self.offsets[0] != 0 or self.offsets[-1] != len(self.points):
+            raise ValueError('Offsets do not span the {:d} points'
+                             .format(len(self.points)))
+        self.scalars = scalars
+        self.properties = properties
+        if header is None:
+            header = default_header()
+        self.header = header
+
+    @classmethod
+    def from_list(cls, streamlines, **kwargs):
+        """Create from a sequence of (n_i, 3) arrays"""
+        lengths = [len(sl) for sl in streamlines]
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        if len(streamlines):
+            points = np.concatenate(
+                [np.asarray(sl, dtype=np.float32).reshape(-1, 3)
+                 for sl in streamlines])
+        else:
+            points = None
+        return cls(points, offsets, **kwargs)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.points[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def lengths(self):
+        """Number of points of each streamline"""
+        return np.diff(self.offsets)
+
+    def streamline_index(self):
+        """Return index of the streamline of every point"""
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+    def select(self, index):
+        """Return Streamlines of the selected streamlines (indices or mask)"""
+        index = np.arange(len(self))[index]
+        lengths = self.lengths[index]
+        offsets = np.zeros(len(index) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        point_index = (np.arange(offsets[-1]) +
+                       np.repeat(self.offsets[index] - offsets[:-1], lengths))
+        scalars = properties = None
+        if self.scalars is not None:
+            scalars = self.scalars[point_index]
+        if self.properties is not None:
+            properties = self.properties[index]
+        return Streamlines(self.points[point_index], offsets, scalars,
+                           properties, self.header.copy())
+
+    def sample(self, n, seed=None):
+        """Return n streamlines picked at random, without replacement"""
+        if n >= len(self):
+            return self.select(slice(None))
+        rng = np.random.RandomState(seed)
+        return self.select(np.sort(rng.choice(len(self), n, replace=False)))
+
+    @classmethod
+    def concatenate(cls, streamlines_list):
+        """Join several Streamlines, keeping the header of the first"""
+        if not streamlines_list:
+            return cls()
+        offsets = [np.zeros(1, dtype=np.int64)]
+        n_points = 0
+        for s in streamlines_list:
+            offsets.append(s.offsets[1:] + n_points)
+            n_points += len(s.points)
+
+        def join(attr):
+            arrays = [getattr(s, attr) for s in streamlines_list]
+            if any(a is None for a in arrays):
+                return None
+            return np.concatenate(arrays)
+
+        return cls(np.concatenate([s.points for s in streamlines_list]),
+                   np.concatenate(offsets),
+                   join('scalars'),
+                   join('properties'),
+                   streamlines_list[0].header.copy())
+
+
+def read_trk_header(buf):
+    """Return the header of a trk file in buf and the dtype of its byte
+    order"""
+    dtype = trk_header_dtype
+    header = np.frombuffer(buf, dtype=dtype, count=1)[0]
+    if header['hdr_size'] != dtype.itemsize:
+        dtype = dtype.newbyteorder()
+        header = np.frombuffer(buf, dtype=dtype, count=1)[0]
+        if header['hdr_size'] != dtype.itemsize:
+            raise ValueError('Not a trk file, header size {}'
+                             .format(header['hdr_size']))
+    if not header['id_string'].startswith(b'TRACK'):
+        raise ValueError('Not a trk file, id {!r}'
+                         .format(header['id_string']))
+    return np.array(header, dtype=trk_header_dtype), dtype
+
+
+def read_trk(fname):
+    """Read a DSI Studio/TrackVis .trk or .trk.gz file
+
+    Parameters
+    ----------
+    fname   :   Str, path of trk file
+
+    Returns
+    -------
+    Streamlines, points in voxmm as stored in the file
+    """
+    with _open(fname, 'rb') as f:
+        buf = f.read()
+    header, hdr_dtype = read_trk_header(buf)
+    order = hdr_dtype.fields['n_count'][0].byteorder
+    order = '<' if order in ('<', '=', '|') else '>'
+    n_scalars = int(header['n_scalars'])
+    n_properties = int(header['n_properties'])
+    width = 3 + n_scalars
+
+    body = buf[hdr_dtype.itemsize:]
+    n_words = len(body) // 4
+    ints = np.frombuffer(body, dtype=order + 'i4', count=n_words)
+    floats = np.frombuffer(body, dtype=order + 'f4', count=n_words)
+
+    # the point count of each streamline gives the position of the next
+    starts = []
+    lengths = []
+    pos = 0
+    while pos < n_words:
+        n = int(ints[pos])
+        starts.append(pos + 1)
+        lengths.append(n)
+        pos += 1 + n * width + n_properties
+    if pos != n_words:
+        raise ValueError('Truncated trk file: {}'.format(fname))
+    starts = np.array(starts, dtype=np.int64)
+    lengths = np.array(lengths, dtype=np.int64)
+    if header['n_count'] and header['n_count'] != len(lengths):
+        raise ValueError('Trk file {} has {:d} streamlines, header says {:d}'
+                         .format(fname, len(lengths), header['n_count']))
+
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    words = lengths * width
+    word_offsets = offsets * width
+    index = (np.arange(word_offsets[-1]) +
+             np.repeat(starts - word_offsets[:-1], words))
+    data = floats[index].astype(np.float32).reshape(-1, width)
+    scalars = properties = None
+    if n_scalars:
+        scalars = data[:, 3:].copy()
+    if n_properties:
+        prop_index = (starts + words)[:, None] + np.arange(n_properties)
+        properties = floats[prop_index].astype(np.float32)
+    return Streamlines(np.ascontiguousarray(data[:, :3]), offsets,
+                       scalars, properties, header)
+
+
+def write_trk(fname, streamlines, header=None, compresslevel=6):
+    """Write Streamlines to a .trk or .trk.gz file
+
+    Parameters
+    ----------
+    fname           :   Str, path of trk file, gzipped if it ends .gz
+    streamlines     :   Streamlines, points in voxmm
+    header          :   trk_header_dtype Array (default streamlines.header)
+    compresslevel   :   Int, gzip level
+    """
+    if header is None:
+        header = streamlines.header
+    header = np.array(header, dtype=trk_header_dtype)
+    n_scalars = 0
+    n_properties = 0
+    if streamlines.scalars is not None:
+        n_scalars = streamlines.scalars.shape[1]
+    if streamlines.properties is not None:
+        n_properties = streamlines.properties.shape[1]
+    header['n_scalars'] = n_scalars
+    header['n_properties'] = n_properties
+    header['n_count'] = len(streamlines)
+    header['hdr_size'] = trk_header_dtype.itemsize
+    width = 3 + n_scalars
+
+    lengths = streamlines.lengths
+    words = 1 + lengths * width + n_properties
+    starts = np.zeros(len(lengths), dtype=np.int64)
+    if len(lengths):
+        np.cumsum(words[:-1], out=starts[1:])
+    body = np.zeros(int(words.sum()), dtype='<f4')
+    body.view('<i4')[starts] = lengths
+    data = streamlines.points
+    if n_scalars:
+        data = np.hstack((data, streamlines.scalars))
+    word_offsets = streamlines.offsets * width
+    index = (np.arange(word_offsets[-1]) +
+             np.repeat(starts + 1 - word_offsets[:-1], lengths * width))
+    body[index] = data.ravel()
+    if n_properties:
+        prop_index = ((starts + 1 + lengths * width)[:, None] +
+                      np.arange(n_properties))
+        body[prop_index] = streamlines.properties
+
+    if fname.endswith('.gz'):
+        f = gzip.open(fname, 'wb', compresslevel)
+    else:
+        f = open(fname, 'wb')
+    with f:
+        f.write(header.tobytes())
+        f.write(body.tobytes())
+    return os.path.abspath(fname)
+
+
+def read_txt(fname, voxel_size=None, header=None):
+    """Read a DSI Studio .txt tract file, one streamline of x y z values
+    per line
+
+    Parameters
+    ----------
+    fname       :   Str, path of txt file
+    voxel_size  :   Sequence(Float, Float, Float), scale the voxel
+        coordinates DSI Studio writes to voxmm, like trk (default no scaling)
+    header      :   trk_header_dtype Array, kept for writing trk
+
+    Returns
+    -------
+    Streamlines
+    """
+    streamlines = []
+    with _open(fname, 'rb') as f:
+        for line in f:
+            values = np.array(line.split(), dtype=np.float32)
+            if len(values):
+                streamlines.append(values.reshape(-1, 3))
+    s = Streamlines.from_list(streamlines, header=header)
+    if voxel_size is not None:
+        s.points *= np.asarray(voxel_size, dtype=np.float32)
+    return s
+
+
+def write_txt(fname, streamlines, voxel_size=None, fmt='%.6g'):
+    """Write Streamlines to a DSI Studio .txt tract file
+
+    Parameters
+    ----------
+    fname       :   Str, path of txt file
+    streamlines :   Streamlines
+    voxel_size  :   Sequence(Float, Float, Float), divide voxmm points by
+        it to write voxel coordinates (default no scaling)
+    fmt         :   Str, format of each value
+    """
+    points = streamlines.points
+    if voxel_size is not None:
+        points = points / np.asarray(voxel_size, dtype=np.float32)
+    with _open(fname, 'wb') as f:
+        for i in range(len(streamlines)):
+            sl = points[streamlines.offsets[i]:streamlines.offsets[i + 1]]
+            line = ' '.join(fmt % v for v in sl.ravel())
+            f.write(line.encode('ascii') + b'\n')
+    return os.path.abspath(fname)
+
+
+def load(fname, **kwargs):
+    """Read a trk, trk.gz or txt tract file by extension"""
+    if fname.endswith(('.trk', '.trk.gz')):
+        return read_trk(fname)
+    if fname.endswith(('.txt', '.txt.gz')):
+        return read_txt(fname, **kwargs)
+    raise ValueError('Unknown tract file type: {}'.format(fname))
+
+
+def save(fname, streamlines, **kwargs):
+    """Write a trk, trk.gz or txt tract file by extension"""
+    if fname.endswith(('.trk', '.trk.gz')):
+        return write_trk(fname, streamlines, **kwargs)
+    if fname.endswith(('.txt', '.txt.gz')):
+        return write_txt(fname, streamlines, **kwargs)
+    raise ValueError('Unknown tract file type: {}'.format(fname))
+
+
+# MAT v4 precision digit of the type field, as written in DSI Studio fibs
+_mat4_dtypes = {0: 'f8', 1: 'f4', 2: 'i4', 3: 'i2', 4: 'u2', 5: 'u1'}
+
+
+def fib_geometry(fname):
+    """Return (dim, voxel_size) of a DSI Studio .fib or .fib.gz file.
+
+    Fib files are MAT v4, records are read until 'dimension' and
+    'voxel_size' are found, which DSI Studio writes first, so only the
+    start of the file is decompressed.
+    """
+    found = dict()
+    with _open(fname, 'rb') as f:
+        while len(found) < 2:
+            head = f.read(20)
+            if len(head) < 20:
+                raise ValueError('No dimension/voxel_size in fib {}'
+                                 .format(fname))
+            mopt, mrows, ncols, imagf, namlen = np.frombuffer(head, '<i4')
+            if mopt > 5000 or mopt < 0:
+                raise ValueError('{} is not a little endian MAT v4 file'
+                                 .format(fname))
+            name = f.read(namlen).rstrip(b'\0').decode('ascii')
+            dtype = np.dtype('<' + _mat4_dtypes[(mopt // 10) % 10])
+            nbytes = int(mrows) * int(ncols) * dtype.itemsize
+            if imagf:
+                nbytes *= 2
+            data = f.read(nbytes)
+            if name in ('dimension', 'voxel_size'):
+                found[name] = np.frombuffer(data, dtype)[:3]
+    dim = tuple(int(d) for d in found['dimension'])
+    return dim, tuple(float(v) for v in found['voxel_size'])
+
+
+def dsi_studio_affine(dim, voxel_size):
+    """Return the affine of DSI Studio NIfTI exports of a native space
+    volume of dim and voxel_size.
+
+    DSI Studio volumes are LPS, +x Left +y Posterior, and trk voxmm points
+    are in that grid. Exports are stored flipped in x and y, see
+    DSI_STUDIO_ORNT, with this RAS affine, so voxel (0, 0, 0) of the LPS
+    grid is at the world origin.
+    """
+    affine = np.diag(tuple(float(v) for v in voxel_size) + (1.,))
+    affine[0, 3] = -voxel_size[0] * (dim[0] - 1)
+    affine[1, 3] = -voxel_size[1] * (dim[1] - 1)
+    return affine
+
+
+# nibabel orientation from DSI Studio's LPS grid to its NIfTI exports
+DSI_STUDIO_ORNT = np.array([[0, -1], [1, -1], [2, 1]])
+
+
+def reference_geometry(fname):
+    """Return the grid of trk points, and of images written for them, given
+    a fib or NIfTI reference.
+
+    A fib gives DSI Studio's export geometry, see dsi_studio_affine. A
+    NIfTI gives its own grid and affine, DSI Studio's LPS grid being the
+    NIfTI reoriented to LPS, as DSI Studio loads it.
+
+    Returns
+    -------
+    dim         :   Tuple(Int), LPS grid trk voxmm points are in
+    voxel_size  :   Tuple(Float), of the LPS grid
+    affine      :   Array (4, 4), of images written, see to_reference
+    ornt        :   Array (3, 2), nibabel orientation from the LPS grid to
+        images written
+    """
+    if fname.endswith(('.fib', '.fib.gz')):
+        dim, voxel_size = fib_geometry(fname)
+        return dim, voxel_size, dsi_studio_affine(dim, voxel_size), \
+            DSI_STUDIO_ORNT.copy()
+    import nibabel as nib
+    from nibabel.orientations import (io_orientation, axcodes2ornt,
+                                      ornt_transform)
+    img = nib.load(fname)
+    ref_ornt = io_orientation(img.affine)
+    lps_ornt = axcodes2ornt(('L', 'P', 'S'))
+    ornt = ornt_transform(lps_ornt, ref_ornt)
+    # axis i of the LPS grid is axis ornt[i, 0] of the reference
+    axes = [int(a) for a in ornt[:, 0]]
+    dim = tuple(int(img.shape[a]) for a in axes)
+    zooms = img.header.get_zooms()
+    voxel_size = tuple(float(zooms[a]) for a in axes)
+    return dim, voxel_size, img.affine, ornt
+
+
+def to_reference(data, ornt):
+    """Reorient data from DSI Studio's LPS grid to a reference grid, as
+    given by reference_geometry"""
+    from nibabel.orientations import apply_orientation
+    return np.ascontiguousarray(apply_orientation(data, ornt))
+
+
+def voxel_index(points, dim, voxel_size):
+    """Return flat voxel index of voxmm points, -1 outside of dim"""
+    ijk = np.floor(points / np.asarray(voxel_size, dtype=np.float32))
+    ijk = ijk.astype(np.int64)
+    inside = np.all((ijk >= 0) & (ijk < np.asarray(dim)), axis=1)
+    flat = np.full(len(points), -1, dtype=np.int64)
+    flat[inside] = np.ravel_multi_index(ijk[inside].T, dim)
+    return flat
+
+
+def density(streamlines, dim, voxel_size):
+    """Return track density image, the number of streamlines visiting
+    each voxel, each streamline counted once per voxel"""
+    n_voxels = int(np.prod(dim))
+    flat = voxel_index(streamlines.points, dim, voxel_size)
+    inside = flat >= 0
+    visits = np.unique(streamlines.streamline_index()[inside] * n_voxels +
+                       flat[inside])
+    counts = np.bincount(visits % n_voxels, minlength=n_voxels)
+    return counts.reshape(dim)
+
+
+def endpoint_density(streamlines, dim, voxel_size):
+    """Return number of streamline end points in each voxel"""
+    n_voxels = int(np.prod(dim))
+    nonempty = streamlines.lengths > 0
+    ends = np.concatenate((streamlines.offsets[:-1][nonempty],
+                           streamlines.offsets[1:][nonempty] - 1))
+    flat = voxel_index(streamlines.points[ends], dim, voxel_size)
+    counts = np.bincount(flat[flat >= 0], minlength=n_voxels)
+    return counts.reshape(dim)
@@ -0,0 +1,192 @@
+import os
+import gzip
+import json
+import numpy as np
+import nibabel as nib
+from DINGO.cache import (FibCache, ResultCache, PairStore, TransformCache,
+                         content_hash)
+
+
+def write_gz(fname, data):
+    with gzip.open(fname, 'wb') as f:
+        f.write(data)
+    return fname
+
+
+def test_fib_cache_acquire_release(tmpdir):
+    fib = write_gz(str(tmpdir.join('sub.fib.gz')), b'fib' * 100)
+    cache = FibCache(str(tmpdir.join('cache')))
+    path = cache.acquire(fib)
+    assert os.path.basename(path) == 'sub.fib'
+    with open(path, 'rb') as f:
+        assert f.read() == b'fib' * 100
+    assert cache.acquire(fib) == path
+    entry_dir = os.path.dirname(path)
+    assert cache._n_refs(entry_dir) == 1
+    cache.release(path)
+    cache.release(path)
+    assert cache._n_refs(entry_dir) == 0
+    # kept for later steps
+    assert os.path.isfile(path)
+
+
+def test_fib_cache_evict_on_release(tmpdir):
+    fib = write_gz(str(tmpdir.join('sub.fib.gz')), b'fib' * 100)
+    cache = FibCache(str(tmpdir.join('cache')), evict_on_release=True)
+    path = cache.acquire(fib)
+    cache.acquire(fib)
+    cache.release(path)
+    assert os.path.isfile(path)
+    cache.release(path)
+    assert not os.path.exists(os.path.dirname(path))
+    assert cache.entries() == []
+
+
+def test_fib_cache_hold_drop(tmpdir):
+    fib = write_gz(str(tmpdir.join('sub.fib.gz')), b'fib' * 100)
+    cache = FibCache(str(tmpdir.join('cache')), evict_on_release=True)
+    path = cache.hold(fib)
+    entry_dir = os.path.dirname(path)
+    # held for the other processes of the branch, not by this one
+    assert cache._n_refs(entry_dir) == 1
+    assert cache.acquire(fib) == path
+    cache.release(path)
+    assert os.path.isfile(path)
+    cache.purge()
+    assert os.path.isfile(path)
+    cache.drop(fib)
+    assert not os.path.exists(entry_dir)
+    # dropping again, or what was never held, does nothing
+    cache.drop(fib)
+    path = cache.acquire(fib)
+    cache.drop(fib)
+    assert os.path.isfile(path)
+    cache.release(path)
+
+
+def write(fname, data):
+    if not os.path.isdir(os.path.dirname(fname)):
+        os.makedirs(os.path.dirname(fname))
+    with open(fname, 'wb') as f:
+        f.write(data)
+    return fname
+
+
+def test_content_hash_by_content(tmpdir):
+    memo_file = str(tmpdir.join('hashes.json'))
+    a = write(str(tmpdir.join('a.nii')), b'same')
+    b = write(str(tmpdir.join('b.nii')), b'same')
+    c = write(str(tmpdir.join('c.nii')), b'other')
+    assert content_hash(a, memo_file) == content_hash(b, memo_file)
+    assert content_hash(a, memo_file) != content_hash(c, memo_file)
+    with open(memo_file) as f:
+        assert os.path.realpath(a) in json.load(f)
+    # a changed file is hashed again, not taken from the memo
+    write(a, b'changed')
+    os.utime(a, (0, 0))
+    assert content_hash(a, memo_file) != content_hash(b, memo_file)
+
+
+def test_result_cache_key_ignores_cwd(tmpdir):
+    cache = ResultCache(str(tmpdir.join('cache')))
+    src = write(str(tmpdir.join('data', 'a.src.gz')), b'src')
+    copy = write(str(tmpdir.join('a.src.gz')), b'src')
+    keys = []
+    for cwd, source in (('run1', src), ('run2', copy)):
+        cwd = str(tmpdir.join(cwd))
+        keys.append(cache.key(
+            ['--source={}'.format(source),
+             '--output={}'.format(os.path.join(cwd, 'a.fib.gz'))],
+            cwd, ['dsi_studio']))
+    assert keys[0] == keys[1]
+    assert cache.key(['--source={}'.format(src)], str(tmpdir),
+                     ['other']) != cache.key(['--source={}'.format(src)],
+                                             str(tmpdir), ['dsi_studio'])
+
+
+def test_result_cache_key_directory(tmpdir):
+    cache = ResultCache(str(tmpdir.join('cache')))
+    dicom = str(tmpdir.join('data', 'dicom'))
+    write(os.path.join(dicom, '1.dcm'), b'slice 1')
+    write(os.path.join(dicom, 'sub', '2.dcm'), b'slice 2')
+    cwd = str(tmpdir.join('run'))
+    args = ['--action=src', '--source={}'.format(dicom)]
+    key = cache.key(args, cwd, ['dsi_studio'])
+    copy = str(tmpdir.join('copy', 'dicom'))
+    write(os.path.join(copy, '1.dcm'), b'slice 1')
+    write(os.path.join(copy, 'sub', '2.dcm'), b'slice 2')
+    assert cache.key(['--action=src', '--source={}'.format(copy)],
+                     cwd, ['dsi_studio']) == key
+    write(os.path.join(dicom, 'sub', '2.dcm'), b'slice 2, again')
+    os.utime(os.path.join(dicom, 'sub', '2.dcm'), (0, 0))
+    changed = cache.key(args, cwd, ['dsi_studio'])
+    assert changed != key
+    write(os.path.join(dicom, '3.dcm'), b'slice 3')
+    assert cache.key(args, cwd, ['dsi_studio']) != changed
+
+
+def test_result_cache_extra_binary(tmpdir, monkeypatch):
+    from DINGO.interfaces.dsistudio import DSIStudioExport
+    binary = write(str(tmpdir.join('bin', 'dsi_studio')), b'build 1')
+    os.chmod(binary, 0o755)
+    monkeypatch.setenv('PATH', os.path.dirname(binary))
+    extra = DSIStudioExport()._result_cache_extra()
+    assert extra[:2] == ['dsi_studio', binary]
+    write(binary, b'build 2, bigger')
+    assert DSIStudioExport()._result_cache_extra() != extra
+
+
+def test_result_cache_store_fetch(tmpdir):
+    cache = ResultCache(str(tmpdir.join('cache')))
+    run1 = tmpdir.join('run1')
+    out = write(str(run1.join('sub', 'a.fib.gz')), b'fib')
+    assert cache.fetch('k', str(run1)) is None
+    cache.store('k', str(run1), [out], 'wrote {}'.format(out))
+    run2 = tmpdir.join('run2').ensure(dir=True)
+    record = cache.fetch('k', str(run2))
+    assert record['files'] == [os.path.join('sub', 'a.fib.gz')]
+    assert record['stdout'] == 'wrote {}'.format(
+        str(run2.join('sub', 'a.fib.gz')))
+    assert run2.join('sub', 'a.fib.gz').read_binary() == b'fib'
+
+
+def test_pair_store(tmpdir):
+    store = PairStore(str(tmpdir.join('pairs')))
+    moving = write(str(tmpdir.join('moving.nii.gz')), b'moving')
+    target = write(str(tmpdir.join('target.nii.gz')), b'target')
+    mask = write(str(tmpdir.join('mask.nii.gz')), b'mask')
+    key = store.key(moving, target, mask, {'dof': 12})
+    assert key != store.key(target, moving, mask, {'dof': 12})
+    assert key != store.key(moving, target, None, {'dof': 12})
+    assert key != store.key(moving, target, mask, {'dof': 6})
+    assert store.fetch(key, str(tmpdir)) is None
+    mat = write(str(tmpdir.join('work', 'm_to_t.mat')), b'1 0')
+    store.store(key, [mat], mean_median=[1.5, 1.0])
+    out_dir = tmpdir.join('out').ensure(dir=True)
+    record = store.fetch(key, str(out_dir))
+    assert record['files'] == [str(out_dir.join('m_to_t.mat'))]
+    assert record['mean_median'] == [1.5, 1.0]
+    assert out_dir.join('m_to_t.mat').read_binary() == b'1 0'
+
+
+def test_transform_cache(tmpdir):
+    cache = TransformCache(str(tmpdir.join('transforms')))
+    affine = write(str(tmpdir.join('s_Affine.txt')), b'affine')
+    warp = write(str(tmpdir.join('s_Warp.nii.gz')), b'warp')
+    ref = str(tmpdir.join('ref.nii.gz'))
+    nib.Nifti1Image(np.zeros((4, 4, 4), dtype=np.uint8),
+                    np.eye(4)).to_filename(ref)
+    key = cache.key([warp, affine], ref)
+    assert key != cache.key([affine, warp], ref)
+    assert key != cache.key([warp, affine], ref, [1])
+    calls = []
+
+    def compose(out_file):
+        calls.append(out_file)
+        write(out_file, b'field')
+
+    field = cache.get(key, compose)
+    assert cache.get(key, compose) == field
+    assert len(calls) == 1
+    with open(field, 'rb') as f:
+        assert f.read() == b'field'
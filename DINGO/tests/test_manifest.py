@@ -0,0 +1,102 @@
+import os
+import glob
+import pytest
+from DINGO.manifest import FileManifest, load_manifest, prepare_manifest
+
+
+def touch(path):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(path)
+    return path
+
+
+def bump(path, seconds=10):
+    """Move a directory's mtime, as listing it again would see"""
+    st = os.stat(path)
+    os.utime(path, (st.st_atime, st.st_mtime + seconds))
+
+
+@pytest.fixture
+def data_dir(tmpdir):
+    root = str(tmpdir.join('data'))
+    for rel in ('CHD_052/01a/Regions/to_auto/Genu.nii.gz',
+                'CHD_052/01a/Regions/to_auto/Splenium.nii.gz',
+                'CHD_052/01a/CHD_052_01a_FA.nii.gz',
+                'CHD_053/01a/CHD_053_01a_FA.nii.gz',
+                'CHD_053/01a/.hidden.nii.gz',
+                'notes.txt'):
+        touch(os.path.join(root, rel))
+    return root
+
+
+def test_glob_as_filesystem(data_dir):
+    manifest = FileManifest(data_dir).scan(n_procs=2)
+    for pattern in ('*', '*/*/*_FA.nii.gz', 'CHD_05[23]/01a/*',
+                    'CHD_052/01a/Regions/to_auto/*.nii.gz',
+                    'CHD_053/01a/.*', 'CHD_054/*', 'notes.txt'):
+        pattern = os.path.join(data_dir, pattern)
+        assert sorted(manifest.glob(pattern)) == sorted(glob.glob(pattern))
+    # outside data_dir falls back to the filesystem
+    outside = os.path.join(os.path.dirname(data_dir), '*')
+    assert sorted(manifest.glob(outside)) == sorted(glob.glob(outside))
+
+
+def test_exists_stat_subject_files(data_dir):
+    manifest = FileManifest(data_dir).scan(n_procs=1)
+    fa = os.path.join(data_dir, 'CHD_052/01a/CHD_052_01a_FA.nii.gz')
+    assert manifest.exists(fa)
+    assert manifest.exists(os.path.join(data_dir, 'CHD_052/01a/Regions'))
+    assert not manifest.exists(os.path.join(data_dir, 'CHD_052/02a'))
+    st = os.stat(fa)
+    assert manifest.stat(fa) == [st.st_size, st.st_mtime]
+    assert manifest.stat(os.path.join(data_dir, 'missing.nii')) is None
+    assert manifest.subject_files('CHD_052', '01a', 'FA') == [fa]
+    assert len(manifest.subject_files('CHD_052')) == 3
+
+
+def test_refresh_relists_changed_dirs(data_dir):
+    manifest = FileManifest(data_dir).scan()
+    added = touch(os.path.join(data_dir, 'CHD_053/01a/new/Genu.nii.gz'))
+    bump(os.path.join(data_dir, 'CHD_053/01a'))
+    removed = os.path.join(data_dir, 'CHD_052/01a/Regions/to_auto')
+    for name in os.listdir(removed):
+        os.remove(os.path.join(removed, name))
+    os.rmdir(removed)
+    bump(os.path.join(data_dir, 'CHD_052/01a/Regions'))
+    manifest.refresh()
+    assert manifest.exists(added)
+    assert not manifest.exists(removed)
+    assert 'CHD_052/01a/Regions/to_auto' not in manifest.dirs
+    pattern = os.path.join(data_dir, '*/01a/*/*.nii.gz')
+    assert sorted(manifest.glob(pattern)) == sorted(glob.glob(pattern))
+
+
+def test_refresh_edited_in_place(data_dir):
+    manifest = FileManifest(data_dir).scan()
+    fa = os.path.join(data_dir, 'CHD_052/01a/CHD_052_01a_FA.nii.gz')
+    reldir = os.path.dirname(manifest.relpath(fa))
+    dir_mtime = manifest.dirs[reldir]['mtime']
+    with open(fa, 'a') as f:
+        f.write('more')
+    os.utime(fa, (0, 12345))
+    assert os.stat(os.path.dirname(fa)).st_mtime == dir_mtime
+    manifest.refresh()
+    st = os.stat(fa)
+    assert manifest.stat(fa) == [st.st_size, 12345]
+
+
+def test_save_load(data_dir, tmpdir):
+    path = prepare_manifest(data_dir, n_procs=1)
+    assert path == os.path.join(data_dir, FileManifest.default_name)
+    manifest = load_manifest(path)
+    assert manifest.data_dir == data_dir
+    scanned = FileManifest(data_dir).scan().dirs
+    assert sorted(manifest.dirs) == sorted(scanned)
+    for reldir, entry in scanned.items():
+        assert manifest.dirs[reldir]['files'] == entry['files']
+    # the manifest does not index itself
+    assert not manifest.exists(path)
+    with pytest.raises(ValueError):
+        FileManifest(str(tmpdir.join('other')), path).load()
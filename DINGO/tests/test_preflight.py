@@ -0,0 +1,75 @@
+import os
+import re
+import json
+from glob import glob
+import pytest
+from DINGO.base import DINGO
+from DINGO.preflight import PreflightError
+
+RES = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))), 'res')
+SETUPS = sorted(glob(os.path.join(RES, '*.json')))
+# the example data is not shipped, only missing data may be reported
+MISSING = re.compile(r'no files found|No such file or directory')
+
+
+def build(setuppath, data_dir):
+    """Build setuppath with data_dir, return preflight problems"""
+    with open(setuppath, 'r') as f:
+        setup = json.load(f)
+    if 'steps' not in setup:
+        return None
+    setup['data_dir'] = str(data_dir)
+    setup['preflight'] = True
+    setup['preflight_n_procs'] = 1
+    path = os.path.join(str(data_dir), os.path.basename(setuppath))
+    with open(path, 'w') as f:
+        json.dump(setup, f)
+    try:
+        DINGO(setuppath=path)
+    except PreflightError as err:
+        return err.problems
+    return []
+
+
+@pytest.mark.parametrize('setuppath', SETUPS, ids=os.path.basename)
+def test_res_setups_build(setuppath, tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    problems = build(setuppath, tmpdir)
+    if problems is None:
+        pytest.skip('subject config, not an analysis setup')
+    unexpected = [(section, msg) for section, msg in problems
+                  if section != 'Inputs' or not MISSING.search(msg)]
+    assert unexpected == []
+
+
+def test_base_directory_from_setup(tmpdir, monkeypatch):
+    # FileIn_mask gets base_directory by connection from the setup data_dir
+    monkeypatch.chdir(str(tmpdir))
+    problems = build(os.path.join(RES, 'GenFIB_analysis_config.json'),
+                     tmpdir)
+    masks = [msg for _, msg in problems if msg.startswith('FileIn_mask')]
+    assert len(masks) == 1
+    assert str(tmpdir) in masks[0]
+    assert 'KeyError' not in masks[0]
+
+
+def test_warp_regions_cover_trk(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    with open(os.path.join(RES, 'DSITRK_analysis_config.json'), 'r') as f:
+        setup = json.load(f)
+    setuppath = str(tmpdir.join('setup.json'))
+    for tracts, missing in (('DSI_TRK', None),
+                            (['Genu', 'Sagittal_L', 'sagittal_r'],
+                             'PosteriorGenu')):
+        setup['method']['WarpRegions']['inputs']['tracts'] = tracts
+        with open(setuppath, 'w') as f:
+            json.dump(setup, f)
+        regions = [msg for section, msg in build(setuppath, tmpdir)
+                   if section == 'Regions']
+        if missing is None:
+            assert regions == []
+        else:
+            assert len(regions) == 1
+            assert missing in regions[0]
+            assert 'Sagittal_R' not in regions[0]
@@ -0,0 +1,148 @@
+import os
+import numpy as np
+import nibabel as nib
+import pytest
+from nipype.interfaces import fsl
+from DINGO import registration
+from DINGO.registration import (FA_2_FMRIB58_SCHEDULE, FNIRT_PRESETS,
+                                schedule_cost, fnirt_preset, downsample,
+                                coarse_to_fine_matrix)
+
+
+@pytest.mark.parametrize('preset', FNIRT_PRESETS,
+                         ids=lambda p: 'min{:d}'.format(p[0]))
+def test_presets_cheaper_than_config(preset):
+    _, factor, opts = preset
+    assert schedule_cost(opts) < schedule_cost(FA_2_FMRIB58_SCHEDULE)
+    for key, levels in opts.items():
+        assert len(levels) == len(FA_2_FMRIB58_SCHEDULE[key])
+    subsampling = opts['subsampling_scheme']
+    assert subsampling == sorted(subsampling, reverse=True)
+    assert min(subsampling) >= min(
+        FA_2_FMRIB58_SCHEDULE['subsampling_scheme'])
+
+
+def test_fnirt_preset_by_size(tmpdir):
+    for shape, factor in (((182, 218, 182), 4), ((91, 109, 91), 2),
+                          ((128, 128, 60), 1)):
+        ref = str(tmpdir.join('ref.nii.gz'))
+        nib.Nifti1Image(np.zeros(shape, dtype=np.uint8),
+                        np.eye(4)).to_filename(ref)
+        assert fnirt_preset(ref)[0] == factor
+
+
+class Recorder(object):
+    """Stands in for fsl.FLIRT and fsl.FNIRT, records inputs"""
+    calls = []
+
+    def __init__(self, **inputs):
+        self.inputs = inputs
+        Recorder.calls.append(inputs)
+
+    def run(self):
+        out = dict()
+        if 'out_matrix_file' in self.inputs:
+            np.savetxt(self.inputs['out_matrix_file'], np.eye(4))
+            out['out_matrix_file'] = os.path.abspath(
+                self.inputs['out_matrix_file'])
+        else:
+            img = nib.load(self.inputs['ref_file'])
+            img.to_filename(self.inputs['warped_file'])
+            out['warped_file'] = os.path.abspath(self.inputs['warped_file'])
+        outputs = type('Outputs', (object,), out)
+        return type('Result', (object,), {'outputs': outputs})
+
+
+def test_benchmark_default_is_fslnonlinreg(tmpdir, monkeypatch):
+    fsldir = tmpdir.join('fsl')
+    monkeypatch.setenv('FSLDIR', str(fsldir))
+    monkeypatch.setattr(fsl, 'no_fsl', lambda: False)
+    monkeypatch.setattr(fsl, 'FLIRT', Recorder)
+    monkeypatch.setattr(fsl, 'FNIRT', Recorder)
+    Recorder.calls = []
+    ref = str(tmpdir.join('ref.nii'))
+    data = np.zeros((160, 160, 160), dtype=np.uint8)
+    data[40:120, 40:120, 40:120] = np.arange(80, dtype=np.uint8)
+    nib.Nifti1Image(data, np.eye(4)).to_filename(ref)
+    results = registration.benchmark(ref, ref, str(tmpdir.join('work')))
+    config = os.path.join(str(fsldir), 'etc/flirtsch/FA_2_FMRIB58_1mm.cnf')
+    fnirts = [c for c in Recorder.calls if 'ref_file' in c]
+    assert fnirts[0]['config_file'] == config
+    assert 'subsampling_scheme' not in fnirts[0]
+    assert fnirts[1]['config_file'] == config
+    assert fnirts[1]['subsampling_scheme'] == FNIRT_PRESETS[0][2][
+        'subsampling_scheme']
+    assert results[0]['cost'] == schedule_cost(FA_2_FMRIB58_SCHEDULE)
+    assert results[1]['cost'] < results[0]['cost']
+    # the Recorder's warped image is the reference
+    assert [r['similarity'] for r in results] == pytest.approx([1.0, 1.0])
+    empty = str(tmpdir.join('empty.nii'))
+    nib.Nifti1Image(np.zeros((4, 4, 4), dtype=np.uint8),
+                    np.eye(4)).to_filename(empty)
+    assert registration.similarity(empty, empty) == 0.0
+
+
+def fsl_coords(img, ijk):
+    """FLIRT scaled-voxel coordinates of voxel ijk, x flipped when the
+    qform has a positive determinant"""
+    zooms = np.array(img.header.get_zooms()[:3])
+    ijk = np.array(ijk, dtype=np.float64)
+    if np.linalg.det(img.header.get_best_affine()[:3, :3]) > 0:
+        ijk[0] = img.shape[0] - 1 - ijk[0]
+    return ijk * zooms
+
+
+@pytest.mark.parametrize('xsign', [1, -1], ids=['neurological',
+                                                 'radiological'])
+def test_coarse_to_fine_matrix(tmpdir, monkeypatch, xsign):
+    monkeypatch.chdir(str(tmpdir))
+    factor = 2
+    in_file = str(tmpdir.join('in.nii.gz'))
+    ref_file = str(tmpdir.join('ref.nii.gz'))
+    nib.Nifti1Image(np.ones((11, 12, 9), dtype=np.float32),
+                    np.diag([xsign * 1.5, 1.5, 2., 1.])).to_filename(in_file)
+    nib.Nifti1Image(np.ones((13, 10, 10), dtype=np.float32),
+                    np.diag([xsign * 1., 1., 1., 1.])).to_filename(ref_file)
+    images = []
+    for fname in (in_file, ref_file):
+        coarse_file = downsample(fname, factor,
+                                 str(tmpdir.join('coarse_' +
+                                                 os.path.basename(fname))))
+        images.append((nib.load(fname), nib.load(coarse_file)))
+    coarse_mat = np.array([[1., 0.1, 0, 2],
+                           [0, 0.9, 0, -1],
+                           [0, 0, 1.1, 3],
+                           [0, 0, 0, 1]])
+    np.savetxt(str(tmpdir.join('coarse.mat')), coarse_mat)
+    fine_file = coarse_to_fine_matrix(str(tmpdir.join('coarse.mat')),
+                                      in_file, ref_file, factor)
+    assert fine_file == str(tmpdir.join('coarse_fine.mat'))
+    fine_mat = np.loadtxt(fine_file)
+    # a coarse voxel centre is the same world point on both grids, the fine
+    # matrix must map it where the coarse matrix does
+    (in_img, in_coarse), (ref_img, ref_coarse) = images
+    for cijk in ((0, 0, 0), (4, 2, 3), (1, 5, 0)):
+        world = np.dot(in_coarse.affine, np.append(cijk, 1))
+        fijk = np.dot(np.linalg.inv(in_img.affine), world)[:3]
+        mapped = np.dot(coarse_mat, np.append(fsl_coords(in_coarse, cijk), 1))
+        fine = np.dot(fine_mat, np.append(fsl_coords(in_img, fijk), 1))
+        # mapped is in coarse ref coordinates, find it on the fine ref
+        scale = np.array(ref_coarse.header.get_zooms()[:3])
+        rcijk = mapped[:3] / scale
+        if xsign > 0:
+            rcijk[0] = ref_coarse.shape[0] - 1 - rcijk[0]
+        rworld = np.dot(ref_coarse.affine, np.append(rcijk, 1))
+        rfijk = np.dot(np.linalg.inv(ref_img.affine), rworld)[:3]
+        assert np.allclose(fine[:3], fsl_coords(ref_img, rfijk))
+
+
+def test_coarse_to_fine_identity(tmpdir):
+    in_file = str(tmpdir.join('in.nii.gz'))
+    nib.Nifti1Image(np.ones((11, 12, 9), dtype=np.float32),
+                    np.diag([1.5, 1.5, 2., 1.])).to_filename(in_file)
+    np.savetxt(str(tmpdir.join('coarse.mat')), np.eye(4))
+    for factor in (1, 2, 4):
+        fine_file = coarse_to_fine_matrix(
+            str(tmpdir.join('coarse.mat')), in_file, in_file, factor,
+            str(tmpdir.join('fine.mat')))
+        assert np.allclose(np.loadtxt(fine_file), np.eye(4))
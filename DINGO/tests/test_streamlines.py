@@ -0,0 +1,169 @@
+import gzip
+import numpy as np
+import nibabel as nib
+from DINGO.streamlines import (Streamlines, default_header, read_trk,
+                               write_trk, read_txt, write_txt, load, save,
+                               fib_geometry, dsi_studio_affine,
+                               reference_geometry, to_reference, density,
+                               endpoint_density)
+
+
+def write_fib(fname, dim, voxel_size):
+    """Write the start of a DSI Studio fib, MAT v4 dimension and
+    voxel_size records"""
+    records = [('dimension', np.asarray(dim, dtype='<i2'), 30),
+               ('voxel_size', np.asarray(voxel_size, dtype='<f4'), 10)]
+    with gzip.open(fname, 'wb') as f:
+        for name, data, mopt in records:
+            name = name.encode('ascii') + b'\0'
+            f.write(np.array([mopt, 1, len(data), 0, len(name)],
+                             dtype='<i4').tobytes())
+            f.write(name)
+            f.write(data.tobytes())
+    return fname
+
+
+def test_fib_geometry(tmpdir):
+    fib = write_fib(str(tmpdir.join('a.fib.gz')), (128, 128, 60),
+                    (2, 2, 2.5))
+    assert fib_geometry(fib) == ((128, 128, 60), (2.0, 2.0, 2.5))
+
+
+def test_dsi_studio_affine():
+    # srow of a DSI Studio export of a native 128x128x60 2mm fib
+    expected = np.array([[2, 0, 0, -254],
+                         [0, 2, 0, -254],
+                         [0, 0, 2, 0],
+                         [0, 0, 0, 1]], dtype=np.float64)
+    assert np.allclose(dsi_studio_affine((128, 128, 60), (2, 2, 2)),
+                       expected)
+
+
+def test_fib_reference_matches_export(tmpdir):
+    dim = (10, 12, 8)
+    voxel_size = (2., 2., 2.)
+    fib = write_fib(str(tmpdir.join('a.fib.gz')), dim, voxel_size)
+    # an export of the fib, voxel (i, j, k) of the LPS grid stored flipped
+    lps = np.arange(np.prod(dim), dtype=np.int32).reshape(dim)
+    export = str(tmpdir.join('a.fib.gz.fa0.nii.gz'))
+    nib.Nifti1Image(lps[::-1, ::-1, :].copy(),
+                    dsi_studio_affine(dim, voxel_size)).to_filename(export)
+    for reference in (fib, export):
+        rdim, rvoxel_size, affine, ornt = reference_geometry(reference)
+        assert rdim == dim
+        assert rvoxel_size == voxel_size
+        assert np.allclose(affine, dsi_studio_affine(dim, voxel_size))
+        assert np.array_equal(to_reference(lps, ornt),
+                              nib.load(export).get_data())
+    # LPS voxel (i, j, k) is at RAS world (-i, -j, k) * voxel_size
+    i, j, k = 3, 4, 5
+    stored = to_reference(lps, ornt)
+    ijk = np.argwhere(stored == lps[i, j, k])[0]
+    world = np.dot(affine, np.append(ijk, 1))[:3]
+    assert np.allclose(world, (-2. * i, -2. * j, 2. * k))
+
+
+def test_nifti_reference_reoriented(tmpdir):
+    # LAS, as FSL writes radiological images, only y differs from LPS
+    dim = (6, 7, 5)
+    affine = np.diag((-1.5, 1.5, 1.5, 1.))
+    ref = str(tmpdir.join('las.nii.gz'))
+    nib.Nifti1Image(np.zeros(dim, dtype=np.float32),
+                    affine).to_filename(ref)
+    rdim, voxel_size, raffine, ornt = reference_geometry(ref)
+    assert rdim == dim
+    assert voxel_size == (1.5, 1.5, 1.5)
+    assert np.allclose(raffine, affine)
+    lps = np.zeros(dim, dtype=np.int32)
+    lps[1, 2, 3] = 1
+    assert np.argwhere(to_reference(lps, ornt) == 1).tolist() == \
+        [[1, dim[1] - 1 - 2, 3]]
+
+
+def test_trk_density_in_export_geometry(tmpdir):
+    dim = (10, 12, 8)
+    voxel_size = (2., 2., 2.)
+    # one streamline within LPS voxel (3, 4, 5), voxmm
+    points = (np.array([[3, 4, 5], [3.5, 4.5, 5.5]]) + 0.25) * 2
+    trk = write_trk(str(tmpdir.join('a.trk.gz')), Streamlines.from_list(
+        [points], header=default_header(dim, voxel_size)))
+    fib = write_fib(str(tmpdir.join('a.fib.gz')), dim, voxel_size)
+    rdim, rvoxel_size, affine, ornt = reference_geometry(fib)
+    tdi = to_reference(density(read_trk(trk), rdim, rvoxel_size), ornt)
+    ijk = np.argwhere(tdi)
+    assert len(ijk) == 1
+    assert np.allclose(np.dot(affine, np.append(ijk[0], 1))[:3],
+                       (-6., -8., 10.))
+
+
+def random_streamlines(n, dim, voxel_size, seed=0, **kwargs):
+    """Random walks in voxmm, some leaving the volume"""
+    rng = np.random.RandomState(seed)
+    extent = np.asarray(dim) * np.asarray(voxel_size)
+    streamlines = []
+    for length in rng.randint(1, 12, size=n):
+        start = rng.uniform(0, extent)
+        steps = rng.normal(scale=1.5, size=(length, 3))
+        steps[0] = 0
+        streamlines.append(start + np.cumsum(steps, axis=0))
+    return Streamlines.from_list(streamlines, **kwargs)
+
+
+def test_trk_round_trip(tmpdir):
+    dim = (10, 12, 8)
+    voxel_size = (2., 2., 2.5)
+    s = random_streamlines(20, dim, voxel_size,
+                           header=default_header(dim, voxel_size))
+    rng = np.random.RandomState(1)
+    s.scalars = rng.rand(len(s.points), 2).astype(np.float32)
+    s.properties = rng.rand(len(s), 1).astype(np.float32)
+    for fname in ('a.trk', 'a.trk.gz'):
+        fname = save(str(tmpdir.join(fname)), s)
+        r = load(fname)
+        assert len(r) == len(s)
+        assert np.array_equal(r.offsets, s.offsets)
+        assert np.array_equal(r.points, s.points)
+        assert np.array_equal(r.scalars, s.scalars)
+        assert np.array_equal(r.properties, s.properties)
+        assert r.header['n_count'] == len(s)
+        assert tuple(r.header['dim']) == dim
+        assert np.allclose(r.header['voxel_size'], voxel_size)
+        assert r.header.tobytes() == read_trk(fname).header.tobytes()
+
+
+def test_txt_round_trip(tmpdir):
+    voxel_size = (2., 2., 2.5)
+    s = random_streamlines(5, (10, 12, 8), voxel_size)
+    fname = write_txt(str(tmpdir.join('a.txt')), s, voxel_size)
+    with open(fname) as f:
+        assert len(f.readlines()) == 5
+    r = read_txt(fname, voxel_size)
+    assert np.array_equal(r.offsets, s.offsets)
+    assert np.allclose(r.points, s.points, rtol=1e-5, atol=1e-4)
+    # trk of a txt tract is the same tract
+    trk = write_trk(str(tmpdir.join('a.trk.gz')), r)
+    assert np.array_equal(read_trk(trk).points, r.points)
+    assert len(load(fname)) == 5
+
+
+def test_density_counts_streamlines_once_per_voxel():
+    dim = (10, 12, 8)
+    voxel_size = (2., 2., 2.5)
+    s = random_streamlines(50, dim, voxel_size)
+    expected = np.zeros(dim, dtype=np.int64)
+    ends = np.zeros(dim, dtype=np.int64)
+    for sl in s:
+        visited = set()
+        for point in sl:
+            ijk = tuple(int(v) for v in np.floor(point / voxel_size))
+            if all(0 <= v < d for v, d in zip(ijk, dim)):
+                visited.add(ijk)
+        for ijk in visited:
+            expected[ijk] += 1
+        for point in (sl[0], sl[-1]):
+            ijk = tuple(int(v) for v in np.floor(point / voxel_size))
+            if all(0 <= v < d for v, d in zip(ijk, dim)):
+                ends[ijk] += 1
+    assert np.array_equal(density(s, dim, voxel_size), expected)
+    assert np.array_equal(endpoint_density(s, dim, voxel_size), ends)
+    assert density(Streamlines(), dim, voxel_size).sum() == 0
@@ -0,0 +1,169 @@
+import os
+import re
+import numpy as np
+import nibabel as nib
+import pytest
+from DINGO.utils import (build_region_index, lookup_region, union_masks,
+                         deformation_stats, group_stats, mean_image,
+                         rank_fa_targets, tract_region_names)
+
+
+def save(path, data, affine=np.eye(4)):
+    nib.Nifti1Image(data, affine).to_filename(path)
+    return path
+
+
+def test_group_stats_as_fsl(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    rng = np.random.RandomState(0)
+    vols = rng.uniform(-0.2, 1, size=(3, 5, 6, 7)).astype(np.float32)
+    vols[1, 0, 0, 0] = 0
+    in_files = [save(str(tmpdir.join('fa{:d}.nii.gz'.format(i))), vol)
+                for i, vol in enumerate(vols)]
+    masked_file, mask_file, mean_file = group_stats(in_files,
+                                                    'all_FA.nii.gz')
+    assert [os.path.basename(f) for f in (masked_file, mask_file,
+                                          mean_file)] == [
+        'all_FA_masked.nii', 'all_FA_mask.nii.gz',
+        'all_FA_masked_mean.nii.gz']
+    # fslmaths all_FA -max 0 -Tmin -bin mask
+    mask = np.min(np.maximum(vols, 0), axis=0) != 0
+    # fslmaths all_FA -mas mask all_FA_masked, -Tmean mean_FA
+    masked = np.where(mask, vols, 0).transpose(1, 2, 3, 0)
+    assert np.array_equal(nib.load(mask_file).get_data(),
+                          mask.astype(np.uint8))
+    assert np.allclose(nib.load(masked_file).get_data(), masked)
+    assert np.allclose(nib.load(mean_file).get_data(),
+                       masked.mean(axis=-1), atol=1e-6)
+
+
+def test_deformation_stats_as_fsl(tmpdir):
+    rng = np.random.RandomState(0)
+    field = rng.normal(size=(5, 6, 7, 3)).astype(np.float32)
+    field[:2] = 0
+    for fname, data in (('field.nii.gz', field),
+                        ('field.nii', field),
+                        ('field3d.nii.gz', field[..., 0])):
+        path = save(str(tmpdir.join(fname)), data)
+        # fslmaths field -sqr -Tmean sqr, fslstats sqr -M -P 50
+        sqr = np.square(data.astype(np.float64))
+        if sqr.ndim == 4:
+            sqr = sqr.mean(axis=-1)
+        nonzero = sqr[sqr != 0]
+        assert nonzero.size == 3 * 6 * 7
+        assert np.allclose(deformation_stats(path),
+                           [nonzero.mean(), np.median(nonzero)])
+    empty = save(str(tmpdir.join('empty.nii.gz')),
+                 np.zeros((2, 2, 2, 3), dtype=np.float32))
+    assert deformation_stats(empty) == [0.0, 0.0]
+
+
+REGIONS = ['/data/sub/Regions/to_auto/Genu.nii.gz',
+           '/data/sub/Regions/to_auto/Genu_L.nii.gz',
+           '/data/sub/Regions/to_auto/Splenium.nii.gz',
+           '/data/sub/Regions/to_auto/CST_ROI_L.nii.gz',
+           '/data/sub/Regions/to_auto/CST_ROI_R.nii.gz',
+           '/data/sub/Regions/to_auto/ROI2.nii.gz',
+           '/data/sub/Regions/to_auto/ROI.nii.gz',
+           'C:\\data\\sub\\Fornix.nii.gz']
+
+
+def regex_lookup(regions, name):
+    """DSI_TRK.replace_regions before the region index"""
+    pattern = ''.join((r'(?<=[\\_/])', name))
+    for region in regions:
+        if re.search(pattern, region, flags=re.IGNORECASE):
+            return region
+    raise LookupError(name)
+
+
+@pytest.mark.parametrize('name', [
+    'Splenium', 'splenium', 'CST_ROI_L', 'ROI_R', 'R.nii', 'to_auto/Genu_L',
+    'Fornix', 'Regions/to_auto/Splenium'])
+def test_lookup_region_as_regex(name):
+    index = build_region_index(REGIONS)
+    assert lookup_region(index, name) == regex_lookup(REGIONS, name)
+
+
+def test_lookup_region_narrowing():
+    index = build_region_index(REGIONS + REGIONS[:2])
+    assert index['files'] == REGIONS
+    # the regex took the first of several matches, the index prefers the
+    # one where the name ends at a word boundary, then at the extension
+    assert lookup_region(index, 'Genu') == REGIONS[0]
+    assert lookup_region(index, 'ROI') == REGIONS[6]
+    for name in ('CST', 'L.nii'):
+        with pytest.raises(LookupError):
+            lookup_region(index, name)
+    with pytest.raises(LookupError):
+        lookup_region(index, 'Cingulum')
+    # only after a separator, as the regex lookbehind
+    with pytest.raises(LookupError):
+        lookup_region(index, 'plenium')
+
+
+def test_union_masks(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    a = np.zeros((4, 5, 6), dtype=np.float32)
+    a[0] = 0.5
+    b = np.zeros((4, 5, 6), dtype=np.int16)
+    b[:, 0] = -1
+    masks = [save(str(tmpdir.join('a.nii.gz')), a),
+             save(str(tmpdir.join('b.nii')), b)]
+    out_file = union_masks(masks, 'union.nii.gz')
+    img = nib.load(out_file)
+    assert img.get_data_dtype() == np.uint8
+    assert np.array_equal(img.get_data(), ((a != 0) | (b != 0)))
+    cache_dir = str(tmpdir.join('cache'))
+    first = union_masks(masks, 'cached1.nii.gz', cache_dir)
+    second = union_masks(masks[::-1], 'cached2.nii.gz', cache_dir)
+    assert len([f for f in os.listdir(cache_dir)
+                if f.endswith('.nii.gz')]) == 1
+    for out_file in (first, second):
+        assert np.array_equal(nib.load(out_file).get_data(), img.get_data())
+    shifted = np.eye(4)
+    shifted[0, 3] = 1
+    with pytest.raises(ValueError):
+        union_masks([masks[0], save(str(tmpdir.join('c.nii.gz')), a,
+                                    shifted)], 'bad.nii.gz')
+
+
+def test_mean_image(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    vols = np.arange(3 * 60, dtype=np.int16).reshape(3, 3, 4, 5)
+    in_files = [save(str(tmpdir.join('{:d}.nii.gz'.format(i))), vol)
+                for i, vol in enumerate(vols)]
+    out_file = mean_image(in_files, 'mean.nii.gz')
+    img = nib.load(out_file)
+    assert img.get_data_dtype() == np.float32
+    assert np.allclose(img.get_data(), vols.mean(axis=0))
+
+
+def test_rank_fa_targets(tmpdir):
+    rng = np.random.RandomState(0)
+    base = np.zeros((12, 12, 12))
+    base[2:10, 3:9, 2:10] = rng.uniform(0.2, 0.8, (8, 6, 8))
+    fas = []
+    for i, noise in enumerate((0.05, 0.01, 0.3)):
+        data = base + (base != 0) * rng.normal(scale=noise, size=base.shape)
+        fas.append(save(str(tmpdir.join('{:d}.nii.gz'.format(i))),
+                        data.astype(np.float32)))
+    order, scores = rank_fa_targets(fas, shape=(8, 8, 8))
+    assert order == [1, 0, 2]
+    assert len(scores) == 3
+    assert scores[1] > scores[0] > scores[2]
+    assert rank_fa_targets(fas[:1], shape=(8, 8, 8)) == ([0], [1.0])
+
+
+def test_tract_region_names():
+    tracts = {'Genu': {'rois': ['Genu', 'Sagittal_L'], 'roas': 'Midbody'},
+              'Splenium': {'rois': ['Splenium', 'Sagittal_L']}}
+    assert sorted(tract_region_names(tracts)) == [
+        'Genu', 'Midbody', 'Sagittal_L', 'Splenium']
+    # DSI_TRK inputs, shared regions apply to every tract
+    trk_inputs = {'fiber_count': 5000, 'roas': ['Cerebellum'],
+                  'tracts': tracts}
+    assert tract_region_names(trk_inputs)[0] == 'Cerebellum'
+    assert len(tract_region_names(trk_inputs)) == 5
+    assert tract_region_names({'rois': ['ROI']}) == ['ROI']
+    assert tract_region_names(['ROI', 'ROI2', 'ROI']) == ['ROI', 'ROI2']
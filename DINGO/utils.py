@@ -33,6 +33,383 @@ def dice_coef(nii_a, nii_b):
     return dice
 
 
+def union_masks(mask_files, out_file, cache_dir=None):
+    """Write the union of binary masks in the same 3D space as a uint8 NIfTI.
+
+    Masks are read one at a time, memory mapped when uncompressed, and
+    OR-ed into the result, so no 4D image is made. With cache_dir the union
+    is kept there by the content of the mask set, and linked to out_file
+    when the same set is requested again.
+
+    Parameters
+    ----------
+    mask_files  :   List(File), NIfTI masks, nonzero is inside
+    out_file    :   File, NIfTI to write
+    cache_dir   :   Directory or None
+
+    Returns
+    -------
+    out_file    :   File, absolute path
+    """
+    import hashlib
+    import nibabel as nib
+    out_file = os.path.abspath(out_file)
+    cached = None
+    if cache_dir is not None:
+        from DINGO.cache import content_hash
+        from DINGO.interfaces.io import link_file, copy_file, makedirs
+        makedirs(cache_dir)
+        memo_file = os.path.join(cache_dir, 'hashes.json')
+        hashes = sorted(set(content_hash(f, memo_file) for f in mask_files))
+        key = hashlib.sha1(' '.join(hashes)).hexdigest()
+        cached = os.path.join(cache_dir, ''.join((key, '.nii.gz')))
+        if os.path.isfile(cached):
+            if link_file(cached, out_file, 'hardlink') is None:
+                copy_file(cached, out_file)
+            return out_file
+
+    first = nib.load(mask_files[0])
+    union = np.zeros(first.shape[:3], dtype=np.uint8)
+    for mask_file in mask_files:
+        img = nib.load(mask_file)
+        if (img.shape[:3] != union.shape or
+                not np.allclose(img.affine, first.affine, atol=1e-4)):
+            raise ValueError('Mask {} is not in the space of {}'
+                             .format(mask_file, mask_files[0]))
+        data = np.asanyarray(img.dataobj)
+        union |= (data.reshape(union.shape) != 0)
+    header = first.header.copy()
+    header.set_data_dtype(np.uint8)
+    out_img = nib.Nifti1Image(union, first.affine, header)
+
+    if cached is None:
+        out_img.to_filename(out_file)
+    else:
+        tmp = '{}.{:d}.nii.gz'.format(cached[:-len('.nii.gz')], os.getpid())
+        out_img.to_filename(tmp)
+        os.rename(tmp, cached)
+        if link_file(cached, out_file, 'hardlink') is None:
+            copy_file(cached, out_file)
+    return out_file
+
+
+def build_region_index(regions):
+    """Index region files for lookup_region.
+
+    A region name matches a file if it follows '\\', '_' or '/' somewhere
+    in the path, ignoring case, as the pattern '(?<=[\\\\_/])name' did.
+    Every such suffix of every path is kept sorted, so each lookup is a
+    bisection instead of a regex per file.
+
+    Parameters
+    ----------
+    regions     :   List(File)
+
+    Returns
+    -------
+    region_index    :   Dict {'files': [File], 'suffixes': [[Str, Int]]}
+    """
+    files = []
+    for region in regions:
+        if region not in files:
+            files.append(region)
+    suffixes = []
+    for i, region in enumerate(files):
+        lower = region.lower()
+        for pos in xrange(1, len(lower)):
+            if lower[pos - 1] in '\\_/':
+                suffixes.append([lower[pos:], i])
+    suffixes.sort()
+    return {'files': files, 'suffixes': suffixes}
+
+
+def lookup_region(region_index, name):
+    """Return the region file in region_index matching name.
+
+    When several files match, those where name ends at a word boundary, then
+    those where only the extension follows, are preferred.
+
+    Raises
+    ------
+    LookupError if no file, or more than one file, matches
+    """
+    import re
+    from bisect import bisect_left
+    key = name.lower()
+    suffixes = region_index['suffixes']
+    files = region_index['files']
+    matches = dict()  # file index: remainders after name
+    pos = bisect_left(suffixes, [key])
+    while pos < len(suffixes) and suffixes[pos][0].startswith(key):
+        suffix, i = suffixes[pos]
+        matches.setdefault(i, []).append(suffix[len(key):])
+        pos += 1
+    if not matches:
+        raise LookupError('{} not found in region file list'.format(name))
+    narrowings = (
+        lambda rest: rest == '' or not rest[0].isalnum(),
+        lambda rest: re.match(r'^(\.[a-z]+)*$', rest) is not None)
+    candidates = sorted(matches)
+    for narrow in narrowings:
+        if len(candidates) == 1:
+            break
+        narrowed = [i for i in candidates if any(map(narrow, matches[i]))]
+        if narrowed:
+            candidates = narrowed
+    if len(candidates) > 1:
+        raise LookupError('{} is ambiguous in region file list: {}'
+                          .format(name, [files[i] for i in candidates]))
+    return files[candidates[0]]
+
+
+def tract_region_names(tracts):
+    """Return the region names used by tracts, in first use order.
+
+    tracts may be a Dict as DSI_TRK's tracts, the inputs of a DSI_TRK step,
+    whose regions outside 'tracts' apply to every tract, or a List of
+    region names.
+    """
+    region_types = ('rois', 'roas', 'seed', 'ends', 'ter')
+    if not isinstance(tracts, dict):
+        tract_inputs = [{'rois': list(tracts)}]
+    elif 'tracts' in tracts or any(k in tracts for k in region_types):
+        tract_inputs = [tracts] + list(tracts.get('tracts', {}).values())
+    else:
+        tract_inputs = list(tracts.values())
+    names = []
+    for tract_input in tract_inputs:
+        for reg_type in region_types:
+            if reg_type in tract_input:
+                regionname_list = tract_input[reg_type]
+                if not isinstance(regionname_list, list):
+                    regionname_list = [regionname_list]
+                for name in regionname_list:
+                    if name not in names:
+                        names.append(name)
+    return names
+
+
+def fa_thumbnail(fa_file, shape=(32, 32, 32)):
+    """Crop an FA to its nonzero bounding box and resample it to shape.
+
+    Cropping and resampling to a common grid stands in for a translation and
+    scaling, so thumbnails of different subjects are roughly comparable
+    without a registration. The result has zero mean and unit variance.
+
+    Parameters
+    ----------
+    fa_file     :   File, 3D NIfTI
+    shape       :   Tuple(Int), thumbnail shape
+
+    Returns
+    -------
+    thumbnail   :   1D numpy.ndarray, float64
+    """
+    import nibabel as nib
+    from scipy import ndimage
+    data = np.asanyarray(nib.load(fa_file).dataobj)
+    data = np.nan_to_num(data.reshape(data.shape[:3]).astype(np.float64))
+    nonzero = np.nonzero(data)
+    if len(nonzero[0]) == 0:
+        raise ValueError('{} is empty'.format(fa_file))
+    box = tuple(slice(n.min(), n.max() + 1) for n in nonzero)
+    cropped = data[box]
+    zoom = [float(s) / c for s, c in zip(shape, cropped.shape)]
+    thumb = ndimage.zoom(cropped, zoom, order=1)
+    # zoom may be off by a voxel from rounding
+    thumb = np.pad(thumb, [(0, max(0, s - t)) for s, t in
+                           zip(shape, thumb.shape)], mode='constant')
+    thumb = thumb[tuple(slice(0, s) for s in shape)].ravel()
+    thumb -= thumb.mean()
+    std = thumb.std()
+    if std > 0:
+        thumb /= std
+    return thumb
+
+
+def rank_fa_targets(fa_list, shape=(32, 32, 32)):
+    """Rank FAs as TBSS targets by mean thumbnail correlation to the others.
+
+    The FA most like the rest of the cohort should need the least
+    deformation to reach, so it is ranked first. This is a screen for
+    choosing which targets get the full nonlinear registration, not a
+    replacement for it.
+
+    Parameters
+    ----------
+    fa_list     :   List(File)
+    shape       :   Tuple(Int), thumbnail shape, see fa_thumbnail
+
+    Returns
+    -------
+    order       :   List(Int), indices into fa_list, best first
+    scores      :   List(Float), mean correlation for each FA in fa_list
+    """
+    n = len(fa_list)
+    thumbs = np.empty((n, int(np.prod(shape))), dtype=np.float64)
+    for i, fa_file in enumerate(fa_list):
+        thumbs[i] = fa_thumbnail(fa_file, shape)
+    corr = np.dot(thumbs, thumbs.T) / thumbs.shape[1]
+    if n > 1:
+        scores = (corr.sum(axis=1) - np.diag(corr)) / (n - 1)
+    else:
+        scores = np.ones(n)
+    # stable, so ties keep fa_list order
+    order = np.argsort(-scores, kind='mergesort')
+    return [int(i) for i in order], [float(s) for s in scores]
+
+
+def deformation_stats(field_file):
+    """Mean and median deformation of a FNIRT field, as
+    fslmaths field -sqr -Tmean then fslstats -M -P 50.
+
+    Volumes are read one at a time (memory mapped when uncompressed) and
+    squared into a running sum. The mean and median are over nonzero
+    voxels, like fslstats; the median is numpy's, where fslstats picks a
+    histogram bin, so it may differ slightly.
+
+    Parameters
+    ----------
+    field_file  :   File, 4D NIfTI, e.g. FNIRT fieldcoeff_file
+
+    Returns
+    -------
+    mean_median :   List(Float, Float)
+    """
+    import numpy as np
+    import nibabel as nib
+    img = nib.load(field_file)
+    shape = img.shape[:3]
+    nvols = int(np.prod(img.shape[3:]))
+    dataobj = img.dataobj
+    if nvols > 1:
+        vols = (dataobj[..., t] for t in xrange(nvols))
+    else:
+        vols = (dataobj,)
+    sqr = np.zeros(shape, dtype=np.float64)
+    for vol in vols:
+        vol = np.asanyarray(vol).astype(np.float64).reshape(shape)
+        sqr += np.square(vol)
+    sqr /= nvols
+    nonzero = sqr[sqr != 0]
+    if nonzero.size == 0:
+        return [0.0, 0.0]
+    return [float(nonzero.mean()), float(np.median(nonzero))]
+
+
+def group_stats(in_files, merged_file):
+    """Merge 3D FAs into a masked 4D file, with group mask and mean, in one
+    pass over the inputs, as fslmerge -t, fslmaths -max 0 -Tmin -bin,
+    fslmaths -mas and fslmaths -Tmean.
+
+    Each volume is read once, written to a memory mapped, uncompressed 4D
+    NIfTI, and added to a running sum and running minimum. Voxels outside
+    the group mask are then zeroed in the mapped file.
+
+    Parameters
+    ----------
+    in_files    :   List(File), 3D NIfTI in the same space
+    merged_file :   Str, basename for the 4D file, e.g. all_FA.nii.gz
+
+    Returns
+    -------
+    masked_file :   File, <merged>_masked.nii, 4D, float32
+    mask_file   :   File, <merged>_mask.nii.gz, uint8
+    mean_file   :   File, <merged>_masked_mean.nii.gz, float32
+    """
+    import os
+    import numpy as np
+    import nibabel as nib
+    base = os.path.abspath(os.path.basename(merged_file))
+    for ext in ('.gz', '.nii'):
+        if base.endswith(ext):
+            base = base[:-len(ext)]
+    masked_file = ''.join((base, '_masked.nii'))
+    mask_file = ''.join((base, '_mask.nii.gz'))
+    mean_file = ''.join((base, '_masked_mean.nii.gz'))
+
+    first = nib.load(in_files[0])
+    shape = first.shape[:3]
+    nvols = len(in_files)
+    header = first.header.copy()
+    header.set_data_dtype(np.float32)
+    header.set_data_shape(shape + (nvols,))
+    header.set_slope_inter(None, None)
+    del header.extensions[:]
+    offset = 352
+    header.set_data_offset(offset)
+    with open(masked_file, 'wb') as f:
+        header.write_to(f)
+        f.write(b'\x00' * (offset - f.tell()))
+        f.truncate(offset + 4 * int(np.prod(shape)) * nvols)
+    merged = np.memmap(masked_file, dtype=header.get_data_dtype(),
+                       mode='r+', offset=offset, shape=shape + (nvols,),
+                       order='F')
+
+    total = np.zeros(shape, dtype=np.float64)
+    low = np.empty(shape, dtype=np.float32)
+    for t, in_file in enumerate(in_files):
+        img = nib.load(in_file)
+        if (img.shape[:3] != shape or
+                not np.allclose(img.affine, first.affine, atol=1e-4)):
+            raise ValueError('{} is not in the space of {}'
+                             .format(in_file, in_files[0]))
+        vol = np.asanyarray(img.dataobj).astype(np.float32).reshape(shape)
+        merged[..., t] = vol
+        total += vol
+        if t == 0:
+            np.maximum(vol, 0, out=low)
+        else:
+            np.minimum(low, np.maximum(vol, 0), out=low)
+    mask = low != 0
+    outside = ~mask
+    for t in range(nvols):
+        merged[..., t][outside] = 0
+    merged.flush()
+    del merged
+
+    out_header = first.header.copy()
+    out_header.set_slope_inter(None, None)
+    out_header.set_data_dtype(np.uint8)
+    nib.Nifti1Image(mask.astype(np.uint8), first.affine,
+                    out_header).to_filename(mask_file)
+    out_header.set_data_dtype(np.float32)
+    mean = np.where(mask, total / nvols, 0).astype(np.float32)
+    nib.Nifti1Image(mean, first.affine, out_header).to_filename(mean_file)
+    return masked_file, mask_file, mean_file
+
+
+def mean_image(in_files, out_file):
+    """Write the voxelwise mean of 3D images in the same space, reading one
+    image at a time into a running sum.
+
+    Returns
+    -------
+    out_file    :   File, absolute path, float32
+    """
+    import os
+    import numpy as np
+    import nibabel as nib
+    first = nib.load(in_files[0])
+    shape = first.shape[:3]
+    total = np.zeros(shape, dtype=np.float64)
+    for in_file in in_files:
+        img = nib.load(in_file)
+        if (img.shape[:3] != shape or
+                not np.allclose(img.affine, first.affine, atol=1e-4)):
+            raise ValueError('{} is not in the space of {}'
+                             .format(in_file, in_files[0]))
+        total += np.asanyarray(img.dataobj).reshape(shape)
+    total /= len(in_files)
+    header = first.header.copy()
+    header.set_data_dtype(np.float32)
+    header.set_slope_inter(None, None)
+    out_file = os.path.abspath(out_file)
+    nib.Nifti1Image(total.astype(np.float32), first.affine,
+                    header).to_filename(out_file)
+    return out_file
+
+
 def flatten(s, accepted_types=(list, tuple)):
     """flatten lists and tuples to a single list, ignore empty
     
@@ -1,10 +1,15 @@
 import os
+import copy
 from DINGO.base import (DINGOFlow, DINGONode)
-from DINGO.interfaces.dsistudio import (DSIStudioSource,
+from DINGO.interfaces.dsistudio import (DSIInfo,
+                                        DSIStudioSource,
                                         DSIStudioReconstruct,
                                         DSIStudioTrack,
+                                        DSIStudioBatchTrack,
                                         DSIStudioAnalysis,
-                                        DSIStudioExport)
+                                        DSIStudioExport,
+                                        DSIStudioFibHold,
+                                        DSIStudioFibDrop)
 from DINGO.workflows.utils import (HelperFlow,
                                    TRKnode,
                                    TRKjoinnode)
@@ -21,7 +26,8 @@ class HelperDSI(HelperFlow):
             'DSI_REC':  'DINGO.DSI_Studio',
             'DSI_TRK':  'DINGO.DSI_Studio',
             'DSI_ANA':  'DINGO.DSI_Studio',
-            'DSI_EXP':  'DINGO.DSI_Studio'
+            'DSI_EXP':  'DINGO.DSI_Studio',
+            'DSI_TDI':  'DINGO.workflows.dsistudio'
         }
         super(HelperDSI, self).__init__(workflow_to_module=wfm, **kwargs)
 
@@ -106,6 +112,14 @@ class DSI_REC(DINGONode):
                             'method' : 'dti'},
                     overwrite=False)
     dsi_rec.outputs.fiber_file=mysrcfile.src.gz.dti.fib.gz
+
+    Parameter sweep
+    ---------------
+    inputs['sweep'] : List(Dict), parameter sets overriding the other
+        inputs, e.g. [{'mddr': 1.25}, {'mddr': 1.5, 'num_fiber': 3}].
+        Each set is an iterable of this node, so src and mask are made
+        once, and its fiber file is tagged with DSIInfo.rec_param_tag,
+        e.g. mysrcfile.src.gz.gqi.1.25.fib.gz.gqi1.25_3f9a2c.fib.gz
     """
     
     connection_spec = {
@@ -116,10 +130,106 @@ class DSI_REC(DINGONode):
     def __init__(self, name="DSI_REC", inputs=None, **kwargs):
         if inputs is None:
             inputs = {}
+        if 'sweep' in inputs and inputs['sweep'] is not None:
+            sweep = inputs['sweep']
+            del inputs['sweep']
+        else:
+            sweep = None
         super(DSI_REC, self).__init__(
             name=name,
             interface=DSIStudioReconstruct(**inputs),
             **kwargs)
+        if sweep:
+            self.iterables = ('indict', self.sweep_indicts(inputs, sweep))
+
+    @staticmethod
+    def sweep_indicts(inputs, sweep):
+        """Return indict for each parameter set, with its output_tag"""
+        indicts = []
+        tags = set()
+        for params in sweep:
+            indict = dict(params)
+            full = dict(inputs)
+            full.update(params)
+            if 'method' not in full:
+                raise KeyError('DSI_REC sweep needs a method in inputs or '
+                               'in each parameter set: {}'.format(params))
+            indict['output_tag'] = DSIInfo.rec_param_tag(full['method'],
+                                                         full)
+            if indict['output_tag'] in tags:
+                raise ValueError('DSI_REC sweep repeats parameter set {}'
+                                 .format(params))
+            tags.add(indict['output_tag'])
+            indicts.append(indict)
+        return indicts
+
+
+class DSI_HOLD(DINGONode):
+    """Nipype node to keep the subject's decompressed fib in the fib cache
+    for all its DSI Studio steps, run as soon as DSI_REC made the fib
+
+    Parameters
+    ----------
+    name        :   Str (node name, default 'DSI_HOLD')
+    inputs      :   Dict (DSIStudioFibHold InputName=ParameterValue)
+        'fib_cache_dir' and 'fib_cache_gb' as the steps using fib_cache
+    **kwargs    :   Node InputName=ParameterValue
+
+    Returns
+    -------
+    Nipype node (name=name, interface=DSIStudioFibHold(**inputs), **kwargs)
+        rerun every time, so a rerun of the subject holds the fib again
+
+    Example
+    -------
+    "steps": ["DSI_REC", "DSI_HOLD", "DSI_TRK", "DSI_Merge", "DSI_DROP"],
+    "method": {"DSI_DROP": {"connect": {"after": ["DSI_Merge",
+                                                  "merged_files"]}}}
+    """
+
+    connection_spec = {
+        'fib_file': ['DSI_REC', 'fiber_file']
+    }
+
+    def __init__(self, name='DSI_HOLD', inputs=None, **kwargs):
+        if inputs is None:
+            inputs = {}
+        kwargs.setdefault('overwrite', True)
+        super(DSI_HOLD, self).__init__(
+            name=name,
+            interface=DSIStudioFibHold(**inputs),
+            **kwargs)
+
+
+class DSI_DROP(DINGONode):
+    """Nipype node to remove the subject's decompressed fib from the fib
+    cache, run after the step connected to 'after', which should be the
+    subject's last DSI Studio step (after any join over tracts)
+
+    Parameters
+    ----------
+    name        :   Str (node name, default 'DSI_DROP')
+    inputs      :   Dict (DSIStudioFibDrop InputName=ParameterValue)
+        'evict' : Bool, remove the copy if unused (default True)
+    **kwargs    :   Node InputName=ParameterValue
+
+    Returns
+    -------
+    Nipype node (name=name, interface=DSIStudioFibDrop(**inputs), **kwargs)
+    """
+
+    connection_spec = {
+        'fib_file': ['DSI_HOLD', 'fib_file']
+    }
+
+    def __init__(self, name='DSI_DROP', inputs=None, **kwargs):
+        if inputs is None:
+            inputs = {}
+        kwargs.setdefault('overwrite', True)
+        super(DSI_DROP, self).__init__(
+            name=name,
+            interface=DSIStudioFibDrop(**inputs),
+            **kwargs)
 
 
 class DSI_TRK(DINGOFlow):
@@ -134,6 +244,19 @@ class DSI_TRK(DINGOFlow):
     inputs      :   Dict Track Node InputName=ParameterValue
         (Inputs['tracts'] is used specially as an iterable, other params
         will apply to each tract)
+        Inputs['batch'] : Bool, track all tracts of a fiber file in one
+            node, decompressing it once, instead of iterating over tracts.
+            trknode outputs are then lists, in the order of tract_names
+        Inputs['batch_n_procs'] : Int, tracts run at the same time in batch
+        Inputs['fib_cache'] : Bool, track from a decompressed copy of the fib
+            in a scratch cache shared with other DSI Studio steps, see
+            DINGO.cache.FibCache (also 'fib_cache_dir', 'fib_cache_gb',
+            'fib_cache_evict'), DSI_HOLD and DSI_DROP keep it from DSI_REC
+            to the subject's last DSI Studio step
+        Inputs['roa_cache'] : Directory, keep unions of more than 5 roas
+            there by roa set, so they are made once
+        Inputs['region_index'] : Dict or json File, region index as made by
+            DINGO.utils.build_region_index, used instead of regions
     **kwargs    :   Workflow InputName=ParameterValue
         any unspecified tractography parameters will be defaults of DSIStudioTrack
                     
@@ -157,24 +280,55 @@ class DSI_TRK(DINGOFlow):
     
     connection_spec = {
         'fib_file': ['DSI_REC', 'fiber_file'],
-        'regions':  ['FileIn_SConfig', 'regions']
+        'regions':  ['FileInSConfig', 'regions']
     }
 
     def __init__(self, name="DSI_TRK", inputs=None, **kwargs):
         if inputs is None:
             inputs = {}
+        # keys are removed and tracts updated below, leave the caller's alone
+        inputs = copy.deepcopy(inputs)
         
         super(DSI_TRK, self).__init__(name=name, **kwargs)
-        
+
+        if 'batch' in inputs and inputs['batch'] is not None:
+            batch = inputs['batch']
+            del inputs['batch']
+        else:
+            batch = False
+        if 'batch_n_procs' in inputs and inputs['batch_n_procs'] is not None:
+            batch_n_procs = inputs['batch_n_procs']
+            del inputs['batch_n_procs']
+        else:
+            batch_n_procs = 1
+        # one tract gains nothing from batching
+        batch = batch and 'tracts' in inputs
+        if 'roa_cache' in inputs and inputs['roa_cache'] is not None:
+            roa_cache = inputs['roa_cache']
+            del inputs['roa_cache']
+        else:
+            roa_cache = None
+
         # Parse inputs
         inputnode = pe.Node(
             name='inputnode',
             interface=IdentityInterface(
                 fields=[
                     'fib_file',
+                    'regions',
+                    'region_index']))
+        if 'region_index' in inputs and inputs['region_index'] is not None:
+            inputnode.inputs.region_index = inputs['region_index']
+            del inputs['region_index']
+
+        # tract iterables are kept apart from inputnode, so that nodes
+        # needing only subject inputs, like index_regions, run once
+        tractsource = pe.Node(
+            name='tractsource',
+            interface=IdentityInterface(
+                fields=[
                     'tract_names', 
-                    'tract_inputs', 
-                    'regions']))
+                    'tract_inputs']))
         
         if 'tracts' not in inputs:
             if 'rois' not in inputs:
@@ -183,7 +337,7 @@ class DSI_TRK(DINGOFlow):
                     'CANNOT TRACK! Neither "tracts" nor "rois" in inputs.')
             else:
                 # config specifies one tract
-                inputnode.inputs.tract_inputs = inputs
+                tractsource.inputs.tract_inputs = inputs
         else:
             # config specifies one or more tracts
             # Get universal params, but where overlap want to use tract specific
@@ -195,75 +349,122 @@ class DSI_TRK(DINGOFlow):
                     if k not in inputs['tracts'][tract]:
                         inputs['tracts'][tract].update({k: v})
 
-            inputnode.iterables = [
-                ('tract_names', inputs['tracts'].keys()),
-                ('tract_inputs', inputs['tracts'].values())]
-            inputnode.synchronize = True
+            if batch:
+                tractsource.inputs.tract_names = inputs['tracts'].keys()
+                tractsource.inputs.tract_inputs = inputs['tracts'].values()
+            else:
+                tractsource.iterables = [
+                    ('tract_names', inputs['tracts'].keys()),
+                    ('tract_inputs', inputs['tracts'].values())]
+                tractsource.synchronize = True
+
+        # Index the subject's region files once for all tracts
+        index_regions = pe.Node(
+            name='index_regions',
+            interface=Function(
+                input_names=['regions', 'region_index'],
+                output_names=['region_index'],
+                function=self.index_regions))
             
         # Substitute region names for actual region files
-        replace_regions = TRKnode(
-            name='replace_regions',
-            interface=Function(
-                input_names=['tract_input', 'regions'],
-                output_names=['real_region_tract_input'],
-                function=self.replace_regions))
+        replace_regions_interface = Function(
+            input_names=['tract_input', 'region_index'],
+            output_names=['real_region_tract_input'],
+            function=self.replace_regions)
+        if batch:
+            replace_regions = pe.MapNode(
+                name='replace_regions',
+                interface=replace_regions_interface,
+                iterfield=['tract_input'])
+        else:
+            replace_regions = TRKnode(
+                name='replace_regions',
+                interface=replace_regions_interface)
         
         cfg = dict(execution={'remove_unnecessary_outputs': False})
         config.update_config(cfg)
         # DSI Studio will only accept 5 ROIs or 5 ROAs. A warning would
         # normally be shown that only the first five listed will be used,
         # but merging the ROAs is viable.
-        merge_roas = self.create_merge_roas(name='merge_roas')
-
-        trknode = TRKnode(
-            name='trknode',
-            interface=DSIStudioTrack())
+        merge_roas = self.create_merge_roas(name='merge_roas', batch=batch,
+                                            roa_cache=roa_cache)
+
+        if batch:
+            trknode = TRKnode(
+                name='trknode',
+                interface=DSIStudioBatchTrack(n_procs=batch_n_procs))
+            for key in ('fib_cache', 'fib_cache_dir', 'fib_cache_gb',
+                        'fib_cache_evict'):
+                if key in inputs and inputs[key] is not None:
+                    setattr(trknode.inputs, key, inputs[key])
+            trk_fields = [('fib_file', 'source'),
+                          ('tract_names', 'tract_names')]
+            indict = 'tract_inputs'
+        else:
+            trknode = TRKnode(
+                name='trknode',
+                interface=DSIStudioTrack())
+            trk_fields = [('fib_file', 'source'),
+                          ('tract_names', 'tract_name')]
+            indict = 'indict'
             
         self.connect([
-            (inputnode, trknode, 
-                [('fib_file', 'source'),
-                 ('tract_names', 'tract_name')]),
-            (inputnode, replace_regions, 
-                [('tract_inputs', 'tract_input'),
-                 ('regions', 'regions')]),
-            (inputnode, merge_roas,
+            (inputnode, trknode, trk_fields[:1]),
+            (tractsource, trknode, trk_fields[1:]),
+            (inputnode, index_regions,
+                [('regions', 'regions'),
+                 ('region_index', 'region_index')]),
+            (index_regions, replace_regions,
+                [('region_index', 'region_index')]),
+            (tractsource, replace_regions, 
+                [('tract_inputs', 'tract_input')]),
+            (tractsource, merge_roas,
                 [('tract_names', 'inputnode.tract_name')]),
             (replace_regions, merge_roas,
                 [('real_region_tract_input', 'inputnode.tract_input')]),
             (merge_roas, trknode, 
-                [('outputnode.mroas_tract_input', 'indict')])
+                [('outputnode.mroas_tract_input', indict)])
         ])
             
-    def replace_regions(tract_input=None, regions=None):
+    def index_regions(regions=None, region_index=None):
+        """Return index of the region files for replace_regions, or the
+        given region_index (Dict or json File) if there is one"""
+        import json
+        from DINGO.utils import build_region_index
+        if region_index is not None:
+            if not isinstance(region_index, dict):
+                with open(region_index, 'r') as f:
+                    region_index = json.load(f)
+            return region_index
+        if regions is None:
+            return None
+        if not isinstance(regions, (list, tuple)):
+            regions = [regions]
+        return build_region_index(regions)
+
+    def replace_regions(tract_input=None, region_index=None):
         """Return the right regions needed by tract_input"""
-        import re
-        if regions is not None:
+        from DINGO.utils import lookup_region
+        if region_index is not None:
             # without per subject region list the analysis config must have
             # filepaths for region lists, thus can only work in one space
             region_types = ('rois', 'roas', 'seed', 'ends', 'ter')
             for reg_type in region_types:
                 if reg_type in tract_input:
                     regionname_list = tract_input[reg_type]
-                    region_files = []
-                    for regionname in regionname_list:
-                        # match pattern preceded by '\' or '_' or '/'
-                        pattern = ''.join(('(?<=[\\\\_\/])', regionname))
-                        found = False
-                        for realregion in regions:  # realregion is a filepath
-                            if re.search(pattern, realregion, flags=re.IGNORECASE):
-                                region_files.append(realregion)
-                                found = True
-                                break
-                        if not found:
-                            raise Exception('{} not found in region file list'
-                                            .format(regionname))
-                    if len(region_files) != len(regionname_list):
-                        raise Exception('Incorrect number of regions found')
+                    if not isinstance(regionname_list, list):
+                        regionname_list = [regionname_list]
+                    # match name preceded by '\' or '_' or '/'
+                    region_files = [lookup_region(region_index, regionname)
+                                    for regionname in regionname_list]
                     tract_input.update({reg_type: region_files})
         return tract_input
                                 
-    def create_merge_roas(self, name='merge_roas'):
-        """Create nipype workflow that will merge roas in tract_input"""
+    def create_merge_roas(self, name='merge_roas', batch=False,
+                          roa_cache=None):
+        """Create nipype workflow that will merge roas in tract_input,
+        for each of a list of tract_inputs and tract_names if batch.
+        Merged roas are kept in roa_cache by roa set, if given."""
         merge = pe.Workflow(name=name)
         
         inputnode = pe.Node(
@@ -272,42 +473,34 @@ class DSI_TRK(DINGOFlow):
                 fields=['tract_input', 'tract_name']),
             mandatory_inputs=True)
             
-        def merge_roas(tract_input, tract_name):
+        def merge_roas(tract_input, tract_name, roa_cache=None):
             """Function to merge roas into one image, used as node"""
-            from DINGO.workflows.dsistudio import TRKnode
-            import nipype.interfaces.fsl as fsl
-            import os
+            from DINGO.utils import union_masks
             if 'roas' in tract_input and len(tract_input['roas']) > 5:
                 roa_list = tract_input['roas']
                 if not isinstance(roa_list, list):
                     roa_list = [roa_list]
                 merged_filename = ''.join((tract_name, '_mergedroas', '.nii.gz'))
-                
-                mergenode = TRKnode(
-                    base_dir=os.getcwd(),
-                    name='mergenode',
-                    interface=fsl.Merge(in_files=roa_list, 
-                                        merged_file=merged_filename,
-                                        dimension='t'))
-                merge_result = mergenode.run()
-                mroas = merge_result.outputs.merged_file
-                
-                maxnode = TRKnode(
-                    base_dir=os.getcwd(),
-                    name='maxnode',
-                    interface=fsl.ImageMaths(in_file=mroas, op_string='-Tmax'))
-                max_result = maxnode.run()
-                mmroas = max_result.outputs.out_file
+                mmroas = union_masks(roa_list, merged_filename,
+                                     cache_dir=roa_cache)
                 tract_input.update({'roas': mmroas})
             # Unsure if nipype function copies or passes dicts, to be safe returning it
             return tract_input
             
-        merge_roas_node = TRKnode(
-            name='merge_roas',
-            interface=Function(
-                input_names=['tract_input', 'tract_name'],
-                output_names=['mroas_tract_input'],
-                function=merge_roas))
+        merge_roas_interface = Function(
+            input_names=['tract_input', 'tract_name', 'roa_cache'],
+            output_names=['mroas_tract_input'],
+            function=merge_roas)
+        merge_roas_interface.inputs.roa_cache = roa_cache
+        if batch:
+            merge_roas_node = pe.MapNode(
+                name='merge_roas',
+                interface=merge_roas_interface,
+                iterfield=['tract_input', 'tract_name'])
+        else:
+            merge_roas_node = TRKnode(
+                name='merge_roas',
+                interface=merge_roas_interface)
             
         outputnode = pe.Node(
             name='outputnode',
@@ -372,6 +565,16 @@ class DSI_ANAnode(DINGONode):
 
 class DSI_Merge(DINGOFlow):
     """Nipype workflow to merge tracts with specified names
+
+    Parameters
+    ----------
+    name    :   Str (workflow name, default 'DSI_Merge')
+    inputs  :   Dict
+        tracts          :   Dict {new_tract_name: [tract_name, ...]}
+        merge_format    :   'txt' (default) convert each tract to txt with
+            DSIStudioAnalysis(**inputs) and merge lines, or 'trk' to merge
+            DSI_TRK .trk/.trk.gz outputs directly, no conversion
+        req_join        :   Bool, join tract_list over the setup inputs
     """
     inputnode = 'inputnode'
     outputnode = 'outputnode'
@@ -394,6 +597,17 @@ class DSI_Merge(DINGOFlow):
         else:
             req_join = False
 
+        if 'merge_format' in inputs and inputs['merge_format'] is not None:
+            merge_format = inputs['merge_format']
+            del inputs['merge_format']
+        else:
+            merge_format = 'txt'
+        if merge_format not in ('txt', 'trk'):
+            raise ValueError('DSI_Merge merge_format must be txt or trk, not {}'
+                             .format(merge_format))
+        # source is only needed to convert tracts
+        mandatory_inputs = merge_format == 'txt'
+
         if req_join:
             inputnode = TRKjoinnode(
                 name='inputnode',
@@ -402,7 +616,7 @@ class DSI_Merge(DINGOFlow):
                             'tract_names',
                             'tracts2merge',
                             'source']),
-                mandatory_inputs=True,
+                mandatory_inputs=mandatory_inputs,
                 joinsource=self.setup_inputs,
                 joinfield=['tract_list'])
         else:
@@ -413,7 +627,7 @@ class DSI_Merge(DINGOFlow):
                             'tract_names',
                             'tracts2merge',
                             'source']),
-                mandatory_inputs=True)
+                mandatory_inputs=mandatory_inputs)
 
         if 'source' in inputs and inputs['source'] is not None:
             inputnode.inputs.source = inputs['source']
@@ -434,11 +648,10 @@ class DSI_Merge(DINGOFlow):
                 output_names=['tract_files'],
                 function=self.replace_tracts))
 
-        convertnode = pe.MapNode(
-            name='convertnode',
-            interface=DSIStudioAnalysis(**inputs),
-            iterfield=['tract'])
-
+        if merge_format == 'trk':
+            merge_function = self.merge_trk
+        else:
+            merge_function = self.merge_tracts
         mergenode = TRKnode(
             name='merge_tracts',
             base_dir=os.getcwd(),
@@ -447,7 +660,7 @@ class DSI_Merge(DINGOFlow):
                              'tracts2merge',
                              'new_tract_name'],
                 output_names=['merged_file'],
-                function=self.merge_tracts))
+                function=merge_function))
 
         outputnode = TRKnode(
             name='outputnode',
@@ -457,13 +670,24 @@ class DSI_Merge(DINGOFlow):
         self.connect([
             (inputnode, replace_tracts, [('tract_list', 'tract_list'),
                                          ('tracts2merge', 'tracts2merge')]),
-            (inputnode, convertnode, [('source', 'source')]),
             (inputnode, mergenode, [('tract_names', 'new_tract_name'),
                                     ('tracts2merge', 'tracts2merge')]),
-            (replace_tracts, convertnode, [('tract_files', 'tract')]),
-            (convertnode, mergenode, [('output', 'file_list')]),
             (mergenode, outputnode, [('merged_file', 'merged_files')])
         ])
+        if merge_format == 'trk':
+            self.connect([
+                (replace_tracts, mergenode, [('tract_files', 'file_list')])
+            ])
+        else:
+            convertnode = pe.MapNode(
+                name='convertnode',
+                interface=DSIStudioAnalysis(**inputs),
+                iterfield=['tract'])
+            self.connect([
+                (inputnode, convertnode, [('source', 'source')]),
+                (replace_tracts, convertnode, [('tract_files', 'tract')]),
+                (convertnode, mergenode, [('output', 'file_list')])
+            ])
 
     def replace_tracts(tract_list, tracts2merge):
         """Return the real tract files from the tract list
@@ -523,6 +747,179 @@ class DSI_Merge(DINGOFlow):
             merged_file = None
         return merged_file
 
+    def merge_trk(file_list=None, tracts2merge=None, new_tract_name=None):
+        """Accept tract files in '.trk' or '.trk.gz' format, with the same
+        geometry. Return merged '.trk.gz', bodies are copied as they are"""
+        import os
+        import gzip
+        import shutil
+        import numpy as np
+        from DINGO.streamlines import read_trk_header, trk_header_dtype
+        if file_list is None:
+            return None
+        if not isinstance(file_list, (list, tuple)):
+            file_list = [file_list]
+        hdr_size = trk_header_dtype.itemsize
+        geometry = ('dim', 'voxel_size', 'vox_to_ras', 'voxel_order',
+                    'n_scalars', 'n_properties')
+
+        def open_trk(fname):
+            if fname.endswith('.trk.gz'):
+                return gzip.open(fname, 'rb')
+            elif fname.endswith('.trk'):
+                return open(fname, 'rb')
+            raise ValueError('Cannot merge {} as trk'.format(fname))
+
+        files = [open_trk(fname) for fname in file_list]
+        try:
+            headers = []
+            for fname, f in zip(file_list, files):
+                header, dtype = read_trk_header(f.read(hdr_size))
+                if dtype != trk_header_dtype:
+                    raise ValueError('Cannot merge big endian trk {}'
+                                     .format(fname))
+                for field in geometry:
+                    if headers and not np.array_equal(header[field],
+                                                      headers[0][field]):
+                        raise ValueError('{} of {} differs from {}'
+                                         .format(field, fname, file_list[0]))
+                headers.append(header)
+            merged = headers[0].copy()
+            counts = [int(h['n_count']) for h in headers]
+            # 0 means the count is unknown, so is the sum
+            merged['n_count'] = 0 if 0 in counts else sum(counts)
+
+            basename = os.path.basename(file_list[0])
+            old = tracts2merge[
+                [tract in basename for tract in tracts2merge]
+                .index(True)]
+            merged_filename = basename.replace(old, new_tract_name)
+            if merged_filename.endswith('.trk'):
+                merged_filename = ''.join((merged_filename, '.gz'))
+            merged_file = os.path.abspath(merged_filename)
+            tmp = ''.join((merged_file, '.part'))
+            out = gzip.open(tmp, 'wb')
+            try:
+                out.write(merged.tobytes())
+                for f in files:
+                    shutil.copyfileobj(f, out, 16 * 1024 * 1024)
+            finally:
+                out.close()
+            os.rename(tmp, merged_file)
+        finally:
+            for f in files:
+                f.close()
+        return merged_file
+
+
+class DSI_TDI(DINGOFlow):
+    """Nipype workflow to make track density images from trk files in
+    python, without DSI Studio reloading the fib for each tract
+
+    Parameters
+    ----------
+    name    :   Str (workflow name, default 'DSI_TDI')
+    inputs  :   Dict
+        reference       :   File, fib or NIfTI whose grid the trk points
+            are in (usually connected from DSI_REC fiber_file). Images are
+            written as DSI Studio exports of a fib, or in the grid and
+            affine of a NIfTI, see streamlines.reference_geometry
+        endpoints       :   Bool, make endpoint density images (default True)
+        masks           :   Bool, make binary tract masks (default True)
+        mask_threshold  :   Int, min streamlines in a voxel for the mask
+            (default 1)
+
+    Outputs
+    -------
+    tdinode.tdi_files
+    tdinode.end_files
+    tdinode.mask_files
+    """
+    inputnode = 'inputnode'
+    outputnode = 'tdinode'
+
+    connection_spec = {
+        'tract_list': ['DSI_TRK', 'output'],
+        'reference': ['DSI_REC', 'fiber_file']
+    }
+
+    def __init__(self, name='DSI_TDI', inputs=None, **kwargs):
+        if inputs is None:
+            inputs = {}
+        super(DSI_TDI, self).__init__(name=name, **kwargs)
+
+        inputnode = TRKnode(
+            name='inputnode',
+            interface=IdentityInterface(
+                fields=['tract_list', 'reference']),
+            mandatory_inputs=True)
+        if 'reference' in inputs and inputs['reference'] is not None:
+            inputnode.inputs.reference = inputs['reference']
+        if 'tract_list' in inputs and inputs['tract_list'] is not None:
+            inputnode.inputs.tract_list = inputs['tract_list']
+
+        tdinode = TRKnode(
+            name='tdinode',
+            interface=Function(
+                input_names=['tract_list', 'reference', 'endpoints',
+                             'masks', 'mask_threshold'],
+                output_names=['tdi_files', 'end_files', 'mask_files'],
+                function=self.tract_images))
+        tdinode.inputs.endpoints = True
+        tdinode.inputs.masks = True
+        tdinode.inputs.mask_threshold = 1
+        for key in ('endpoints', 'masks', 'mask_threshold'):
+            if key in inputs and inputs[key] is not None:
+                setattr(tdinode.inputs, key, inputs[key])
+
+        self.connect([
+            (inputnode, tdinode, [('tract_list', 'tract_list'),
+                                  ('reference', 'reference')])
+        ])
+
+    def tract_images(tract_list, reference, endpoints=True, masks=True,
+                     mask_threshold=1):
+        """Write track density, endpoint density and mask NIfTIs for each
+        trk in tract_list, named after it. Returns lists in tract order,
+        end_files/mask_files are None if not made."""
+        import os
+        import numpy as np
+        import nibabel as nib
+        from DINGO.utils import split_filename
+        from DINGO.streamlines import (read_trk, reference_geometry,
+                                       to_reference, density,
+                                       endpoint_density)
+        if not isinstance(tract_list, (list, tuple)):
+            tract_list = [tract_list]
+        dim, voxel_size, affine, ornt = reference_geometry(reference)
+
+        def save(data, tract, suffix):
+            _, base, _ = split_filename(tract)
+            fname = os.path.abspath(''.join((base, suffix, '.nii.gz')))
+            nib.Nifti1Image(to_reference(data, ornt), affine).to_filename(
+                fname)
+            return fname
+
+        tdi_files = []
+        end_files = []
+        mask_files = []
+        for tract in tract_list:
+            streamlines = read_trk(tract)
+            tdi = density(streamlines, dim, voxel_size)
+            tdi_files.append(save(tdi.astype(np.int32), tract, '.tdi'))
+            if endpoints:
+                end = endpoint_density(streamlines, dim, voxel_size)
+                end_files.append(save(end.astype(np.int32), tract,
+                                      '.tdi_end'))
+            if masks:
+                mask = (tdi >= mask_threshold).astype(np.uint8)
+                mask_files.append(save(mask, tract, '.mask'))
+        if not endpoints:
+            end_files = None
+        if not masks:
+            mask_files = None
+        return tdi_files, end_files, mask_files
+
 
 class DSI_EXP(DINGONode):
     """Nipype node to run DSIStudioAnalysis
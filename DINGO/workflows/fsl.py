@@ -1,10 +1,12 @@
 import os
 from warnings import warn
 from DINGO.base import DINGO, DINGOFlow, DINGONode
-from DINGO.utils import (join_strs)
+from DINGO.utils import (join_strs,
+                         deformation_stats as deformation_stats_func,
+                         group_stats as group_stats_func)
 
 from nipype import (IdentityInterface, Function, config)
-from nipype.interfaces.utility import Select
+from nipype.interfaces.utility import Select, Merge
 from nipype.interfaces import fsl
 import nipype.pipeline.engine as pe
 from nipype.workflows.dmri.fsl import tbss
@@ -29,6 +31,8 @@ class HelperFSL(DINGO):
             'TBSSPreReg':   'DINGO.workflows.fsl',
             'TBSSRegNXN':   'DINGO.workflows.fsl',
             'TBSSPostReg':  'DINGO.workflows.fsl',
+            'TemplateBuild':    'DINGO.workflows.fsl',
+            'WarpRegions':  'DINGO.workflows.fsl',
         }
         
         super(HelperFSL, self).__init__(workflow_to_module=wfm, **kwargs)
@@ -177,6 +181,20 @@ class FNIRT(DINGONode):
         
         
 class ApplyWarp(DINGOFlow):
+    """
+    Parameters
+    ----------
+    name    :   Str, workflow name
+    inputs  :   Dict, fsl.ApplyWarp inputs, and
+        iterfield   :   Str or List(Str), MapNode iterfield, default 'in_file'
+        batch       :   Bool, default False, in_file is a list of images
+            sharing field_file and ref_file. Images with the same shape,
+            affine and data type are stacked to 4D and warped by one
+            applywarp, so the field is read once per group instead of once
+            per image. out_file is the list of warped images, in in_file
+            order, named as fsl.ApplyWarp would, each in its own _warp<i>
+            directory as a MapNode would, so equal basenames do not clash.
+    """
     
     inputnode = 'warpnode'
     outputnode = 'warpnode'
@@ -194,13 +212,114 @@ class ApplyWarp(DINGOFlow):
             del inputs['iterfield']
         else:
             iterfield = 'in_file'
+        if 'batch' in inputs:
+            batch = inputs['batch']
+            del inputs['batch']
+        else:
+            batch = False
             
-        warpnode = pe.MapNode(
-            name='warpnode',
-            interface=fsl.ApplyWarp(**inputs),
-            iterfield=iterfield)
+        if batch:
+            warpnode = pe.Node(
+                name='warpnode',
+                interface=Function(
+                    input_names=['in_file', 'ref_file', 'field_file',
+                                 'premat', 'postmat', 'options'],
+                    output_names=['out_file'],
+                    function=ApplyWarp.batch_applywarp))
+            for k in ('ref_file', 'field_file', 'premat', 'postmat'):
+                if k in inputs:
+                    setattr(warpnode.inputs, k, inputs[k])
+                    del inputs[k]
+                else:
+                    setattr(warpnode.inputs, k, None)
+            warpnode.inputs.options = inputs
+        else:
+            warpnode = pe.MapNode(
+                name='warpnode',
+                interface=fsl.ApplyWarp(**inputs),
+                iterfield=iterfield)
         self.add_nodes([warpnode])
         
+    def batch_applywarp(in_file, ref_file, field_file, premat=None,
+                        postmat=None, options=None):
+        """Warp a list of images with one applywarp per group of images that
+        share shape, affine and data type. Return warped images in order,
+        the i-th as _warp<i>/<basename>_warp<ext>."""
+        import os
+        import numpy as np
+        import nibabel as nib
+        from nipype.interfaces import fsl
+        from nipype.utils.filemanip import split_filename
+        from DINGO.interfaces.io import makedirs
+        
+        if isinstance(in_file, basestring):
+            in_file = [in_file]
+        if options is None:
+            options = {}
+        ext = fsl.Info.output_type_to_ext(fsl.Info.output_type())
+        out_files = []
+        groups = []  # [key, [indices]]
+        for i, afile in enumerate(in_file):
+            _, base, _ = split_filename(afile)
+            out_dir = os.path.abspath('_warp{:d}'.format(i))
+            makedirs(out_dir)
+            out_files.append(os.path.join(out_dir,
+                                          ''.join((base, '_warp', ext))))
+            img = nib.load(afile)
+            if len(img.shape) > 3 and img.shape[3] > 1:
+                # already 4D, warp on its own
+                groups.append([None, [i]])
+                continue
+            key = (img.shape[:3],
+                   tuple(np.round(img.affine, 4).ravel()),
+                   img.get_data_dtype().str)
+            for group in groups:
+                if group[0] == key:
+                    group[1].append(i)
+                    break
+            else:
+                groups.append([key, [i]])
+        
+        def applywarp(afile, out_file):
+            warp = fsl.ApplyWarp(
+                in_file=afile,
+                ref_file=ref_file,
+                field_file=field_file,
+                out_file=out_file,
+                **options)
+            if premat is not None:
+                warp.inputs.premat = premat
+            if postmat is not None:
+                warp.inputs.postmat = postmat
+            return warp.run().outputs.out_file
+        
+        for n, (key, indices) in enumerate(groups):
+            if len(indices) == 1:
+                applywarp(in_file[indices[0]], out_files[indices[0]])
+                continue
+            first = nib.load(in_file[indices[0]])
+            stack = np.stack(
+                [np.asanyarray(nib.load(in_file[i]).dataobj)
+                 .reshape(first.shape[:3]) for i in indices], axis=-1)
+            header = first.header.copy()
+            header.set_data_shape(stack.shape)
+            stacked = os.path.abspath('batch{:d}{}'.format(n, ext))
+            nib.Nifti1Image(stack, first.affine, header).to_filename(stacked)
+            warped = nib.load(applywarp(
+                stacked, os.path.abspath('batch{:d}_warp{}'.format(n, ext))))
+            data = np.asanyarray(warped.dataobj)
+            for t, i in enumerate(indices):
+                vol = data[..., t]
+                header = warped.header.copy()
+                header.set_data_shape(vol.shape)
+                nib.Nifti1Image(vol, warped.affine, header).to_filename(
+                    out_files[i])
+            del warped, data
+            os.remove(stacked)
+            os.remove(os.path.abspath('batch{:d}_warp{}'.format(n, ext)))
+        
+        return out_files
+        
         
 class FSLNonLinReg(DINGOFlow):
     inputnode = 'inputnode'
@@ -218,6 +337,20 @@ class FSLNonLinReg(DINGOFlow):
                      fnirtopts={'fieldcoeff_file': True}),
                  **kwargs):
         """
+        Parameters
+        ----------
+        inputs  :   Dict
+            FA          :   Bool, use FA_2_FMRIB58_1mm.cnf for FNIRT
+            flirtopts   :   Dict, fsl.FLIRT inputs
+            fnirtopts   :   Dict, fsl.FNIRT inputs
+            multires    :   Bool, default False, run FLIRT on block-averaged
+                in_file and ref_file (cached per image, see
+                DINGO.registration.pyramid_level) and correct its matrix to
+                full resolution, then FNIRT with a subsampling schedule from
+                DINGO.registration.FNIRT_PRESETS for the ref_file size.
+                fnirtopts override the preset.
+            pyramid_cache   :   Directory, for multires levels
+        
         Inputs
         ------
         inputnode.in_file
@@ -265,17 +398,109 @@ class FSLNonLinReg(DINGOFlow):
             name='outputnode',
             interface=IdentityInterface(
                 fields=['affine_file', 'field_file']))
+        
+        if 'multires' in inputs and inputs['multires']:
+            if 'pyramid_cache' in inputs:
+                pyramid_cache = inputs['pyramid_cache']
+            else:
+                pyramid_cache = None
+            preset_fields = ['subsampling_scheme', 'max_nonlin_iter',
+                             'in_fwhm', 'ref_fwhm', 'regularization_lambda']
+            preset = pe.Node(
+                name='preset',
+                interface=Function(
+                    input_names=['ref_file'],
+                    output_names=['factor'] + preset_fields,
+                    function=FSLNonLinReg.multires_preset))
+            
+            coarsein = pe.Node(
+                name='coarsein',
+                interface=Function(
+                    input_names=['in_file', 'factor', 'cache_dir'],
+                    output_names=['out_file'],
+                    function=FSLNonLinReg.pyramid))
+            coarsein.inputs.cache_dir = pyramid_cache
+            
+            coarseref = pe.Node(
+                name='coarseref',
+                interface=Function(
+                    input_names=['in_file', 'factor', 'cache_dir'],
+                    output_names=['out_file'],
+                    function=FSLNonLinReg.pyramid))
+            coarseref.inputs.cache_dir = pyramid_cache
+            
+            finemat = pe.Node(
+                name='finemat',
+                interface=Function(
+                    input_names=['coarse_mat', 'in_file', 'ref_file',
+                                 'factor'],
+                    output_names=['out_matrix_file'],
+                    function=FSLNonLinReg.fine_matrix))
+            
+            self.connect([
+                (inputnode, preset, [('ref_file', 'ref_file')]),
+                (inputnode, coarsein, [('in_file', 'in_file')]),
+                (inputnode, coarseref, [('ref_file', 'in_file')]),
+                (preset, coarsein, [('factor', 'factor')]),
+                (preset, coarseref, [('factor', 'factor')]),
+                (coarsein, flirt, [('out_file', 'in_file')]),
+                (coarseref, flirt, [('out_file', 'reference')]),
+                (flirt, finemat, [('out_matrix_file', 'coarse_mat')]),
+                (inputnode, finemat, [('in_file', 'in_file'),
+                                      ('ref_file', 'ref_file')]),
+                (preset, finemat, [('factor', 'factor')])
+                ])
+            preset_conns = [(f, f) for f in preset_fields
+                            if f not in fnirtopts]
+            if len(preset_conns) > 0:
+                self.connect([(preset, fnirt, preset_conns)])
+            affine = (finemat, 'out_matrix_file')
+        else:
+            self.connect(inputnode, 'in_file', flirt, 'in_file')
+            self.connect(inputnode, 'ref_file', flirt, 'reference')
+            affine = (flirt, 'out_matrix_file')
                     
-        self.connect(inputnode, 'in_file', flirt, 'in_file')
-        self.connect(inputnode, 'ref_file', flirt, 'reference')
         self.connect(inputnode, 'in_file', fnirt, 'in_file')
         self.connect(inputnode, 'ref_file', fnirt, 'ref_file')
-        self.connect(flirt, 'out_matrix_file', fnirt, 'affine_file')
-        self.connect(flirt, 'out_matrix_file', outputnode, 'affine_file')
+        self.connect(affine[0], affine[1], fnirt, 'affine_file')
+        self.connect(affine[0], affine[1], outputnode, 'affine_file')
         self.connect(fnirt, 'fieldcoeff_file', outputnode, 'field_file')
         
+    def multires_preset(ref_file):
+        """Return coarse affine factor and FNIRT schedule for ref_file"""
+        from DINGO.registration import fnirt_preset
+        factor, opts = fnirt_preset(ref_file)
+        return (factor,
+                opts['subsampling_scheme'],
+                opts['max_nonlin_iter'],
+                opts['in_fwhm'],
+                opts['ref_fwhm'],
+                opts['regularization_lambda'])
+    
+    def pyramid(in_file, factor, cache_dir=None):
+        """Return in_file block-averaged by factor, cached"""
+        from DINGO.registration import pyramid_level
+        return pyramid_level(in_file, factor, cache_dir)
+    
+    def fine_matrix(coarse_mat, in_file, ref_file, factor):
+        """Correct a FLIRT matrix between pyramid levels to full resolution"""
+        from DINGO.registration import coarse_to_fine_matrix
+        return coarse_to_fine_matrix(coarse_mat, in_file, ref_file, factor)
+        
         
 class TBSSPreReg(DINGOFlow):
+    """
+    Parameters
+    ----------
+    name            :   Str, workflow name
+    req_join        :   Bool, join fa_list over setup_inputs iterables
+    inputs          :   Dict
+        verify_index    :   File, cohort index written by a FileOut with a
+            manifest, the fa_list must be complete in it before tbss1 runs.
+            FAs are matched to sunk files by path, or else by size and
+            checksum, so fa_list may come from DTIFIT or from a FileIn over
+            the sunk data
+    """
     inputnode = 'inputnode'
     outputnode = 'tbss1.outputnode'
     
@@ -283,7 +508,10 @@ class TBSSPreReg(DINGOFlow):
         'fa_list':  ['DTIFIT', 'FA']
     }    
     
-    def __init__(self, name='TBSSPreReg', req_join=True, **kwargs):
+    def __init__(self, name='TBSSPreReg', req_join=True, inputs=None,
+                 **kwargs):
+        if inputs is None:
+            inputs = {}
         super(TBSSPreReg, self).__init__(name=name, **kwargs)
         
         if req_join:
@@ -306,10 +534,58 @@ class TBSSPreReg(DINGOFlow):
         # inputnode: fa_list
         # outputnode: fa_list (not the same), mask_list, slices
         
-        self.connect(inputnode, 'fa_list', tbss1, 'inputnode.fa_list')
+        if 'verify_index' in inputs and inputs['verify_index'] is not None:
+            verify = pe.Node(
+                name='verify',
+                interface=Function(
+                    input_names=['fa_list', 'index_file'],
+                    output_names=['fa_list'],
+                    function=self.verify_fa_list))
+            verify.inputs.index_file = inputs['verify_index']
+            self.connect(inputnode, 'fa_list', verify, 'fa_list')
+            self.connect(verify, 'fa_list', tbss1, 'inputnode.fa_list')
+        else:
+            self.connect(inputnode, 'fa_list', tbss1, 'inputnode.fa_list')
+
+    def verify_fa_list(fa_list, index_file):
+        """Raise if an FA is not complete in the FileOut cohort index"""
+        from DINGO.interfaces.io import verify_index
+        problems = verify_index(index_file, files=fa_list, by_content=True)
+        if len(problems) > 0:
+            raise IOError('Incomplete fa_list in {}:\n{}'
+                          .format(index_file, '\n'.join(problems)))
+        return fa_list
         
 
 class TBSSRegNXN(DINGOFlow):
+    """
+    Parameters
+    ----------
+    name                :   Str, workflow name
+    inputs              :   Dict
+        fa_list             :   List(File)
+        mask_list           :   List(File)
+        id_list             :   List(Str)
+        n_procs             :   Int, processes per target, default 1, only
+            used by the nested scheduler
+        memory_gb           :   Int, memory per pair ('flat') or per target
+            ('nested'), default 2
+        scheduler           :   'flat' (default) makes every (moving, target)
+            pair a job of the DINGO workflow's plugin, so it alone controls
+            parallelism and a failed pair reruns by itself, 'nested' runs a
+            create_tbss_2_reg workflow with its own MultiProc per target
+        target_selection    :   'all' (default) registers every FA to every
+            other FA, 'approximate' ranks the FAs by thumbnail correlation
+            first and registers to only the top n_candidates, the other
+            targets get infinite deformation so find_best cannot pick them
+        n_candidates        :   Int, targets kept by 'approximate', default 5
+        deformation_stats   :   'numpy' (default) computes each warp's mean
+            and median deformation in process, 'fsl' with fslmaths and
+            fslstats
+        pair_store          :   Directory, registrations of each (moving,
+            target) pair are kept there by content and reused, so adding
+            subjects only registers the new rows and columns of NxN
+    """
     inputnode = 'inputnode'
     outputnode = 'tbss2'
     
@@ -318,6 +594,22 @@ class TBSSRegNXN(DINGOFlow):
         'mask_list':    ['TBSSPreReg', 'mask_list']
     }
     
+    # everything in create_tbss_2_reg and register_pair that changes a pair's
+    # results, part of the pair_store key
+    pair_options = {
+        'flirt':    'dof=12',
+        'fnirt':    'FA_2_FMRIB58_1mm.cnf',
+        'stats':    '-sqr -Tmean; -M -P 50'
+    }
+    
+    @staticmethod
+    def pair_key_options(deformation_stats='numpy'):
+        """pair_options, with the deformation stats method"""
+        options = dict(TBSSRegNXN.pair_options)
+        if deformation_stats == 'numpy':
+            options['stats'] = ' '.join(('numpy', options['stats']))
+        return options
+    
     def __init__(self, name='TBSS_reg_NXN',
     inputs=dict(fa_list=None, mask_list=None, id_list=None, 
                 n_procs=None, memory_gb=None),
@@ -341,45 +633,305 @@ class TBSSRegNXN(DINGOFlow):
             n_procs = inputs['n_procs']
         else:
             n_procs = 1
+        if ('affine_initial' in inputs and
+                inputs['affine_initial'] is not None):
+            affine_initial = inputs['affine_initial']
+        else:
+            affine_initial = True
         if 'memory_gb' in inputs and inputs['memory_gb'] is not None:
             memory_gb = inputs['memory_gb']
         else:
             memory_gb = 2
+        if ('target_selection' in inputs and
+                inputs['target_selection'] is not None):
+            target_selection = inputs['target_selection']
+        else:
+            target_selection = 'all'
+        if target_selection not in ('all', 'approximate'):
+            raise ValueError('target_selection: {} not in (all, approximate)'
+                             .format(target_selection))
+        if 'n_candidates' in inputs and inputs['n_candidates'] is not None:
+            n_candidates = int(inputs['n_candidates'])
+        else:
+            n_candidates = 5
+        if 'pair_store' in inputs and inputs['pair_store'] is not None:
+            pair_store = os.path.abspath(inputs['pair_store'])
+        else:
+            pair_store = None
+        if 'scheduler' in inputs and inputs['scheduler'] is not None:
+            scheduler = inputs['scheduler']
+        else:
+            scheduler = 'flat'
+        if scheduler not in ('flat', 'nested'):
+            raise ValueError('scheduler: {} not in (flat, nested)'
+                             .format(scheduler))
+        if ('deformation_stats' in inputs and
+                inputs['deformation_stats'] is not None):
+            deformation_stats = inputs['deformation_stats']
+        else:
+            deformation_stats = 'numpy'
+        if deformation_stats not in ('numpy', 'fsl'):
+            raise ValueError('deformation_stats: {} not in (numpy, fsl)'
+                             .format(deformation_stats))
         
         # update cfg to keep unnecessary outputs, or most of the function nodes
         # will be empty and rerun each execution
         cfg = dict(execution={'remove_unnecessary_outputs': u'false'})
         config.update_config(cfg)
-        # In order to iterate over something not set in advance, workflow must be
-        # in a function node, within a map node with the proper iterfield
-        # tbss2 workflow: registration nxn
-        tbss2 = pe.MapNode(
-            name='tbss2',
-            interface=Function(
-                input_names=[
-                    'n_procs', 'memory_gb',
-                    'target_id', 'target',
-                    'id_list', 'fa_list', 'mask_list'],
-                output_names=['mat_list', 'fieldcoeff_list', 'mean_median_list'],
-                function=TBSSRegNXN.tbss2_target),
-            iterfield=['target', 'target_id'])
-        tbss2.inputs.n_procs = n_procs
-        tbss2.inputs.memory_gb = memory_gb
+        
+        if target_selection == 'all':
+            regname = 'tbss2'
+            targetsrc = inputnode
+            target_fields = [('id_list', 'target_ids'), ('fa_list', 'targets')]
+        else:
+            # rank targets cheaply, register to the top few, then fill the
+            # NxN shape TBSSPostReg.find_best expects
+            regname = 'tbss2reg'
+            targetsrc = pe.Node(
+                name='candidates',
+                interface=Function(
+                    input_names=['id_list', 'fa_list', 'n_candidates'],
+                    output_names=['candidate_index', 'candidate_ids',
+                                  'candidate_fas'],
+                    function=TBSSRegNXN.select_candidates))
+            targetsrc.inputs.n_candidates = n_candidates
+            target_fields = [('candidate_ids', 'target_ids'),
+                             ('candidate_fas', 'targets')]
+            self.connect([
+                (inputnode, targetsrc, [('id_list', 'id_list'),
+                                        ('fa_list', 'fa_list')])
+                ])
+        
+        if scheduler == 'flat':
+            # every (moving, target) pair is a job of the outer scheduler
+            pairs = pe.Node(
+                name='pairs',
+                interface=Function(
+                    input_names=['id_list', 'fa_list', 'mask_list',
+                                 'target_ids', 'targets'],
+                    output_names=['moving_ids', 'moving_fas', 'moving_masks',
+                                  'target_ids', 'targets'],
+                    function=TBSSRegNXN.make_pairs))
             
-        self.connect([
-            (inputnode, tbss2, [('id_list', 'target_id'),
-                                ('fa_list', 'target'),
-                                ('id_list', 'id_list'),
-                                ('fa_list', 'fa_list'),
-                                ('mask_list', 'mask_list')])
-            ])
+            pairreg = pe.MapNode(
+                name='pairreg',
+                interface=Function(
+                    input_names=['moving_id', 'moving', 'mask',
+                                 'target_id', 'target', 'pair_store',
+                                 'deformation_stats'],
+                    output_names=['mat_file', 'fieldcoeff_file',
+                                  'mean_median'],
+                    function=TBSSRegNXN.register_pair),
+                iterfield=['moving_id', 'moving', 'mask',
+                           'target_id', 'target'],
+                mem_gb=memory_gb,
+                n_procs=1)
+            pairreg.inputs.pair_store = pair_store
+            pairreg.inputs.deformation_stats = deformation_stats
+            
+            tbss2reg = pe.Node(
+                name=regname,
+                interface=Function(
+                    input_names=['id_list', 'target_ids', 'mat_files',
+                                 'fieldcoeff_files', 'mean_medians'],
+                    output_names=['mat_list', 'fieldcoeff_list',
+                                  'mean_median_list'],
+                    function=TBSSRegNXN.collect_pairs))
+            
+            self.connect([
+                (inputnode, pairs, [('id_list', 'id_list'),
+                                    ('fa_list', 'fa_list'),
+                                    ('mask_list', 'mask_list')]),
+                (targetsrc, pairs, target_fields),
+                (pairs, pairreg, [('moving_ids', 'moving_id'),
+                                  ('moving_fas', 'moving'),
+                                  ('moving_masks', 'mask'),
+                                  ('target_ids', 'target_id'),
+                                  ('targets', 'target')]),
+                (inputnode, tbss2reg, [('id_list', 'id_list')]),
+                (targetsrc, tbss2reg, target_fields[:1]),
+                (pairreg, tbss2reg, [('mat_file', 'mat_files'),
+                                     ('fieldcoeff_file', 'fieldcoeff_files'),
+                                     ('mean_median', 'mean_medians')])
+                ])
+        else:
+            # In order to iterate over something not set in advance, workflow
+            # must be in a function node, within a map node with the proper
+            # iterfield; tbss2 workflow: registration nxn
+            tbss2reg = pe.MapNode(
+                name=regname,
+                interface=Function(
+                    input_names=[
+                        'n_procs', 'memory_gb',
+                        'target_id', 'target',
+                        'id_list', 'fa_list', 'mask_list', 'pair_store',
+                        'deformation_stats'],
+                    output_names=['mat_list', 'fieldcoeff_list',
+                                  'mean_median_list'],
+                    function=TBSSRegNXN.tbss2_target),
+                iterfield=['target', 'target_id'],
+                mem_gb=memory_gb,
+                n_procs=n_procs)
+            tbss2reg.inputs.n_procs = n_procs
+            tbss2reg.inputs.memory_gb = memory_gb
+            tbss2reg.inputs.pair_store = pair_store
+            tbss2reg.inputs.deformation_stats = deformation_stats
+            
+            self.connect([
+                (inputnode, tbss2reg, [('id_list', 'id_list'),
+                                       ('fa_list', 'fa_list'),
+                                       ('mask_list', 'mask_list')]),
+                (targetsrc, tbss2reg, [(src, dst[:-1]) for src, dst in
+                                       target_fields])
+                ])
+        
+        if target_selection == 'approximate':
+            tbss2 = pe.Node(
+                name='tbss2',
+                interface=Function(
+                    input_names=['id_list', 'candidate_index',
+                                 'mat_lists', 'fieldcoeff_lists',
+                                 'mean_median_lists'],
+                    output_names=['mat_list', 'fieldcoeff_list',
+                                  'mean_median_list'],
+                    function=TBSSRegNXN.pad_candidates))
+            
+            self.connect([
+                (inputnode, tbss2, [('id_list', 'id_list')]),
+                (targetsrc, tbss2, [('candidate_index', 'candidate_index')]),
+                (tbss2reg, tbss2, [('mat_list', 'mat_lists'),
+                                   ('fieldcoeff_list', 'fieldcoeff_lists'),
+                                   ('mean_median_list', 'mean_median_lists')])
+                ])
+    
+    def make_pairs(id_list, fa_list, mask_list, target_ids, targets):
+        """Return synced lists of every (moving, target) pair, grouped by
+        target in target order, moving in id_list order"""
+        moving_ids = []
+        moving_fas = []
+        moving_masks = []
+        pair_target_ids = []
+        pair_targets = []
+        for target_id, target in zip(target_ids, targets):
+            moving_ids.extend(id_list)
+            moving_fas.extend(fa_list)
+            moving_masks.extend(mask_list)
+            pair_target_ids.extend([target_id] * len(id_list))
+            pair_targets.extend([target] * len(id_list))
+        return (moving_ids, moving_fas, moving_masks,
+                pair_target_ids, pair_targets)
+    
+    def register_pair(moving_id, moving, mask, target_id, target,
+                      pair_store=None, deformation_stats='numpy'):
+        """FLIRT then FNIRT moving to target, as create_tbss_2_reg does for
+        one pair, and estimate mean & median deformation"""
+        from DINGO.workflows.fsl import TBSSRegNXN
+        from nipype.interfaces import fsl
+        import os
+        
+        if pair_store is not None:
+            from DINGO.cache import PairStore
+            store = PairStore(pair_store)
+            key = store.key(moving, target, mask,
+                            TBSSRegNXN.pair_key_options(deformation_stats))
+            record = store.fetch(key, os.getcwd())
+            if record is not None:
+                mat_file, fieldcoeff_file = record['files']
+                return mat_file, fieldcoeff_file, record['mean_median']
+        
+        i2r = '_'.join((moving_id, 'to', target_id))
+        flirt = fsl.FLIRT(
+            dof=12,
+            in_file=moving,
+            reference=target,
+            in_weight=mask,
+            out_file=''.join((i2r, '.nii.gz')),
+            out_matrix_file=''.join((i2r, '.mat')))
+        mat_file = flirt.run().outputs.out_matrix_file
+        
+        fnirt = fsl.FNIRT(
+            in_file=moving,
+            ref_file=target,
+            affine_file=mat_file,
+            fieldcoeff_file='_'.join((i2r, 'warp.nii.gz')),
+            warped_file='_'.join((i2r, 'warped.nii.gz')),
+            config_file=os.path.join(
+                os.environ['FSLDIR'], 'etc/flirtsch/FA_2_FMRIB58_1mm.cnf'))
+        fieldcoeff_file = fnirt.run().outputs.fieldcoeff_file
+        
+        if deformation_stats == 'numpy':
+            from DINGO.utils import deformation_stats as numpy_stats
+            mean_median = numpy_stats(fieldcoeff_file)
+        else:
+            sqrtmean = fsl.ImageMaths(
+                in_file=fieldcoeff_file,
+                op_string='-sqr -Tmean',
+                out_file='_'.join((i2r, 'warp_sqrTmean.nii.gz')))
+            meanmedian = fsl.ImageStats(
+                in_file=sqrtmean.run().outputs.out_file,
+                op_string='-M -P 50')
+            mean_median = meanmedian.run().outputs.out_stat
+        
+        if pair_store is not None:
+            store.store(key, [mat_file, fieldcoeff_file],
+                        mean_median=mean_median)
+        return mat_file, fieldcoeff_file, mean_median
+    
+    def collect_pairs(id_list, target_ids, mat_files, fieldcoeff_files,
+                      mean_medians):
+        """Split make_pairs ordered results into a list per target"""
+        nids = len(id_list)
+        if len(mat_files) != nids * len(target_ids):
+            raise IndexError('N_pairs: {:d} != N_ids: {:d} x N_targets: {:d}'
+                             .format(len(mat_files), nids, len(target_ids)))
+        mat_list = []
+        fieldcoeff_list = []
+        mean_median_list = []
+        for t in range(len(target_ids)):
+            mat_list.append(list(mat_files[t * nids:(t + 1) * nids]))
+            fieldcoeff_list.append(
+                list(fieldcoeff_files[t * nids:(t + 1) * nids]))
+            mean_median_list.append(
+                list(mean_medians[t * nids:(t + 1) * nids]))
+        return mat_list, fieldcoeff_list, mean_median_list
+    
+    def select_candidates(id_list, fa_list, n_candidates):
+        """Return the n_candidates FAs most correlated with the rest, as
+        indices into fa_list, ids and files, in fa_list order"""
+        from DINGO.utils import rank_fa_targets
+        order, scores = rank_fa_targets(fa_list)
+        candidate_index = sorted(order[:max(1, n_candidates)])
+        print('Target scores: {}'.format(
+            ', '.join('{}={:.4f}'.format(i, s)
+                      for i, s in zip(id_list, scores))))
+        candidate_ids = [id_list[i] for i in candidate_index]
+        candidate_fas = [fa_list[i] for i in candidate_index]
+        return candidate_index, candidate_ids, candidate_fas
+    
+    def pad_candidates(id_list, candidate_index, mat_lists, fieldcoeff_lists,
+                       mean_median_lists):
+        """Spread candidate target results over all ids, non-candidates get
+        None for files and inf for mean and median deformation"""
+        nids = len(id_list)
+        mat_list = [None] * nids
+        fieldcoeff_list = [None] * nids
+        mean_median_list = [[[float('inf'), float('inf')]] * nids
+                            for i in range(nids)]
+        for c, i in enumerate(candidate_index):
+            mat_list[i] = mat_lists[c]
+            fieldcoeff_list[i] = fieldcoeff_lists[c]
+            mean_median_list[i] = mean_median_lists[c]
+        return mat_list, fieldcoeff_list, mean_median_list
         
     @staticmethod
     def create_tbss_2_reg(name="tbss_2_reg",
                           target=None, target_id=None,
-                          id_list=None, fa_list=None, mask_list=None):
+                          id_list=None, fa_list=None, mask_list=None,
+                          deformation_stats='numpy'):
         """TBSS nonlinear registration:
         Performs flirt and fnirt from every file in fa_list to a target.
+        deformation_stats 'numpy' or 'fsl' selects how mean & median
+        deformation are computed.
         
         Inputs
         ------
@@ -506,17 +1058,6 @@ class TBSSRegNXN(DINGOFlow):
                 [('out_matrix_file', 'affine_file')])
             ])
 
-        # Estimate mean & median deformation
-        sqrtmean = pe.MapNode(
-            name='sqrTmean',
-            interface=fsl.ImageMaths(op_string='-sqr -Tmean'),
-            iterfield=['in_file'])
-        
-        meanmedian = pe.MapNode(
-            name='meanmedian',
-            interface=fsl.ImageStats(op_string='-M -P 50'),
-            iterfield=['in_file'])
-
         outputnode = pe.Node(
             name='outputnode',
             interface=IdentityInterface(
@@ -524,18 +1065,49 @@ class TBSSRegNXN(DINGOFlow):
 
         tbss2.connect([
             (flirt, outputnode, [('out_matrix_file', 'linear_matrix')]),
-            (fnirt, sqrtmean, [('fieldcoeff_file', 'in_file')]),
-            (fnirt, outputnode, [('fieldcoeff_file', 'fieldcoeff')]),
-            (sqrtmean, meanmedian, [('out_file', 'in_file')]),
-            (meanmedian, outputnode, [('out_stat', 'mean_median')])
+            (fnirt, outputnode, [('fieldcoeff_file', 'fieldcoeff')])
             ])
+        
+        # Estimate mean & median deformation
+        if deformation_stats == 'numpy':
+            meanmedian = pe.MapNode(
+                name='meanmedian',
+                interface=Function(
+                    input_names=['field_file'],
+                    output_names=['out_stat'],
+                    function=deformation_stats_func),
+                iterfield=['field_file'])
+            tbss2.connect([
+                (fnirt, meanmedian, [('fieldcoeff_file', 'field_file')]),
+                (meanmedian, outputnode, [('out_stat', 'mean_median')])
+                ])
+        else:
+            sqrtmean = pe.MapNode(
+                name='sqrTmean',
+                interface=fsl.ImageMaths(op_string='-sqr -Tmean'),
+                iterfield=['in_file'])
+            
+            meanmedian = pe.MapNode(
+                name='meanmedian',
+                interface=fsl.ImageStats(op_string='-M -P 50'),
+                iterfield=['in_file'])
+            
+            tbss2.connect([
+                (fnirt, sqrtmean, [('fieldcoeff_file', 'in_file')]),
+                (sqrtmean, meanmedian, [('out_file', 'in_file')]),
+                (meanmedian, outputnode, [('out_stat', 'mean_median')])
+                ])
             
         return tbss2
 
     def tbss2_target(n_procs=None, memory_gb=None,
                      target=None, target_id=None,
-                     id_list=None, fa_list=None, mask_list=None):
+                     id_list=None, fa_list=None, mask_list=None,
+                     pair_store=None, deformation_stats='numpy'):
         """Wrap tbss2 workflow in mapnode(functionnode) to iterate over fa_files
+        
+        With pair_store, pairs registered before (by content of the FAs and
+        masks) are linked from it and only the rest are registered.
         """
         from DINGO.workflows.fsl import TBSSRegNXN
         import os
@@ -547,13 +1119,37 @@ class TBSSRegNXN(DINGOFlow):
            (id_list is not None) and
            (fa_list is not None) and
            (mask_list is not None)):
+            nids = len(id_list)
+            mat_list = [None] * nids
+            fieldcoeff_list = [None] * nids
+            mm_list = [None] * nids
+            
+            if pair_store is not None:
+                from DINGO.cache import PairStore
+                store = PairStore(pair_store)
+                options = TBSSRegNXN.pair_key_options(deformation_stats)
+                keys = [store.key(fa_list[i], target, mask_list[i], options)
+                        for i in range(nids)]
+                for i in range(nids):
+                    record = store.fetch(
+                        keys[i], os.path.join(os.getcwd(), 'pairs', id_list[i]))
+                    if record is not None:
+                        mat_list[i], fieldcoeff_list[i] = record['files']
+                        mm_list[i] = record['mean_median']
+            missing = [i for i in range(nids) if mm_list[i] is None]
+            print('Target {}: {:d} of {:d} pairs to register'
+                  .format(target_id, len(missing), nids))
+            if len(missing) == 0:
+                return mat_list, fieldcoeff_list, mm_list
+            
             tbss2n = TBSSRegNXN.create_tbss_2_reg(
                 name='tbss2n',
                 target=target,
                 target_id=target_id,
-                id_list=id_list,
-                fa_list=fa_list,
-                mask_list=mask_list)
+                id_list=[id_list[i] for i in missing],
+                fa_list=[fa_list[i] for i in missing],
+                mask_list=[mask_list[i] for i in missing],
+                deformation_stats=deformation_stats)
             tbss2n.base_dir = os.getcwd()
             
             if (n_procs is None) or (not isinstance(n_procs, int)):
@@ -584,14 +1180,25 @@ class TBSSRegNXN(DINGOFlow):
                 with gzip.open(result_filename, 'rb') as f:
                     data = pickle.load(f)
                 return getattr(data.outputs, data_dict[name])
-                
+            
             for node in node_list:
                 if node.name == 'flirt':
-                    mat_list = read_result('flirt', node_data, node)
+                    new_list = read_result('flirt', node_data, node)
+                    for i, new in zip(missing, new_list):
+                        mat_list[i] = new
                 elif node.name == 'fnirt':
-                    fieldcoeff_list = read_result('fnirt', node_data, node)
+                    new_list = read_result('fnirt', node_data, node)
+                    for i, new in zip(missing, new_list):
+                        fieldcoeff_list[i] = new
                 elif node.name == 'meanmedian':
-                    mm_list = read_result('meanmedian', node_data, node)
+                    new_list = read_result('meanmedian', node_data, node)
+                    for i, new in zip(missing, new_list):
+                        mm_list[i] = new
+            
+            if pair_store is not None:
+                for i in missing:
+                    store.store(keys[i], [mat_list[i], fieldcoeff_list[i]],
+                                mean_median=mm_list[i])
             
             return mat_list, fieldcoeff_list, mm_list
         
@@ -651,6 +1258,7 @@ class TBSSPostReg(DINGOFlow):
     def find_best(id_list, list_numlists):
         """take synced id_list and list of lists with means, medians, return id and
         mean_median that are smallest"""
+        import numpy as np
         nids = len(id_list)
         nnumlists = len(list_numlists)
         if nids != nnumlists:
@@ -658,23 +1266,23 @@ class TBSSPostReg(DINGOFlow):
                    .format(nids, nnumlists))
             raise IndexError(msg)
         else:
-            idmeans = []
-            idmedians = []
             for o in range(0, nids):
                 nnums = len(list_numlists[o])
                 if nids != nnums:
                     msg = ('Warning: N_nums: {:d} for ID: {} is not N_ids: {:d}'
                            .format(nnums, id_list[o], nids))
                     print(msg)
-                meangen = (list_numlists[o][i][0] for i in range(0, nids))
-                idmeans.append(sum(meangen) / nids)
-                mediangen = (list_numlists[o][i][1] for i in range(0, nids))
-                idmedians.append(sum(mediangen) / nids)
-                
-            best_index = idmeans.index(min(idmeans))
+            # targets x movings x (mean, median)
+            numarray = np.array([[numlist[i][:2] for i in range(0, nids)]
+                                 for numlist in list_numlists],
+                                dtype=np.float64)
+            idmeans = numarray[:, :, 0].sum(axis=1) / nids
+            idmedians = numarray[:, :, 1].sum(axis=1) / nids
+            
+            best_index = int(np.argmin(idmeans))
             best_id = id_list[best_index]
-            best_mean = idmeans[best_index]
-            best_median = idmedians[best_index]
+            best_mean = float(idmeans[best_index])
+            best_median = float(idmedians[best_index])
 
         return best_index, best_id, best_mean, best_median
     
@@ -797,7 +1405,8 @@ class TBSSPostReg(DINGOFlow):
                               id_list=None,
                               fa_list=None,
                               field_list=None,
-                              mm_list=None):
+                              mm_list=None,
+                              group_stats='numpy'):
         """find best target from fa_list, then apply warps
         
         Parameters
@@ -808,6 +1417,10 @@ class TBSSPostReg(DINGOFlow):
         target              :   'best' or 'FMRIB58_FA_1mm.nii.gz'
         mask_best           :   Bool (default True) whether to binarize best
                                      brain and use to weight xfm to MNI space
+        group_stats         :   'numpy' (default) merge, group mask, masking
+                                     and mean in one pass over the warped
+                                     FAs, masked 4D is uncompressed .nii
+                                'fsl' with fslmerge and 3 fslmaths
         id_list             :   inputnode.id_list
         fa_list             :   inputnode.fa_list
         field_list          :   inputnode.field_list
@@ -867,31 +1480,58 @@ class TBSSPostReg(DINGOFlow):
             applywarp.inputs.ref_file = fsl.Info.standard_image(
                 "FMRIB58_FA_1mm.nii.gz")
         
-        # Merge the FA files into a 4D file
-        mergefa = pe.Node(
-            name='mergefa',
-            interface=fsl.Merge(dimension='t'))
-            
-        # Take the mean over the fourth dimension
-        meanfa = pe.Node(
-            name='meanfa',
-            interface=fsl.ImageMaths(
-                op_string="-Tmean",
-                suffix="_mean"))
+        if group_stats == 'numpy':
+            # Merge, group mask, mask and mean in one pass
+            groupstats = pe.Node(
+                name='groupstats',
+                interface=Function(
+                    input_names=['in_files', 'merged_file'],
+                    output_names=['masked_file', 'mask_file', 'mean_file'],
+                    function=group_stats_func))
+            groupstats.inputs.merged_file = 'all_FA_merged.nii.gz'
+            merge_in = (groupstats, 'in_files')
+            merge_name = (groupstats, 'merged_file')
+            mask_out = (groupstats, 'mask_file')
+            masked_out = (groupstats, 'masked_file')
+            mean_out = (groupstats, 'mean_file')
+        else:
+            # Merge the FA files into a 4D file
+            mergefa = pe.Node(
+                name='mergefa',
+                interface=fsl.Merge(dimension='t'))
+            
+            # Take the mean over the fourth dimension
+            meanfa = pe.Node(
+                name='meanfa',
+                interface=fsl.ImageMaths(
+                    op_string="-Tmean",
+                    suffix="_mean"))
                 
-        # Get a group mask
-        groupmask = pe.Node(
-            name='groupmask',
-            interface=fsl.ImageMaths(
-                op_string="-max 0 -Tmin -bin",
-                out_data_type="char",
-                suffix="_mask"))
-
-        maskgroup = pe.Node(
-            name='maskgroup',
-            interface=fsl.ImageMaths(
-                op_string="-mas",
-                suffix="_masked"))
+            # Get a group mask
+            groupmask = pe.Node(
+                name='groupmask',
+                interface=fsl.ImageMaths(
+                    op_string="-max 0 -Tmin -bin",
+                    out_data_type="char",
+                    suffix="_mask"))
+
+            maskgroup = pe.Node(
+                name='maskgroup',
+                interface=fsl.ImageMaths(
+                    op_string="-mas",
+                    suffix="_masked"))
+            
+            tbss3.connect([
+                (mergefa, groupmask, [("merged_file", "in_file")]),
+                (mergefa, maskgroup, [("merged_file", "in_file")]),
+                (groupmask, maskgroup, [("out_file", "in_file2")]),
+                (maskgroup, meanfa, [("out_file", "in_file")])
+                ])
+            merge_in = (mergefa, 'in_files')
+            merge_name = (mergefa, 'merged_file')
+            mask_out = (groupmask, 'out_file')
+            masked_out = (maskgroup, 'out_file')
+            mean_out = (meanfa, 'out_file')
             
         if target == 'best':
             # Find best target that limits mean deformation, insert before applywarp
@@ -930,9 +1570,9 @@ class TBSSPostReg(DINGOFlow):
                 (inputnode, applywarp, 
                     [('fa_list', 'in_file')]),
                 (fb, rename2target, [('outputnode.best_id', 'arg2')]),
-                (fb, mergefa, [(('outputnode.best_id', 
-                                best2merged), 
-                                'merged_file')]),
+                (fb, merge_name[0], [(('outputnode.best_id', 
+                                       best2merged), 
+                                       merge_name[1])]),
                 (fb, applywarp, 
                     [('outputnode.2best_fields_list', 'field_file'),
                      ('outputnode.best_fa2MNI_mat', 'postmat')]),
@@ -957,10 +1597,7 @@ class TBSSPostReg(DINGOFlow):
                     'mergefa_file']))
             
         tbss3.connect([
-            (applywarp, mergefa, [("out_file", "in_files")]),
-            (mergefa, groupmask, [("merged_file", "in_file")]),
-            (mergefa, maskgroup, [("merged_file", "in_file")]),
-            (groupmask, maskgroup, [("out_file", "in_file2")]),
+            (applywarp, merge_in[0], [("out_file", merge_in[1])])
             ])
             
         if estimate_skeleton:
@@ -970,12 +1607,11 @@ class TBSSPostReg(DINGOFlow):
                 interface=fsl.TractSkeleton(skeleton_file=True))
                 
             tbss3.connect([
-                (maskgroup, meanfa, [("out_file", "in_file")]),
-                (meanfa, makeskeleton, [("out_file", "in_file")]),
-                (groupmask, outputnode, [('out_file', 'groupmask_file')]),
+                (mean_out[0], makeskeleton, [(mean_out[1], "in_file")]),
+                (mask_out[0], outputnode, [(mask_out[1], 'groupmask_file')]),
                 (makeskeleton, outputnode, [('skeleton_file', 'skeleton_file')]),
-                (meanfa, outputnode, [('out_file', 'meanfa_file')]),
-                (maskgroup, outputnode, [('out_file', 'mergefa_file')])
+                (mean_out[0], outputnode, [(mean_out[1], 'meanfa_file')]),
+                (masked_out[0], outputnode, [(masked_out[1], 'mergefa_file')])
                 ])
         else:
             # $FSLDIR/bin/fslmaths $FSLDIR/data/standard/FMRIB58_FA_1mm -mas mean_FA_mask mean_FA
@@ -999,9 +1635,9 @@ class TBSSPostReg(DINGOFlow):
                     suffix="_masked"))
 
             tbss3.connect([
-                (groupmask, maskstd, [("out_file", "in_file2")]),
+                (mask_out[0], maskstd, [(mask_out[1], "in_file2")]),
                 (maskstd, binmaskstd, [("out_file", "in_file")]),
-                (maskgroup, maskgroup2, [("out_file", "in_file")]),
+                (masked_out[0], maskgroup2, [(masked_out[1], "in_file")]),
                 (binmaskstd, maskgroup2, [("out_file", "in_file2")])
                 ])
 
@@ -1015,3 +1651,588 @@ class TBSSPostReg(DINGOFlow):
                 ])
                 
         return tbss3
+
+
+class TemplateBuild(DINGOFlow):
+    """Iterative cohort template: register every image to the current
+    template, average the warped images, repeat.
+    
+    Iterations are unrolled into the workflow (reg0, mean0, reg1, ...), so
+    the registrations of an iteration run in parallel under the DINGO
+    plugin, and an interrupted build resumes from its last finished nodes.
+    
+    To keep the template from taking after the starting image (the first
+    in_file by default), the images are first registered affinely to it
+    and averaged (affine, mean_affine), and every mean is moved by the
+    inverse of the mean affine of its registrations, as ANTs
+    buildtemplateparallel does. The template then sits at the average
+    position, orientation and size of the cohort. The inverse mean warp is
+    not applied, so some nonlinear shape of the starting image may remain,
+    less with each iteration.
+    
+    Parameters
+    ----------
+    name            :   Str, workflow name
+    req_join        :   Bool, join in_files over setup_inputs iterables
+    inputs          :   Dict
+        iterations      :   Int, default 4
+        method          :   'fsl' (default) FLIRT+FNIRT as FSLNonLinReg,
+            'ants' ANTS SyN then WarpImageMultiTransform
+        initial_template    :   File, default the first in_file
+        affine_initial  :   Bool, start from the affine average of the
+            images registered to initial_template, default True
+        FA              :   Bool, FNIRT with FA_2_FMRIB58_1mm.cnf
+        multires        :   Bool, as FSLNonLinReg multires ('fsl' only)
+        regopts         :   Dict, fsl: {'flirt': {}, 'fnirt': {}},
+            ants: ants_ext.ANTS inputs
+        memory_gb       :   Int, memory per registration, default 2
+        n_procs         :   Int, threads per registration, default 1
+    
+    Inputs
+    ------
+    inputnode.in_files
+    
+    Outputs
+    -------
+    outputnode.template         :   File, final template
+    outputnode.affine_template  :   File, affine average the nonlinear
+        iterations start from (initial template without affine_initial)
+    outputnode.templates        :   List(File), template after each iteration
+    outputnode.warped_files     :   List(File), last iteration's warped images
+    outputnode.affine_files     :   List(File), last iteration's affines
+    outputnode.field_files      :   List(File), last iteration's warps
+    """
+    inputnode = 'inputnode'
+    outputnode = 'outputnode'
+    
+    connection_spec = {
+        'in_files':     ['DTIFIT', 'FA']
+    }
+    
+    def __init__(self, name='TemplateBuild', req_join=True, inputs=None,
+                 **kwargs):
+        if inputs is None:
+            inputs = {}
+        super(TemplateBuild, self).__init__(name=name, **kwargs)
+        
+        if 'iterations' in inputs and inputs['iterations'] is not None:
+            iterations = int(inputs['iterations'])
+        else:
+            iterations = 4
+        if iterations < 1:
+            raise ValueError('iterations: {:d} < 1'.format(iterations))
+        if 'method' in inputs and inputs['method'] is not None:
+            method = inputs['method']
+        else:
+            method = 'fsl'
+        if method not in ('fsl', 'ants'):
+            raise ValueError('method: {} not in (fsl, ants)'.format(method))
+        if 'regopts' in inputs and inputs['regopts'] is not None:
+            regopts = inputs['regopts']
+        else:
+            regopts = {}
+        if method == 'fsl':
+            regopts = dict(regopts)
+            if 'FA' in inputs and inputs['FA']:
+                fnirtopts = dict(regopts.get('fnirt', {}))
+                if fsl.no_fsl():
+                    warn('NO FSL found')
+                else:
+                    fnirtopts.setdefault('config_file', os.path.join(
+                        os.environ["FSLDIR"],
+                        "etc/flirtsch/FA_2_FMRIB58_1mm.cnf"))
+                regopts['fnirt'] = fnirtopts
+            if 'multires' in inputs and inputs['multires']:
+                regopts['multires'] = True
+        if ('affine_initial' in inputs and
+                inputs['affine_initial'] is not None):
+            affine_initial = inputs['affine_initial']
+        else:
+            affine_initial = True
+        if 'memory_gb' in inputs and inputs['memory_gb'] is not None:
+            memory_gb = inputs['memory_gb']
+        else:
+            memory_gb = 2
+        if 'n_procs' in inputs and inputs['n_procs'] is not None:
+            n_procs = inputs['n_procs']
+        else:
+            n_procs = 1
+        
+        if req_join:
+            inputnode = pe.JoinNode(
+                name='inputnode',
+                interface=IdentityInterface(
+                    fields=['in_files']),
+                mandatory_inputs=True,
+                joinsource=self.setup_inputs,
+                joinfield=['in_files'])
+        else:
+            inputnode = pe.Node(
+                name='inputnode',
+                interface=IdentityInterface(
+                    fields=['in_files']),
+                mandatory_inputs=True)
+        if 'in_files' in inputs and inputs['in_files'] is not None:
+            inputnode.inputs.in_files = inputs['in_files']
+        
+        initial = pe.Node(
+            name='initial',
+            interface=Function(
+                input_names=['in_files', 'initial_template'],
+                output_names=['template'],
+                function=TemplateBuild.initial_template))
+        if ('initial_template' in inputs and
+                inputs['initial_template'] is not None):
+            initial.inputs.initial_template = inputs['initial_template']
+        else:
+            initial.inputs.initial_template = None
+        
+        outputnode = pe.Node(
+            name='outputnode',
+            interface=IdentityInterface(
+                fields=['template', 'affine_template', 'templates',
+                        'warped_files', 'affine_files', 'field_files']))
+        
+        templates = pe.Node(
+            name='templates',
+            interface=Merge(iterations))
+        
+        self.connect(inputnode, 'in_files', initial, 'in_files')
+        template = (initial, 'template')
+        if affine_initial:
+            affine = pe.MapNode(
+                name='affine',
+                interface=Function(
+                    input_names=['in_file', 'template', 'method', 'regopts'],
+                    output_names=['warped_file', 'affine_file'],
+                    function=TemplateBuild.affine_to_template),
+                iterfield=['in_file'],
+                mem_gb=memory_gb,
+                n_procs=n_procs)
+            affine.inputs.method = method
+            affine.inputs.regopts = regopts
+            
+            mean_affine = pe.Node(
+                name='mean_affine',
+                interface=Function(
+                    input_names=['in_files', 'affine_files', 'method',
+                                 'out_file'],
+                    output_names=['out_file'],
+                    function=TemplateBuild.unbiased_mean))
+            mean_affine.inputs.method = method
+            mean_affine.inputs.out_file = 'template0.nii.gz'
+            
+            self.connect([
+                (inputnode, affine, [('in_files', 'in_file')]),
+                (initial, affine, [('template', 'template')]),
+                (affine, mean_affine, [('warped_file', 'in_files'),
+                                       ('affine_file', 'affine_files')])
+                ])
+            template = (mean_affine, 'out_file')
+        self.connect(template[0], template[1], outputnode, 'affine_template')
+        for i in range(iterations):
+            reg = pe.MapNode(
+                name='reg{:d}'.format(i),
+                interface=Function(
+                    input_names=['in_file', 'template', 'method', 'regopts'],
+                    output_names=['warped_file', 'affine_file',
+                                  'field_file'],
+                    function=TemplateBuild.register_to_template),
+                iterfield=['in_file'],
+                mem_gb=memory_gb,
+                n_procs=n_procs)
+            reg.inputs.method = method
+            reg.inputs.regopts = regopts
+            
+            mean = pe.Node(
+                name='mean{:d}'.format(i),
+                interface=Function(
+                    input_names=['in_files', 'affine_files', 'method',
+                                 'out_file'],
+                    output_names=['out_file'],
+                    function=TemplateBuild.unbiased_mean))
+            mean.inputs.method = method
+            mean.inputs.out_file = 'template{:d}.nii.gz'.format(i + 1)
+            
+            self.connect([
+                (inputnode, reg, [('in_files', 'in_file')]),
+                (template[0], reg, [(template[1], 'template')]),
+                (reg, mean, [('warped_file', 'in_files'),
+                             ('affine_file', 'affine_files')]),
+                (mean, templates, [('out_file', 'in{:d}'.format(i + 1))])
+                ])
+            template = (mean, 'out_file')
+        
+        self.connect([
+            (template[0], outputnode, [(template[1], 'template')]),
+            (templates, outputnode, [('out', 'templates')]),
+            (reg, outputnode, [('warped_file', 'warped_files'),
+                               ('affine_file', 'affine_files'),
+                               ('field_file', 'field_files')])
+            ])
+    
+    def initial_template(in_files, initial_template=None):
+        """Return initial_template, or the first in_file"""
+        import os
+        if initial_template is not None:
+            return os.path.abspath(initial_template)
+        return os.path.abspath(in_files[0])
+    
+    def affine_to_template(in_file, template, method='fsl', regopts=None):
+        """Affinely register in_file to template, return the resampled
+        image and the affine"""
+        from nipype.utils.filemanip import split_filename
+        
+        if regopts is None:
+            regopts = {}
+        _, base, _ = split_filename(in_file)
+        if method == 'ants':
+            from DINGO.interfaces.ants_ext import ANTS, WarpImageMultiTransform
+            antsopts = dict(
+                dimension=3,
+                metric=['CC'],
+                metric_weight=[1.0],
+                radius=[4],
+                transformation_model='SyN',
+                number_of_affine_iterations=[10000, 10000, 10000, 10000,
+                                             10000])
+            antsopts.update(regopts)
+            # no deformable iterations, affine only
+            antsopts['number_of_iterations'] = [0]
+            ants = ANTS(
+                fixed_image=[template],
+                moving_image=[in_file],
+                output_transform_prefix=''.join((base, '_')),
+                **antsopts)
+            affine_file = ants.run().outputs.affine_transform
+            wimt = WarpImageMultiTransform(
+                input_image=in_file,
+                reference_image=template,
+                output_image=''.join((base, '_affine.nii.gz')),
+                transformation_series=[affine_file])
+            return wimt.run().outputs.output_image, affine_file
+        
+        from nipype.interfaces import fsl
+        flirt = fsl.FLIRT(
+            in_file=in_file,
+            reference=template,
+            out_file=''.join((base, '_affine.nii.gz')),
+            out_matrix_file=''.join((base, '_flirt.mat')),
+            **dict(regopts.get('flirt', {'dof': 12})))
+        flirt_out = flirt.run().outputs
+        return flirt_out.out_file, flirt_out.out_matrix_file
+    
+    def unbiased_mean(in_files, affine_files, method='fsl', out_file=None):
+        """Average images registered to a template, then resample the mean
+        by the inverse of the mean of their affines, moving it from the
+        template's position and size to the average of the images.
+        
+        fsl: FLIRT matrices (image to template) are averaged elementwise,
+        and the mean is resampled with FLIRT -applyxfm by the inverse.
+        ants: as buildtemplateparallel, AverageAffineTransform, then
+        WarpImageMultiTransform with the average inverted.
+        
+        Returns
+        -------
+        out_file    :   File, absolute path
+        """
+        import os
+        import numpy as np
+        from nipype.utils.filemanip import split_filename
+        from DINGO.utils import mean_image
+        
+        if out_file is None:
+            out_file = 'template.nii.gz'
+        out_file = os.path.abspath(out_file)
+        _, base, _ = split_filename(out_file)
+        mean_file = mean_image(in_files, ''.join((base, '_mean.nii.gz')))
+        if method == 'ants':
+            from nipype.interfaces.ants import AverageAffineTransform
+            from DINGO.interfaces.ants_ext import WarpImageMultiTransform
+            # 'Affine' in the name marks it for invert_affine
+            average = AverageAffineTransform(
+                dimension=3,
+                transforms=list(affine_files),
+                output_affine_transform=''.join((base, '_meanAffine.txt')))
+            wimt = WarpImageMultiTransform(
+                input_image=mean_file,
+                reference_image=mean_file,
+                output_image=out_file,
+                transformation_series=[
+                    average.run().outputs.affine_transform],
+                invert_affine=[1])
+            wimt.run()
+            return out_file
+        
+        from nipype.interfaces import fsl
+        mean_affine = np.mean([np.loadtxt(f) for f in affine_files], axis=0)
+        inverse_file = os.path.abspath(''.join((base, '_meaninv.mat')))
+        np.savetxt(inverse_file, np.linalg.inv(mean_affine), fmt='%.10f')
+        flirt = fsl.FLIRT(
+            in_file=mean_file,
+            reference=mean_file,
+            apply_xfm=True,
+            in_matrix_file=inverse_file,
+            out_file=out_file,
+            out_matrix_file=''.join((base, '_applied.mat')))
+        flirt.run()
+        return out_file
+    
+    def register_to_template(in_file, template, method='fsl', regopts=None):
+        """Nonlinearly register in_file to template, return the warped image
+        and transforms"""
+        import os
+        from nipype.utils.filemanip import split_filename
+        
+        if regopts is None:
+            regopts = {}
+        _, base, _ = split_filename(in_file)
+        if method == 'ants':
+            from DINGO.interfaces.ants_ext import ANTS, WarpImageMultiTransform
+            antsopts = dict(
+                dimension=3,
+                metric=['CC'],
+                metric_weight=[1.0],
+                radius=[4],
+                transformation_model='SyN',
+                number_of_iterations=[30, 20, 10],
+                regularization='Gauss',
+                regularization_gradient_field_sigma=3,
+                regularization_deformation_field_sigma=0,
+                number_of_affine_iterations=[10000, 10000, 10000, 10000,
+                                             10000])
+            antsopts.update(regopts)
+            ants = ANTS(
+                fixed_image=[template],
+                moving_image=[in_file],
+                output_transform_prefix=''.join((base, '_')),
+                **antsopts)
+            ants_out = ants.run().outputs
+            wimt = WarpImageMultiTransform(
+                input_image=in_file,
+                reference_image=template,
+                output_image=''.join((base, '_warped.nii.gz')),
+                transformation_series=[ants_out.warp_transform,
+                                       ants_out.affine_transform])
+            warped_file = wimt.run().outputs.output_image
+            return (warped_file, ants_out.affine_transform,
+                    ants_out.warp_transform)
+        
+        from nipype.interfaces import fsl
+        flirtopts = dict(regopts.get('flirt', {'dof': 12}))
+        fnirtopts = dict(regopts.get('fnirt', {}))
+        if regopts.get('multires', False):
+            from DINGO.registration import (fnirt_preset, pyramid_level,
+                                            coarse_to_fine_matrix)
+            factor, preset = fnirt_preset(template)
+            flirt = fsl.FLIRT(
+                in_file=pyramid_level(in_file, factor),
+                reference=pyramid_level(template, factor),
+                out_matrix_file=''.join((base, '_coarse.mat')),
+                **flirtopts)
+            affine_file = coarse_to_fine_matrix(
+                flirt.run().outputs.out_matrix_file, in_file, template,
+                factor, ''.join((base, '_flirt.mat')))
+            for k, v in preset.items():
+                fnirtopts.setdefault(k, v)
+        else:
+            flirt = fsl.FLIRT(
+                in_file=in_file,
+                reference=template,
+                out_matrix_file=''.join((base, '_flirt.mat')),
+                **flirtopts)
+            affine_file = flirt.run().outputs.out_matrix_file
+        fnirt = fsl.FNIRT(
+            in_file=in_file,
+            ref_file=template,
+            affine_file=affine_file,
+            fieldcoeff_file=''.join((base, '_warp.nii.gz')),
+            warped_file=''.join((base, '_warped.nii.gz')),
+            **fnirtopts)
+        fnirt_out = fnirt.run().outputs
+        return fnirt_out.warped_file, affine_file, fnirt_out.fieldcoeff_file
+
+
+class WarpRegions(DINGOFlow):
+    """Warp template regions to a subject, for DSI_TRK.
+    
+    The template is registered to the subject once (FLIRT, FNIRT), then the
+    union of regions named by all tracts is warped in one batched pass, see
+    ApplyWarp.batch_applywarp. outputnode.region_index is indexed by the
+    template region paths, so tract region names match as they would have
+    on the template, and may be connected to DSI_TRK's region_index.
+    
+    Parameters
+    ----------
+    name    :   Str, workflow name
+    inputs  :   Dict
+        template            :   File, template image, moving
+        template_regions    :   List(File), regions in template space
+        ref_file            :   File, subject image, reference
+        tracts      :   Dict, as DSI_TRK's tracts, or List(Str) of region
+            names, or Str, the name of the DSI_TRK step of the setup, whose
+            inputs are then used so the two cannot drift apart. Only
+            regions they name are warped, default all
+        flirt       :   Dict, fsl.FLIRT inputs, default {'dof': 12}
+        fnirt       :   Dict, fsl.FNIRT inputs
+        FA          :   Bool, FNIRT with FA_2_FMRIB58_1mm.cnf
+        applywarp   :   Dict, fsl.ApplyWarp inputs, default {'interp': 'nn'}
+    
+    Outputs
+    -------
+    outputnode.region_index         :   Dict, see utils.build_region_index
+    outputnode.region_index_file    :   File, region_index as json
+    outputnode.warped_regions       :   List(File)
+    outputnode.affine_file          :   File, FLIRT matrix
+    outputnode.field_file           :   File, FNIRT coefficients
+    outputnode.warped_file          :   File, template in subject space
+    
+    Example
+    -------
+    "inputs": {"tracts": "DSI_TRK"} in the WarpRegions method, and
+    "connect": {"region_index": ["WarpRegions", "region_index"]}
+    in the DSI_TRK method of the analysis config
+    """
+    inputnode = 'inputnode'
+    outputnode = 'outputnode'
+    # Str values of these inputs naming a step are replaced by its inputs
+    step_inputs = ('tracts',)
+    
+    connection_spec = {
+        'template':         ['FileIn', 'template'],
+        'template_regions': ['FileIn', 'template_regions'],
+        'ref_file':         ['FileIn', 'ref_file']
+    }
+    
+    def __init__(self, name='WarpRegions', inputs=None, **kwargs):
+        if inputs is None:
+            inputs = {}
+        super(WarpRegions, self).__init__(name=name, **kwargs)
+        
+        if 'flirt' in inputs and inputs['flirt'] is not None:
+            flirtopts = inputs['flirt']
+        else:
+            flirtopts = {'dof': 12}
+        if 'fnirt' in inputs and inputs['fnirt'] is not None:
+            fnirtopts = dict(inputs['fnirt'])
+        else:
+            fnirtopts = {}
+        if 'FA' in inputs and inputs['FA']:
+            if fsl.no_fsl():
+                warn('NO FSL found')
+            else:
+                fnirtopts.setdefault('config_file', os.path.join(
+                    os.environ["FSLDIR"],
+                    "etc/flirtsch/FA_2_FMRIB58_1mm.cnf"))
+        fnirtopts.setdefault('fieldcoeff_file', True)
+        if 'applywarp' in inputs and inputs['applywarp'] is not None:
+            warpopts = inputs['applywarp']
+        else:
+            warpopts = {'interp': 'nn'}
+        
+        inputnode = pe.Node(
+            name='inputnode',
+            interface=IdentityInterface(
+                fields=['template', 'template_regions', 'ref_file']))
+        for k in ('template', 'template_regions', 'ref_file'):
+            if k in inputs and inputs[k] is not None:
+                setattr(inputnode.inputs, k, inputs[k])
+        
+        flirt = pe.Node(
+            name='flirt',
+            interface=fsl.FLIRT(**flirtopts))
+        
+        fnirt = pe.Node(
+            name='fnirt',
+            interface=fsl.FNIRT(**fnirtopts))
+        
+        # Regions named by any tract, once each
+        select = pe.Node(
+            name='select_regions',
+            interface=Function(
+                input_names=['template_regions', 'tracts'],
+                output_names=['regions'],
+                function=WarpRegions.select_regions))
+        if 'tracts' in inputs and inputs['tracts'] is not None:
+            if isinstance(inputs['tracts'], (str, unicode)):
+                raise KeyError('WarpRegions tracts "{}" is not a step of '
+                               'the setup'.format(inputs['tracts']))
+            select.inputs.tracts = inputs['tracts']
+        else:
+            select.inputs.tracts = None
+        
+        warp = pe.Node(
+            name='warpregions',
+            interface=Function(
+                input_names=['in_file', 'ref_file', 'field_file',
+                             'premat', 'postmat', 'options'],
+                output_names=['out_file'],
+                function=ApplyWarp.batch_applywarp))
+        warp.inputs.premat = None
+        warp.inputs.postmat = None
+        warp.inputs.options = warpopts
+        
+        index = pe.Node(
+            name='index_regions',
+            interface=Function(
+                input_names=['regions', 'warped_regions'],
+                output_names=['region_index', 'region_index_file'],
+                function=WarpRegions.index_warped))
+        
+        outputnode = pe.Node(
+            name='outputnode',
+            interface=IdentityInterface(
+                fields=['region_index', 'region_index_file',
+                        'warped_regions', 'affine_file', 'field_file',
+                        'warped_file']))
+        
+        self.connect([
+            (inputnode, flirt, [('template', 'in_file'),
+                                ('ref_file', 'reference')]),
+            (inputnode, fnirt, [('template', 'in_file'),
+                                ('ref_file', 'ref_file')]),
+            (flirt, fnirt, [('out_matrix_file', 'affine_file')]),
+            (inputnode, select, [('template_regions', 'template_regions')]),
+            (select, warp, [('regions', 'in_file')]),
+            (inputnode, warp, [('ref_file', 'ref_file')]),
+            (fnirt, warp, [('fieldcoeff_file', 'field_file')]),
+            (select, index, [('regions', 'regions')]),
+            (warp, index, [('out_file', 'warped_regions')]),
+            (index, outputnode, [('region_index', 'region_index'),
+                                 ('region_index_file', 'region_index_file')]),
+            (warp, outputnode, [('out_file', 'warped_regions')]),
+            (flirt, outputnode, [('out_matrix_file', 'affine_file')]),
+            (fnirt, outputnode, [('fieldcoeff_file', 'field_file'),
+                                 ('warped_file', 'warped_file')])
+            ])
+    
+    def select_regions(template_regions, tracts=None):
+        """Return the template regions named by tracts, in first use order,
+        or all template regions without tracts"""
+        from DINGO.utils import (build_region_index, lookup_region,
+                                 tract_region_names)
+        if not isinstance(template_regions, (list, tuple)):
+            template_regions = [template_regions]
+        if tracts is None:
+            return build_region_index(template_regions)['files']
+        template_index = build_region_index(template_regions)
+        regions = []
+        for name in tract_region_names(tracts):
+            region = lookup_region(template_index, name)
+            if region not in regions:
+                regions.append(region)
+        return regions
+    
+    def index_warped(regions, warped_regions):
+        """Return region index of warped_regions, matched by the names of
+        their template regions, and the index as json"""
+        import os
+        import json
+        from DINGO.utils import build_region_index
+        region_index = build_region_index(regions)
+        # regions are unique, so files line up with warped_regions
+        region_index['files'] = [os.path.abspath(f) for f in warped_regions]
+        region_index_file = os.path.abspath('region_index.json')
+        with open(region_index_file, 'w') as f:
+            json.dump(region_index, f)
+        return region_index, region_index_file
@@ -0,0 +1,76 @@
+import os
+import copy
+import gzip
+import numpy as np
+import nibabel as nib
+from DINGO.streamlines import (Streamlines, default_header, write_trk,
+                               dsi_studio_affine)
+from DINGO.cache import FibCache
+from DINGO.tests.test_streamlines import write_fib
+from DINGO.interfaces.dsistudio import DSIStudioBatchTrack
+from DINGO.workflows.dsistudio import DSI_TDI, DSI_TRK, DSI_HOLD, DSI_DROP
+
+
+def function(method):
+    """Function node functions are defined in class bodies, without self"""
+    return getattr(method, '__func__', method)
+
+
+def test_tract_images_fib_reference(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    dim = (10, 12, 8)
+    voxel_size = (2., 2., 2.)
+    fib = write_fib(str(tmpdir.join('a.fib.gz')), dim, voxel_size)
+    # two streamlines through LPS voxel (3, 4, 5), one ending there
+    trk = write_trk(str(tmpdir.join('a_tract.trk.gz')), Streamlines.from_list(
+        [np.array([[6.5, 8.5, 10.5], [6.5, 8.5, 12.5]]),
+         np.array([[4.5, 8.5, 10.5], [6.5, 8.5, 10.5], [8.5, 8.5, 10.5]])],
+        header=default_header(dim, voxel_size)))
+    tdi_files, end_files, mask_files = function(DSI_TDI.tract_images)(
+        [trk], fib)
+    tdi = nib.load(tdi_files[0])
+    assert np.allclose(tdi.affine, dsi_studio_affine(dim, voxel_size))
+    stored = (dim[0] - 1 - 3, dim[1] - 1 - 4, 5)
+    assert tdi.get_data()[stored] == 2
+    assert nib.load(end_files[0]).get_data()[stored] == 1
+    assert nib.load(mask_files[0]).get_data().sum() == 4
+
+
+def test_trk_leaves_inputs_alone():
+    inputs = {'batch': True, 'roa_cache': None, 'fiber_count': 1000,
+              'tracts': {'Genu': {'rois': ['Genu']},
+                         'Splenium': {'rois': ['Splenium']}}}
+    before = copy.deepcopy(inputs)
+    DSI_TRK(name='DSI_TRK', inputs=inputs)
+    assert inputs == before
+
+
+def test_batch_track_outputs_per_tract(tmpdir):
+    trk = str(tmpdir.join('a.Genu.trk.gz').ensure())
+    stat = str(tmpdir.join('a.Genu.stat.txt').ensure())
+    batch = DSIStudioBatchTrack(tract_names=['Empty', 'Genu'])
+    batch._tract_outputs = [{}, {'output': trk, 'stat_file': stat}]
+    outputs = batch._list_outputs()
+    assert outputs['tract_names'] == ['Empty', 'Genu']
+    assert outputs['output'] == [None, trk]
+    assert outputs['endpt'] == [None, None]
+    assert outputs['stat_file'] == [None, stat]
+
+
+def test_hold_drop_fib(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    fib = str(tmpdir.join('a.fib.gz'))
+    with gzip.open(fib, 'wb') as f:
+        f.write(b'fib')
+    cache_dir = str(tmpdir.join('cache'))
+    inputs = {'fib_cache_dir': cache_dir}
+    hold = DSI_HOLD(inputs=inputs, base_dir=str(tmpdir))
+    hold.inputs.fib_file = fib
+    assert hold.run().outputs.fib_file == fib
+    entry = FibCache(cache_dir).entry(fib)
+    assert os.path.isfile(entry)
+    drop = DSI_DROP(inputs=inputs, base_dir=str(tmpdir))
+    drop.inputs.fib_file = fib
+    drop.inputs.after = ['a_Genu.trk.gz']
+    drop.run()
+    assert not os.path.exists(os.path.dirname(entry))
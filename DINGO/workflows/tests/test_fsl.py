@@ -0,0 +1,225 @@
+import os
+import numpy as np
+import nibabel as nib
+import pytest
+from nipype.interfaces import fsl
+from DINGO.utils import lookup_region
+from DINGO.workflows.fsl import (ApplyWarp, TBSSRegNXN, TBSSPostReg,
+                                 TemplateBuild, WarpRegions)
+
+
+def function(method):
+    """Function node functions are defined in class bodies, without self"""
+    return getattr(method, '__func__', method)
+
+
+batch_applywarp = function(ApplyWarp.batch_applywarp)
+
+
+class IdentityApplyWarp(object):
+    """Stands in for fsl.ApplyWarp, copies in_file to out_file"""
+    calls = []
+
+    def __init__(self, in_file=None, ref_file=None, field_file=None,
+                 out_file=None, **options):
+        self.inputs = type('Inputs', (object,), {})()
+        self.in_file = in_file
+        self.out_file = out_file
+
+    def run(self):
+        IdentityApplyWarp.calls.append(self.in_file)
+        img = nib.load(self.in_file)
+        nib.Nifti1Image(np.asanyarray(img.dataobj), img.affine,
+                        img.header).to_filename(self.out_file)
+        outputs = type('Outputs', (object,), {'out_file': self.out_file})
+        return type('Result', (object,), {'outputs': outputs})
+
+
+@pytest.fixture
+def identity_warp(monkeypatch):
+    monkeypatch.setenv('FSLOUTPUTTYPE', 'NIFTI_GZ')
+    monkeypatch.setattr(fsl, 'ApplyWarp', IdentityApplyWarp)
+    IdentityApplyWarp.calls = []
+    return IdentityApplyWarp
+
+
+def save(path, data, affine=np.eye(4)):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    nib.Nifti1Image(data, affine).to_filename(path)
+    return path
+
+
+def test_batch_applywarp_duplicate_basenames(tmpdir, monkeypatch,
+                                            identity_warp):
+    monkeypatch.chdir(str(tmpdir))
+    shape = (4, 5, 6)
+    left = save(str(tmpdir.join('L', 'ROI.nii.gz')),
+                np.ones(shape, dtype=np.uint8))
+    right = save(str(tmpdir.join('R', 'ROI.nii.gz')),
+                 np.full(shape, 2, dtype=np.uint8))
+    out_files = batch_applywarp(
+        [left, right], 'ref.nii.gz', 'warp.nii.gz')
+    assert len(set(out_files)) == 2
+    assert [os.path.basename(f) for f in out_files] == ['ROI_warp.nii.gz'] * 2
+    # same grid, one applywarp for both
+    assert len(identity_warp.calls) == 1
+    assert np.all(nib.load(out_files[0]).get_data() == 1)
+    assert np.all(nib.load(out_files[1]).get_data() == 2)
+
+
+def test_batch_applywarp_groups_keep_order(tmpdir, monkeypatch,
+                                           identity_warp):
+    monkeypatch.chdir(str(tmpdir))
+    shifted = np.eye(4)
+    shifted[:3, 3] = 10
+    in_files = [
+        save(str(tmpdir.join('a', 'a.nii.gz')),
+             np.full((4, 4, 4), 1, dtype=np.int16)),
+        save(str(tmpdir.join('b', 'b.nii.gz')),
+             np.full((4, 4, 4), 2, dtype=np.int16), shifted),
+        save(str(tmpdir.join('c', 'c.nii.gz')),
+             np.full((4, 4, 4), 3, dtype=np.int16))]
+    out_files = batch_applywarp(
+        in_files, 'ref.nii.gz', 'warp.nii.gz')
+    assert len(identity_warp.calls) == 2
+    for value, out_file in zip((1, 2, 3), out_files):
+        img = nib.load(out_file)
+        assert img.shape == (4, 4, 4)
+        assert img.get_data_dtype() == np.int16
+        assert np.all(img.get_data() == value)
+
+
+def test_warp_regions_duplicate_basenames(tmpdir, monkeypatch,
+                                          identity_warp):
+    monkeypatch.chdir(str(tmpdir))
+    shape = (4, 5, 6)
+    left = save(str(tmpdir.join('L', 'ROI.nii.gz')),
+                np.ones(shape, dtype=np.uint8))
+    right = save(str(tmpdir.join('R', 'ROI.nii.gz')),
+                 np.full(shape, 2, dtype=np.uint8))
+    regions = function(WarpRegions.select_regions)(
+        [left, right], {'tract': {'rois': ['L/ROI', 'R/ROI']}})
+    warped = batch_applywarp(regions, 'ref.nii.gz', 'warp.nii.gz')
+    region_index, _ = function(WarpRegions.index_warped)(regions, warped)
+    assert np.all(nib.load(lookup_region(region_index, 'L/ROI'))
+                  .get_data() == 1)
+    assert np.all(nib.load(lookup_region(region_index, 'R/ROI'))
+                  .get_data() == 2)
+
+
+class RecordFLIRT(object):
+    """Stands in for fsl.FLIRT -applyxfm, keeps the matrix and copies
+    in_file to out_file"""
+    calls = []
+
+    def __init__(self, **inputs):
+        self.inputs = inputs
+
+    def run(self):
+        RecordFLIRT.calls.append(
+            dict(self.inputs, matrix=np.loadtxt(self.inputs['in_matrix_file'])))
+        img = nib.load(self.inputs['in_file'])
+        nib.Nifti1Image(np.asanyarray(img.dataobj), img.affine,
+                        img.header).to_filename(self.inputs['out_file'])
+
+
+def test_unbiased_mean_inverts_mean_affine(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    monkeypatch.setattr(fsl, 'FLIRT', RecordFLIRT)
+    RecordFLIRT.calls = []
+    in_files = [save(str(tmpdir.join('a', 'a.nii.gz')),
+                     np.full((4, 4, 4), 1, dtype=np.float32)),
+                save(str(tmpdir.join('b', 'b.nii.gz')),
+                     np.full((4, 4, 4), 3, dtype=np.float32))]
+    affine_files = []
+    for name, scale, shift in (('a', 1.0, 2), ('b', 1.2, 4)):
+        mat = np.diag([scale, scale, scale, 1])
+        mat[0, 3] = shift
+        affine_files.append(str(tmpdir.join('{}.mat'.format(name))))
+        np.savetxt(affine_files[-1], mat)
+    out_file = function(TemplateBuild.unbiased_mean)(
+        in_files, affine_files, 'fsl', 'template1.nii.gz')
+    assert out_file == str(tmpdir.join('template1.nii.gz'))
+    assert np.allclose(nib.load(out_file).get_data(), 2)
+    call, = RecordFLIRT.calls
+    assert call['apply_xfm']
+    assert call['reference'] == call['in_file']
+    expected = np.diag([1 / 1.1, 1 / 1.1, 1 / 1.1, 1])
+    expected[0, 3] = -3 / 1.1
+    assert np.allclose(call['matrix'], expected)
+
+
+def test_template_build_starts_from_affine_average():
+    wf = TemplateBuild(req_join=False, inputs={'iterations': 2})
+    names = set(wf.list_node_names())
+    assert set(['affine', 'mean_affine', 'reg0', 'mean1']) <= names
+    reg0 = wf.get_node('reg0')
+    sources = [u.name for u, v in wf._graph.in_edges(reg0)]
+    assert 'mean_affine' in sources and 'initial' not in sources
+    wf = TemplateBuild(req_join=False,
+                       inputs={'iterations': 1, 'affine_initial': False})
+    assert 'affine' not in wf.list_node_names()
+
+
+def test_collect_pairs_by_target():
+    ids = ['a', 'b', 'c']
+    targets = ['a', 'c']
+    # make_pairs order, every id to the first target, then the next
+    pairs = ['{}_to_{}'.format(i, t) for t in targets for i in ids]
+    mms = [[n, n / 2.] for n in range(len(pairs))]
+    mats, fields, mean_medians = function(TBSSRegNXN.collect_pairs)(
+        ids, targets, pairs, [p + '_warp' for p in pairs], mms)
+    assert mats == [['a_to_a', 'b_to_a', 'c_to_a'],
+                    ['a_to_c', 'b_to_c', 'c_to_c']]
+    assert fields[1] == ['a_to_c_warp', 'b_to_c_warp', 'c_to_c_warp']
+    assert mean_medians[1] == mms[3:]
+    with pytest.raises(IndexError):
+        function(TBSSRegNXN.collect_pairs)(ids, targets, pairs[:-1],
+                                           pairs[:-1], mms[:-1])
+
+
+def test_pad_candidates():
+    ids = ['a', 'b', 'c']
+    mats, fields, mean_medians = function(TBSSRegNXN.pad_candidates)(
+        ids, [1], [['a_to_b', 'b_to_b', 'c_to_b']],
+        [['a_warp', 'b_warp', 'c_warp']], [[[1, 1], [0, 0], [2, 2]]])
+    assert mats == [None, ['a_to_b', 'b_to_b', 'c_to_b'], None]
+    assert fields[1] == ['a_warp', 'b_warp', 'c_warp']
+    inf = float('inf')
+    assert mean_medians[0] == [[inf, inf]] * 3
+    assert mean_medians[1] == [[1, 1], [0, 0], [2, 2]]
+    best = function(TBSSPostReg.find_best)(ids, mean_medians)
+    assert best == (1, 'b', 1.0, 1.0)
+
+
+def loop_find_best(id_list, list_numlists):
+    """TBSSPostReg.find_best before it was vectorised"""
+    nids = len(id_list)
+    idmeans = []
+    idmedians = []
+    for o in range(0, nids):
+        idmeans.append(sum(list_numlists[o][i][0]
+                           for i in range(0, nids)) / nids)
+        idmedians.append(sum(list_numlists[o][i][1]
+                             for i in range(0, nids)) / nids)
+    best_index = idmeans.index(min(idmeans))
+    return (best_index, id_list[best_index], idmeans[best_index],
+            idmedians[best_index])
+
+
+def test_find_best_as_loop():
+    find_best = function(TBSSPostReg.find_best)
+    rng = np.random.RandomState(0)
+    ids = ['s{:d}'.format(i) for i in range(5)]
+    # fslstats out_stat may carry more values than mean and median
+    numlists = rng.uniform(0, 3, size=(5, 5, 3)).tolist()
+    index, best_id, mean, median = find_best(ids, numlists)
+    expected = loop_find_best(ids, numlists)
+    assert (index, best_id) == expected[:2]
+    assert np.allclose((mean, median), expected[2:])
+    # ties go to the first
+    tied = [[[1., 1.]] * 3, [[0.5, 2.]] * 3, [[0.5, 0.]] * 3]
+    assert find_best(ids[:3], tied) == loop_find_best(ids[:3], tied)
+    with pytest.raises(IndexError):
+        find_best(ids, numlists[:4])
@@ -0,0 +1,37 @@
+import os
+import pytest
+from DINGO.workflows.utils import FileInSConfig
+
+
+def function(method):
+    """Function node functions are defined in class bodies, without self"""
+    return getattr(method, '__func__', method)
+
+
+read_subject_template = function(FileInSConfig.read_subject_template)
+
+
+def test_subject_templates_per_subject(tmpdir):
+    flow = FileInSConfig.__new__(FileInSConfig)
+    templates = {'CHD_052_01a_1': {'fa': 'CHD_052/01a/CHD_052_01a_FA.nii.gz'},
+                 'CHD_053_01a_1': {'fa': 'CHD_053/01a/CHD_053_01a_FA.nii.gz'}}
+    templates_dir = flow.write_subject_templates(str(tmpdir), templates,
+                                                 ['fa'])
+    assert sorted(os.listdir(templates_dir)) == ['CHD_052_01a_1.json',
+                                                 'CHD_053_01a_1.json']
+    assert read_subject_template(templates_dir, 'CHD_052', '01a',
+                                 '1') == templates['CHD_052_01a_1']
+    # an unchanged subject's file is not rewritten
+    unchanged = os.path.join(templates_dir, 'CHD_053_01a_1.json')
+    os.utime(unchanged, (0, 0))
+    templates['CHD_052_01a_1'] = {'fa': 'CHD_052/01a/FA.nii.gz'}
+    assert flow.write_subject_templates(str(tmpdir), templates,
+                                        ['fa']) == templates_dir
+    assert os.stat(unchanged).st_mtime == 0
+    assert read_subject_template(templates_dir, 'CHD_052', '01a',
+                                 '1') == templates['CHD_052_01a_1']
+    # other outfields do not share the directory
+    assert flow.write_subject_templates(str(tmpdir), templates,
+                                        ['fa', 'md']) != templates_dir
+    with pytest.raises(KeyError):
+        read_subject_template(templates_dir, 'CHD_054', '01a', '1')
@@ -1,4 +1,5 @@
 import os
+import json
 from DINGO.utils import (read_setup,
                          split_chpid,
                          join_strs,
@@ -6,6 +7,9 @@ from DINGO.utils import (read_setup,
 from DINGO.base import (DINGO,
                         DINGOFlow,
                         DINGONode)
+from DINGO.manifest import prepare_manifest
+from DINGO.interfaces.io import (DINGOGrabber,
+                                DINGOSink)
 from nipype import (IdentityInterface,
                     Function)
 import nipype.pipeline.engine as pe
@@ -477,6 +481,12 @@ class FileIn(DINGONode):
     field_template  :    Dict, overwrite default template per outfield
     template_args   :    Dict, linking infields to template or field_template
     sort_filelist   :    Boolean
+    manifest        :    Bool or Str, resolve templates from a FileManifest
+        of base_directory instead of globbing, True for the default
+        base_directory/.dingo_manifest.json or a path to the manifest. It is
+        created or refreshed once when the workflow is built.
+    manifest_n_procs:    Int, threads used to scan base_directory
+        (default cpu_count)
     
     Returns
     -------
@@ -561,14 +571,28 @@ class FileIn(DINGONode):
         else:
             template_args = inputs['template_args']
             
+        if 'manifest' in inputs and inputs['manifest']:
+            if 'manifest_n_procs' in inputs:
+                n_procs = inputs['manifest_n_procs']
+            else:
+                n_procs = None
+            manifest = prepare_manifest(
+                base_directory, inputs['manifest'], n_procs)
+            grabber = DINGOGrabber
+        else:
+            manifest = None
+            grabber = nio.DataGrabber
+
         # Create DataGrabber node
         super(FileIn, self).__init__(name=name, 
-                                     interface=nio.DataGrabber(
+                                     interface=grabber(
                                          infields=infields,
                                          outfields=outfields),
                                      **kwargs)
             
         self.inputs.base_directory = base_directory
+        if manifest is not None:
+            self.inputs.manifest = manifest
         self.inputs.template = '*'
         self.inputs.field_template = field_template
         self.inputs.template_args = template_args
@@ -589,9 +613,25 @@ class FileInSConfig(DINGOFlow):
     Optional Inputs - in dict arg inputs or connected to create_ft
     ---------------
     repl                :    List or Dict
+    manifest            :    Bool or Str, see FileIn, requires base_directory
+        in inputs
+    manifest_n_procs    :    Int
+    
+    Batch Inputs - in dict arg inputs, configs of all ids are read and
+    validated when the workflow is created, instead of by nodes per subject
+    ------------
+    id_list             :    List[Str] e.g. "included_ids"
+    id_sep              :    Str (default '_')
+    batch_n_procs       :    Int, threads reading configs (default cpu_count)
+    
+    In batch mode each subject's field_template is written to its own json
+    file under base_directory/.dingo_templates, and a subject_template node
+    reads it for the grabber, so a grabber only gets (and hashes) its own
+    subject's templates, and editing one config does not rerun the others.
     """
     inputnode = 'inputnode'
     outputnode = 'filein'
+    templates_name = '.dingo_templates'
     
     connection_spec = {
         'sub_id':   ['SplitIDs', 'sub_id'],
@@ -633,6 +673,79 @@ class FileInSConfig(DINGOFlow):
         if 'uid' in inputs and inputs['uid'] is not None:
             inputnode.inputs.uid = inputs['uid']
             
+        if 'manifest' in inputs and inputs['manifest']:
+            if ('base_directory' not in inputs or
+                    inputs['base_directory'] is None):
+                raise KeyError('inputs["base_directory"] '
+                               'must be specified to use a manifest in {}'
+                               .format(self.__class__))
+            if 'manifest_n_procs' in inputs:
+                n_procs = inputs['manifest_n_procs']
+            else:
+                n_procs = None
+            manifest = prepare_manifest(
+                inputs['base_directory'], inputs['manifest'], n_procs)
+        else:
+            manifest = None
+
+        if 'repl' in inputs and inputs['repl'] is not None:
+            repl = inputs['repl']
+        else:
+            repl = None
+
+        if 'id_list' in inputs and inputs['id_list'] is not None:
+            # batch mode, all subject configs are read now, the grabber
+            # picks the field_template of its subject
+            if ('base_directory' not in inputs or
+                    inputs['base_directory'] is None):
+                raise KeyError('inputs["base_directory"] '
+                               'must be specified with inputs["id_list"] in {}'
+                               .format(self.__class__))
+            if 'id_sep' in inputs and inputs['id_sep'] is not None:
+                id_sep = inputs['id_sep']
+            else:
+                id_sep = '_'
+            if 'batch_n_procs' in inputs:
+                n_procs = inputs['batch_n_procs']
+            else:
+                n_procs = None
+            self.batch_templates = self.subject_templates(
+                inputs['base_directory'], inputs['id_list'], id_sep,
+                inputs['outfields'], repl=repl, n_procs=n_procs)
+            
+            # rerun every time, reading one small file, so that the grabber
+            # sees the current template of its own subject
+            select = pe.Node(
+                name='subject_template',
+                interface=Function(
+                    input_names=['templates_dir', 'sub_id', 'scan_id', 'uid'],
+                    output_names=['field_template'],
+                    function=self.read_subject_template),
+                overwrite=True)
+            select.inputs.templates_dir = self.write_subject_templates(
+                inputs['base_directory'], self.batch_templates,
+                inputs['outfields'], repl)
+
+            filein = pe.Node(
+                name='filein',
+                interface=DINGOGrabber(outfields=inputs['outfields']))
+            filein.inputs.template_args = dict(
+                (o, []) for o in inputs['outfields'])
+            filein.inputs.template = '*'
+            filein.inputs.sort_filelist = True
+            if manifest is not None:
+                filein.inputs.manifest = manifest
+
+            self.connect([
+                (inputnode, select, [('sub_id', 'sub_id'),
+                                     ('scan_id', 'scan_id'),
+                                     ('uid', 'uid')]),
+                (inputnode, filein, [('base_directory', 'base_directory')]),
+                (select, filein, [('field_template', 'field_template')])
+                ])
+            return
+        self.batch_templates = None
+
         cfgpath = pe.Node(
             name='cfgpath',
             interface=Function(
@@ -665,10 +778,16 @@ class FileInSConfig(DINGOFlow):
                 output_names=['field_template'],
                 function=self.create_field_template))
                 
-        if 'repl' in inputs and inputs['repl'] is not None:
-            create_ft.inputs.repl = inputs['repl']
+        if repl is not None:
+            create_ft.inputs.repl = repl
                 
-        filein = pe.Node(
+        if manifest is not None:
+            filein = pe.Node(
+                name='filein',
+                interface=DINGOGrabber(outfields=inputs['outfields']))
+            filein.inputs.manifest = manifest
+        else:
+            filein = pe.Node(
                 name='filein',
                 interface=nio.DataGrabber(outfields=inputs['outfields']))
         filein.inputs.template = '*'
@@ -690,6 +809,111 @@ class FileInSConfig(DINGOFlow):
             (create_ft, filein, [('field_template', 'field_template')])
             ])
 
+    def subject_templates(self, base_directory, id_list, id_sep, outfields,
+                          repl=None, n_procs=None):
+        """Read the config of every subject in id_list and return the field
+        templates, as the cfgpath, read_conf and create_field_template nodes
+        would for each subject.
+
+        Configs are read in parallel, all invalid or missing configs are
+        reported together.
+
+        Returns
+        -------
+        subject_templates   :   Dict{DINGOGrabber.subject_key: field_template}
+        """
+        from multiprocessing import cpu_count
+        from multiprocessing.pool import ThreadPool
+        cfgpath_from_ids = self.cfgpath_from_ids.__func__
+        create_field_template = self.create_field_template.__func__
+        if isinstance(id_list, (str, unicode)):
+            id_list = [id_list]
+
+        def load(psid):
+            try:
+                sub_id, scan_id, uid = split_chpid(psid, id_sep)
+                path = cfgpath_from_ids(base_directory=base_directory,
+                                        sub_id=sub_id,
+                                        scan_id=scan_id,
+                                        uid=uid)
+                config = read_setup(path)
+                field_template = create_field_template(
+                    base_directory=base_directory,
+                    sub_id=sub_id, scan_id=scan_id, uid=uid,
+                    config=config, outfields=outfields, repl=repl)
+            except Exception as err:
+                return psid, None, '{}: {}'.format(type(err).__name__, err)
+            key = DINGOGrabber.subject_key(sub_id, scan_id, uid)
+            return key, field_template, None
+
+        if n_procs is None:
+            n_procs = cpu_count()
+        if n_procs > 1 and len(id_list) > 1:
+            pool = ThreadPool(min(n_procs, len(id_list)))
+            try:
+                results = pool.map(load, id_list)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(load, id_list)
+
+        subject_templates = dict()
+        errors = []
+        for key, field_template, err in results:
+            if err is not None:
+                errors.append('{}: {}'.format(key, err))
+            else:
+                subject_templates[key] = field_template
+        if len(errors) > 0:
+            raise ValueError('{} subject config errors in {}:\n{}'
+                             .format(len(errors), base_directory,
+                                     '\n'.join(errors)))
+        return subject_templates
+
+    def write_subject_templates(self, base_directory, subject_templates,
+                                outfields, repl=None):
+        """Write each subject's field_template to <subject_key>.json in a
+        directory of base_directory/.dingo_templates named by outfields and
+        repl. Files whose content is unchanged are left alone.
+
+        Returns
+        -------
+        templates_dir   :   Directory
+        """
+        import hashlib
+        from DINGO.interfaces.io import makedirs
+        name = hashlib.sha1(json.dumps([sorted(outfields), repl],
+                                       sort_keys=True)).hexdigest()
+        templates_dir = os.path.join(os.path.abspath(base_directory),
+                                     self.templates_name, name)
+        makedirs(templates_dir)
+        for key, field_template in subject_templates.items():
+            path = os.path.join(templates_dir, ''.join((key, '.json')))
+            text = json.dumps(field_template, sort_keys=True)
+            if os.path.isfile(path):
+                with open(path, 'r') as f:
+                    if f.read() == text:
+                        continue
+            tmp = '{}.{:d}.tmp'.format(path, os.getpid())
+            with open(tmp, 'w') as f:
+                f.write(text)
+            os.rename(tmp, path)
+        return templates_dir
+
+    def read_subject_template(templates_dir, sub_id, scan_id, uid):
+        """Return the field_template of one subject, as written by
+        write_subject_templates"""
+        import os
+        from DINGO.interfaces.io import DINGOGrabber
+        from DINGO.utils import json_load_byteified
+        key = DINGOGrabber.subject_key(sub_id, scan_id, uid)
+        path = os.path.join(templates_dir, ''.join((key, '.json')))
+        if not os.path.isfile(path):
+            raise KeyError('No field_template for subject {}'.format(key))
+        with open(path, 'r') as f:
+            return json_load_byteified(f)
+
     def cfgpath_from_ids(base_directory=None,
                          sub_id=None, scan_id=None, uid=None):
         if (base_directory is not None and
@@ -781,6 +1005,15 @@ class FileOut(DINGOFlow):
         uid             :   Str
         container       :   Str, default '{0}/{1}'
         container_args  :   List, default ['sub_id', 'scan_id']
+        sink_method     :   Str, 'copy' (default), 'hardlink', 'reflink' or
+            'symlink', links fall back to copy when not possible. Symlinks
+            point into the nipype cache, which must then be kept.
+        sink_n_procs    :   Int, threads used to copy (default 1)
+        manifest        :   Bool or Str, write a manifest of the sunk files
+            with size, mtime and checksum in each container, and a cohort
+            index parent_dir/<manifest>_index.json, True to name it after
+            this workflow
+        checksum        :   Str, 'md5' (default), 'sha1' or 'sha256'
         
     Returns
     -------
@@ -865,10 +1098,30 @@ class FileOut(DINGOFlow):
         else:
             nodetype = TRKnode
         
+        if (('sink_method' in inputs and inputs['sink_method'] is not None) or
+                ('sink_n_procs' in inputs and
+                 inputs['sink_n_procs'] is not None) or
+                ('manifest' in inputs and inputs['manifest'])):
+            sinkinterface = DINGOSink(infields=infields,
+                                      parameterization=False)
+            if 'sink_method' in inputs and inputs['sink_method'] is not None:
+                sinkinterface.inputs.sink_method = inputs['sink_method']
+            if 'sink_n_procs' in inputs and inputs['sink_n_procs'] is not None:
+                sinkinterface.inputs.sink_n_procs = inputs['sink_n_procs']
+            if 'manifest' in inputs and inputs['manifest']:
+                if inputs['manifest'] is True:
+                    sinkinterface.inputs.manifest_name = name
+                else:
+                    sinkinterface.inputs.manifest_name = inputs['manifest']
+            if 'checksum' in inputs and inputs['checksum'] is not None:
+                sinkinterface.inputs.checksum = inputs['checksum']
+        else:
+            sinkinterface = nio.DataSink(infields=infields,
+                                         parameterization=False)
+
         sink = nodetype(
             name='sink',
-            interface=nio.DataSink(infields=infields,
-                                   parameterization=False),
+            interface=sinkinterface,
             **sinkargs)
         
         if 's2r' in inputs and inputs['s2r'] is not None: